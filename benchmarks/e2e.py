@@ -0,0 +1,139 @@
+"""
+End to end throughput of the worker pipeline, process_data -> Batcher -> insert_batch,
+against the in memory stand-ins of benchmarks/stand_ins.py.
+
+    python benchmarks/e2e.py --messages 50000 --v2-ratio 0.5 --latency latency.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import resource
+import time
+
+from stand_ins import FakeDatabase, FakeKafkaConsumer, LatencyModel, MessageFactory
+
+import main  # noqa: E402
+from _cache import DimensionCaches, TTLCache  # noqa: E402
+from _dedupe import WindowedBloomFilter  # noqa: E402
+from aiokafka import TopicPartition  # noqa: E402
+from core.config import settings  # noqa: E402
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--v2-ratio", type=float, default=0.5)
+    parser.add_argument("--players", type=int, default=10_000)
+    parser.add_argument("--duplicate-rate", type=float, default=0.01)
+    parser.add_argument("--partitions", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=main.BATCH_SIZE)
+    parser.add_argument("--batch-max-age", type=float, default=main.BATCH_MAX_AGE)
+    parser.add_argument(
+        "--latency",
+        help="json file of recorded statement latencies, {statement: [seconds]}",
+    )
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--json", action="store_true", help="print the result as json")
+    return parser.parse_args()
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def feed(
+    kafka: FakeKafkaConsumer, payloads: list[bytes], partitions: int
+) -> None:
+    """
+    Put the payloads on the consumer queue like ReportConsumer.consume_messages,
+    the value is deserialized here as the aiokafka value_deserializer would.
+    """
+    queue = main.consumer.get_queue()
+    tps = [TopicPartition(settings.REPORT_TOPIC, p) for p in range(partitions)]
+    offsets = [0] * partitions
+    for i, payload in enumerate(payloads):
+        p = i % partitions
+        # with a decode pool the consumer leaves the value serialized
+        value = payload if settings.DECODE_EXECUTOR else json.loads(payload)
+        record = kafka.record(tps[p], offsets[p], value)
+        main.consumer.tracker.track(tps[p], offsets[p])
+        offsets[p] += 1
+        await queue.put(record)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    latency = (
+        LatencyModel.load(args.latency) if args.latency else LatencyModel()
+    ).scaled(args.latency_scale)
+    db = FakeDatabase(latency)
+    kafka = FakeKafkaConsumer()
+    main.get_session = db.get_session
+    main.consumer.consumer = kafka
+
+    factory = MessageFactory(
+        v2_ratio=args.v2_ratio,
+        players=args.players,
+        duplicate_rate=args.duplicate_rate,
+    )
+    payloads = factory.serialized(args.messages)
+    # v2 messages refer to player ids, which have to exist for the sightings
+    db.players.update({f"player{i}": i + 1 for i in range(args.players)})
+
+    player_cache = TTLCache(max_bytes=settings.PLAYER_CACHE_MAX_BYTES)
+    dimension_cache = DimensionCaches(max_size=main.DIMENSION_CACHE_SIZE)
+    seen = WindowedBloomFilter(
+        window=settings.DEDUPE_WINDOW,
+        capacity=settings.DEDUPE_CAPACITY,
+        fp_rate=settings.DEDUPE_FP_RATE,
+    )
+    pipeline, _ = main.build_pipeline(
+        player_cache=player_cache,
+        dimension_cache=dimension_cache,
+        seen=seen,
+        batch_size=args.batch_size,
+        batch_max_age=args.batch_max_age,
+    )
+
+    started_at = time.perf_counter()
+    pipeline.start()
+    try:
+        await feed(kafka, payloads, args.partitions)
+        async with asyncio.timeout(args.timeout):
+            while sum(kafka.committed.values()) < args.messages:
+                await asyncio.sleep(0.01)
+    finally:
+        elapsed = time.perf_counter() - started_at
+        await pipeline.stop()
+
+    return {
+        "messages": args.messages,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(args.messages / elapsed, 1),
+        "latency_p50": round(percentile(kafka.latencies, 0.50), 4),
+        "latency_p99": round(percentile(kafka.latencies, 0.99), 4),
+        # kilobytes on linux
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "reports": db.reports,
+        "dropped": dict(main.drop_counts),
+        "statements": dict(db.statements),
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for k, v in result.items():
+            print(f"{k:>20}: {v}")
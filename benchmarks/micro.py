@@ -0,0 +1,211 @@
+"""
+Microbenchmarks of the per report hot functions, compared against the stored
+baseline in benchmarks/micro_baseline.json.
+
+    python benchmarks/micro.py            # compare, exit 1 on a regression
+    python benchmarks/micro.py --save     # store the current numbers as baseline
+
+ns/op is the fastest of --repeat timed loops, alloc is the peak traced memory
+of a single op in bytes, so a regression in either is not hidden by noise.
+Baselines are only comparable on the machine they were saved on.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+from stand_ins import MessageFactory
+
+from _cache import SimpleALRUCache  # noqa: E402
+from app.controllers.player import PlayerController  # noqa: E402
+from app.controllers.report import ReportController  # noqa: E402
+from app.views.report import (  # noqa: E402
+    convert_stg_to_kafka_report,
+    decode_messages,
+    normalize_reports,
+)
+
+BASELINE = os.path.join(os.path.dirname(__file__), "micro_baseline.json")
+# allocations below this many bytes are noise of the interpreter
+ALLOC_SLACK = 64
+
+
+def run_sync(coro):
+    """
+    Run a coroutine that never suspends, without the overhead of an event loop.
+    """
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError(f"{coro} suspended")
+
+
+@dataclass
+class Bench:
+    name: str
+    fn: object
+    # items handled per call, ns/op is per item
+    items: int = 1
+
+
+def benches() -> list[Bench]:
+    factory = MessageFactory(v2_ratio=1, players=10_000, duplicate_rate=0)
+    msgs = [factory.message() for _ in range(100)]
+    values = [json.dumps(msg).encode() for msg in msgs]
+    _, rows, _ = normalize_reports(msgs)
+
+    player_controller = PlayerController(cache=None)
+    report_controller = ReportController(session=None)
+
+    cache = SimpleALRUCache(max_size=10_000)
+    keys = [(i, i + 1, 0) for i in range(10_000)]
+    for key in keys:
+        run_sync(cache.put(key, 1))
+    hit = keys[5_000]
+
+    return [
+        Bench("normalize_reports", lambda: normalize_reports(msgs), items=len(msgs)),
+        Bench("decode_messages", lambda: decode_messages(values), items=len(values)),
+        Bench(
+            "convert_stg_to_kafka_report",
+            lambda: convert_stg_to_kafka_report(rows[0]),
+        ),
+        Bench(
+            "ReportController._parse_reports",
+            lambda: report_controller._parse_reports(rows),
+            items=len(rows),
+        ),
+        Bench(
+            "PlayerController.sanitize_name",
+            lambda: player_controller.sanitize_name("Some_Player-Name "),
+        ),
+        Bench("SimpleALRUCache.get", lambda: run_sync(cache.get(hit))),
+        Bench("SimpleALRUCache.put", lambda: run_sync(cache.put(hit, 2))),
+    ]
+
+
+def time_op(bench: Bench, repeat: int, min_seconds: float) -> float:
+    # calibrate the loop so one timing takes min_seconds
+    loops = 1
+    while True:
+        started_at = time.perf_counter_ns()
+        for _ in range(loops):
+            bench.fn()
+        elapsed = time.perf_counter_ns() - started_at
+        if elapsed >= min_seconds * 1e9:
+            break
+        loops *= 2
+
+    best = elapsed / loops
+    for _ in range(repeat - 1):
+        started_at = time.perf_counter_ns()
+        for _ in range(loops):
+            bench.fn()
+        best = min(best, (time.perf_counter_ns() - started_at) / loops)
+    return best / bench.items
+
+
+def alloc_op(bench: Bench, samples: int = 5) -> int:
+    bench.fn()
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            bench.fn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - current)
+    finally:
+        tracemalloc.stop()
+    return sorted(peaks)[len(peaks) // 2] // bench.items
+
+
+def measure(bench: Bench, repeat: int, min_seconds: float) -> dict:
+    gc.collect()
+    gc.disable()
+    try:
+        return {
+            "ns_per_op": round(time_op(bench, repeat, min_seconds), 1),
+            "alloc_bytes": alloc_op(bench),
+        }
+    finally:
+        gc.enable()
+
+
+def compare(
+    baseline: dict, result: dict, ns_threshold: float, alloc_threshold: float
+) -> list[str]:
+    regressions = []
+    ns, base_ns = result["ns_per_op"], baseline["ns_per_op"]
+    if ns > base_ns * (1 + ns_threshold):
+        regressions.append(f"ns/op {base_ns} -> {ns} (+{ns / base_ns - 1:.0%})")
+    alloc, base_alloc = result["alloc_bytes"], baseline["alloc_bytes"]
+    if alloc > base_alloc * (1 + alloc_threshold) + ALLOC_SLACK:
+        regressions.append(f"alloc {base_alloc} -> {alloc} bytes")
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--save", action="store_true", help="overwrite the baseline")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("-k", dest="filter", help="only benchmarks containing this")
+    parser.add_argument("--repeat", type=int, default=9)
+    parser.add_argument("--min-seconds", type=float, default=0.2)
+    parser.add_argument("--ns-threshold", type=float, default=0.25)
+    parser.add_argument("--alloc-threshold", type=float, default=0.10)
+    return parser.parse_args()
+
+
+def run(args: argparse.Namespace) -> int:
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    failed = 0
+    results = {}
+    for bench in benches():
+        if args.filter and args.filter not in bench.name:
+            continue
+        result = results[bench.name] = measure(bench, args.repeat, args.min_seconds)
+        line = (
+            f"{bench.name:<34} {result['ns_per_op']:>10.1f} ns/op"
+            f" {result['alloc_bytes']:>8} B/op"
+        )
+
+        baseline = baselines.get(bench.name)
+        if args.save:
+            pass
+        elif baseline is None:
+            line += "  (no baseline)"
+        elif regressions := compare(
+            baseline, result, args.ns_threshold, args.alloc_threshold
+        ):
+            failed += 1
+            line += "  REGRESSION " + ", ".join(regressions)
+        else:
+            line += f"  ok ({result['ns_per_op'] / baseline['ns_per_op']:.2f}x)"
+        print(line)
+
+    if args.save:
+        baselines.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"saved {len(results)} baselines to {args.baseline}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    sys.exit(run(args))
@@ -23,6 +23,16 @@ def create_topics():
                 num_partitions=4,
                 replication_factor=1,
             ),
+            NewTopic(
+                name="report-retry",
+                num_partitions=4,
+                replication_factor=1,
+            ),
+            NewTopic(
+                name="report-dlq",
+                num_partitions=1,
+                replication_factor=1,
+            ),
         ]
     )
 
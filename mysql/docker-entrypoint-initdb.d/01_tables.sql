@@ -138,3 +138,132 @@ CREATE TABLE `report` (
     `region_id` MEDIUMINT UNSIGNED NOT NULL,
     PRIMARY key (`report_sighting_id`, `report_location_id`, `region_id`)
 );
+
+-- one row per partition of every committed batch, offsets as "start-end,start-end"
+CREATE TABLE `report_batch_ledger` (
+    `fingerprint` BINARY(16) NOT NULL,
+    `topic` VARCHAR(255) NOT NULL,
+    `partition_id` INT UNSIGNED NOT NULL,
+    `offsets` MEDIUMTEXT NOT NULL,
+    `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY key (`fingerprint`, `topic`, `partition_id`),
+    KEY idx_topic_partition_created_at (`topic`, `partition_id`, `created_at`),
+    KEY idx_created_at (`created_at`)
+);
+
+-- normalizes the session's temp_report into report_sighting, report_gear, report_location & report
+-- the dimension inserts ignore rows a concurrent writer inserted after the NOT EXISTS check
+DELIMITER $$
+
+CREATE PROCEDURE normalize_temp_report()
+BEGIN
+    INSERT IGNORE INTO report_sighting (reporting_id, reported_id, manual_detect)
+    SELECT DISTINCT tr.reporting_id, tr.reported_id, tr.manual_detect FROM temp_report tr
+    WHERE NOT EXISTS (
+        SELECT 1 FROM report_sighting rs
+        WHERE 1
+            AND tr.reporting_id = rs.reporting_id
+            AND tr.reported_id = rs.reported_id
+            AND tr.manual_detect = rs.manual_detect
+    );
+
+    INSERT IGNORE INTO report_gear (
+        equip_head_id,
+        equip_amulet_id,
+        equip_torso_id,
+        equip_legs_id,
+        equip_boots_id,
+        equip_cape_id,
+        equip_hands_id,
+        equip_weapon_id,
+        equip_shield_id
+    )
+    SELECT DISTINCT
+        tr.equip_head_id,
+        tr.equip_amulet_id,
+        tr.equip_torso_id,
+        tr.equip_legs_id,
+        tr.equip_boots_id,
+        tr.equip_cape_id,
+        tr.equip_hands_id,
+        tr.equip_weapon_id,
+        tr.equip_shield_id
+    FROM temp_report tr
+    WHERE NOT EXISTS (
+        SELECT 1 FROM report_gear rg
+        WHERE 1
+            AND tr.equip_head_id <=> rg.equip_head_id
+            AND tr.equip_amulet_id <=> rg.equip_amulet_id
+            AND tr.equip_torso_id <=> rg.equip_torso_id
+            AND tr.equip_legs_id <=> rg.equip_legs_id
+            AND tr.equip_boots_id <=> rg.equip_boots_id
+            AND tr.equip_cape_id <=> rg.equip_cape_id
+            AND tr.equip_hands_id <=> rg.equip_hands_id
+            AND tr.equip_weapon_id <=> rg.equip_weapon_id
+            AND tr.equip_shield_id <=> rg.equip_shield_id
+    );
+
+    INSERT IGNORE INTO report_location (region_id, x_coord, y_coord, z_coord)
+    SELECT DISTINCT tr.region_id, tr.x_coord, tr.y_coord, tr.z_coord FROM temp_report tr
+    WHERE NOT EXISTS (
+        SELECT 1 FROM report_location rl
+        WHERE 1
+            AND tr.region_id = rl.region_id
+            AND tr.x_coord = rl.x_coord
+            AND tr.y_coord = rl.y_coord
+            AND tr.z_coord = rl.z_coord
+    );
+
+    INSERT IGNORE INTO report (
+        report_sighting_id,
+        report_location_id,
+        report_gear_id,
+        reported_at,
+        on_members_world,
+        on_pvp_world,
+        world_number,
+        region_id
+    )
+    SELECT
+        rs.report_sighting_id,
+        rl.report_location_id,
+        MIN(rg.report_gear_id),
+        tr.reported_at,
+        tr.on_members_world,
+        tr.on_pvp_world,
+        tr.world_number,
+        tr.region_id
+    FROM temp_report tr
+    JOIN report_sighting rs
+        ON rs.reporting_id = tr.reporting_id
+        AND rs.reported_id = tr.reported_id
+        AND rs.manual_detect = tr.manual_detect
+    JOIN report_location rl
+        ON rl.region_id = tr.region_id
+        AND rl.x_coord = tr.x_coord
+        AND rl.y_coord = tr.y_coord
+        AND rl.z_coord = tr.z_coord
+    JOIN report_gear rg
+        ON rg.equip_head_id <=> tr.equip_head_id
+        AND rg.equip_amulet_id <=> tr.equip_amulet_id
+        AND rg.equip_torso_id <=> tr.equip_torso_id
+        AND rg.equip_legs_id <=> tr.equip_legs_id
+        AND rg.equip_boots_id <=> tr.equip_boots_id
+        AND rg.equip_cape_id <=> tr.equip_cape_id
+        AND rg.equip_hands_id <=> tr.equip_hands_id
+        AND rg.equip_weapon_id <=> tr.equip_weapon_id
+        AND rg.equip_shield_id <=> tr.equip_shield_id
+    GROUP BY
+        rs.report_sighting_id,
+        rl.report_location_id,
+        tr.reported_at,
+        tr.on_members_world,
+        tr.on_pvp_world,
+        tr.world_number,
+        tr.region_id
+    ;
+
+    DELETE FROM temp_report;
+END $$
+
+DELIMITER ;
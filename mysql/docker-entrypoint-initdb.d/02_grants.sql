@@ -7,9 +7,11 @@ GRANT SELECT, INSERT ON playerdata.report_sighting TO `report-worker`@`%`;
 GRANT SELECT, INSERT ON playerdata.report_gear TO `report-worker`@`%`;
 GRANT SELECT, INSERT ON playerdata.report_location TO `report-worker`@`%`;
 GRANT SELECT, INSERT ON playerdata.report TO `report-worker`@`%`;
+GRANT SELECT, INSERT, DELETE ON playerdata.report_batch_ledger TO `report-worker`@`%`;
 
 GRANT SELECT, INSERT, CREATE, DROP ON playerdata.temp_sighting TO `report-worker`@`%`;
 GRANT SELECT, INSERT, CREATE, DROP ON playerdata.temp_gear TO `report-worker`@`%`;
 GRANT SELECT, INSERT, CREATE, DROP ON playerdata.temp_location TO `report-worker`@`%`;
 GRANT SELECT, INSERT, CREATE, DROP ON playerdata.temp_report TO `report-worker`@`%`;
+GRANT EXECUTE ON PROCEDURE playerdata.normalize_temp_report TO `report-worker`@`%`;
 FLUSH PRIVILEGES;
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+
+from _batcher import Batcher
+from _pipeline import Stage
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Bounds:
+    min: int
+    max: int
+
+    def clamp(self, value: int) -> int:
+        return max(self.min, min(self.max, value))
+
+
+class AIMDController:
+    """
+    Additive increase, multiplicative decrease of the batch size and the number of
+    process tasks, toward a target insert transaction latency.
+
+    Every interval, with the mean insert latency since the previous step:
+    - over the target, both are cut by `decrease`, the database is the bottleneck
+    - insert queues at least half full, the process tasks are cut, they only
+      pile up batches
+    - under the target, the batch size grows by batch_step if batches were
+      flushed full, the process tasks grow by one if the consumer queue is
+      at least half full
+    """
+
+    def __init__(
+        self,
+        process_stage: Stage,
+        batchers: list[Batcher],
+        insert_stages: list[Stage],
+        insert_latency,
+        target_seconds: float,
+        batch_bounds: Bounds,
+        task_bounds: Bounds,
+        batch_step: int = 100,
+        decrease: float = 0.5,
+    ):
+        self.process_stage = process_stage
+        self.batchers = batchers
+        self.insert_stages = insert_stages
+        # returns the (sum, count) of all insert latencies so far
+        self.insert_latency = insert_latency
+        self.target_seconds = target_seconds
+        self.batch_bounds = batch_bounds
+        self.task_bounds = task_bounds
+        self.batch_step = batch_step
+        self.decrease = decrease
+
+        self.batch_size = batch_bounds.clamp(batchers[0].max_records)
+        self.tasks = task_bounds.clamp(process_stage.workers)
+        self.adjustments: int = 0
+        self._latency = insert_latency()
+        self._full_batches = self.full_batches()
+
+    def full_batches(self) -> int:
+        return sum(b.flush_reasons["records"] for b in self.batchers)
+
+    def fill(self, stages: list[Stage]) -> float:
+        """
+        Fraction of the bounded queues of the stages that is in use.
+        """
+        fills = [s.depth() / s.in_queue.maxsize for s in stages if s.in_queue.maxsize]
+        return max(fills, default=0)
+
+    def mean_latency(self) -> float | None:
+        total, count = self.insert_latency()
+        last_total, last_count = self._latency
+        self._latency = (total, count)
+        if count == last_count:
+            return None
+        return (total - last_total) / (count - last_count)
+
+    def step(self) -> None:
+        latency = self.mean_latency()
+        full_batches = self.full_batches()
+        new_full_batches = full_batches - self._full_batches
+        self._full_batches = full_batches
+        congestion = self.fill(self.insert_stages)
+        backlog = self.fill([self.process_stage])
+
+        batch_size, tasks, reasons = self.batch_size, self.tasks, []
+        if latency is not None and latency > self.target_seconds:
+            batch_size = int(batch_size * self.decrease)
+            tasks = int(tasks * self.decrease)
+            reasons.append("latency")
+        elif congestion >= 0.5:
+            tasks = int(tasks * self.decrease)
+            reasons.append("congestion")
+        else:
+            if latency is not None and new_full_batches:
+                batch_size += self.batch_step
+                reasons.append("headroom")
+            if backlog >= 0.5:
+                tasks += 1
+                reasons.append("backlog")
+
+        self.apply(
+            batch_size=self.batch_bounds.clamp(batch_size),
+            tasks=self.task_bounds.clamp(tasks),
+            reason=",".join(reasons),
+            latency=latency,
+            congestion=congestion,
+            backlog=backlog,
+        )
+
+    def apply(self, batch_size: int, tasks: int, reason: str, **observed) -> None:
+        if (batch_size, tasks) == (self.batch_size, self.tasks):
+            return
+        logger.info(
+            {
+                "adjust": reason,
+                "batch_size": [self.batch_size, batch_size],
+                "process_tasks": [self.tasks, tasks],
+                **{k: round(v, 3) for k, v in observed.items() if v is not None},
+            }
+        )
+        self.batch_size, self.tasks = batch_size, tasks
+        self.adjustments += 1
+        for batcher in self.batchers:
+            batcher.max_records = batch_size
+        self.process_stage.resize(tasks)
+
+    async def run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.step()
+            except Exception as e:
+                logger.error({"controller": "aimd", "error": e})
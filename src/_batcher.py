@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import sys
+import time
+from asyncio import Queue
+from collections import Counter
+from dataclasses import dataclass, field
+
+from _pipeline import Stage
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Batch:
+    items: list
+    # kafka offset of every item, committed once the batch is in the database
+    offsets: list
+    reason: str
+    # monotonic time at which the first item was added
+    started_at: float
+    # offsets of the duplicates that were dropped, done together with the batch
+    dropped_offsets: list = field(default_factory=list)
+
+
+def approx_size(item) -> int:
+    values = item.__dict__.values() if hasattr(item, "__dict__") else item
+    return sum(sys.getsizeof(v) for v in values)
+
+
+class Batcher(Stage):
+    """
+    Linger based batching, like kafka's linger.ms, a batch is flushed on the first
+    of max_records, max_bytes or max_age seconds since its first item.
+    The in_queue holds (offset, item) pairs.
+    With a key_fn, items whose key is already in the batch or in the seen filter
+    are dropped as duplicates.
+    """
+
+    def __init__(
+        self,
+        out_queue: Queue,
+        max_records: int,
+        max_bytes: int,
+        max_age: float,
+        size_fn=approx_size,
+        key_fn=None,
+        seen=None,
+        name: str = "batch",
+        in_queue: Queue = None,
+        maxsize: int = 0,
+    ):
+        super().__init__(name=name, in_queue=in_queue, maxsize=maxsize)
+        self.out_queue = out_queue
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.size_fn = size_fn
+        self.key_fn = key_fn
+        # keys of earlier batches, e.g. a WindowedBloomFilter
+        self.seen = seen
+
+        self.items: list = []
+        self.offsets: list = []
+        self.keys: set = set()
+        self.dropped_offsets: list = []
+        self.nbytes: int = 0
+        self.started_at: float = None
+
+        self.flush_reasons = Counter()
+        self.flushed_items: int = 0
+        # dropped duplicates, by where the key was found
+        self.duplicates = Counter()
+
+    async def flush(self, reason: str) -> None:
+        if self.started_at is None:
+            return
+        batch = Batch(
+            items=self.items,
+            offsets=self.offsets,
+            reason=reason,
+            started_at=self.started_at,
+            dropped_offsets=self.dropped_offsets,
+        )
+        self.items, self.offsets, self.nbytes, self.started_at = [], [], 0, None
+        self.keys, self.dropped_offsets = set(), []
+
+        self.flush_reasons[reason] += 1
+        self.flushed_items += len(batch.items)
+        logger.debug(
+            {
+                "batch_size": len(batch.items),
+                "duplicates": len(batch.dropped_offsets),
+                "reason": reason,
+                "age": round(time.monotonic() - batch.started_at, 3),
+            }
+        )
+        await self.out_queue.put(batch)
+
+    async def drain(self) -> None:
+        """
+        Flush the partial batch once the items of the in_queue are added.
+        """
+        await self.in_queue.join()
+        await self.flush(reason="shutdown")
+
+    def add(self, item, offset=None) -> str | None:
+        """
+        Add an item, returns the flush reason if the batch is full.
+        """
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+
+        if self.key_fn is not None:
+            key = self.key_fn(item)
+            if key in self.keys:
+                self.duplicates["batch"] += 1
+                self.dropped_offsets.append(offset)
+                return None
+            if self.seen is not None and key in self.seen:
+                self.duplicates["window"] += 1
+                self.dropped_offsets.append(offset)
+                return None
+            self.keys.add(key)
+
+        self.items.append(item)
+        self.offsets.append(offset)
+        self.nbytes += self.size_fn(item)
+
+        if len(self.items) >= self.max_records:
+            return "records"
+        if self.nbytes >= self.max_bytes:
+            return "bytes"
+        return None
+
+    async def run(self, index: int = 0):
+        while True:
+            if self.started_at is None:
+                offset, item = await self.in_queue.get()
+            else:
+                remaining = self.max_age - (time.monotonic() - self.started_at)
+                try:
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    offset, item = await asyncio.wait_for(
+                        self.in_queue.get(), remaining
+                    )
+                except asyncio.TimeoutError:
+                    await self.flush(reason="age")
+                    continue
+
+            self.in_queue.task_done()
+
+            reason = self.add(item, offset=offset)
+            if reason is not None:
+                await self.flush(reason=reason)
@@ -1,6 +1,8 @@
 import asyncio
 import logging
-from collections import OrderedDict
+import sys
+import time
+from collections import Counter, OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +14,9 @@ class SimpleALRUCache:
         self.lock = asyncio.Lock()
         self.hits: int = 0
         self.misses: int = 0
+        # read only fallback for misses, e.g. a SnapshotView
+        self.backing = None
+        self.backing_hits: int = 0
 
     async def get(self, key):
         async with self.lock:
@@ -20,8 +25,13 @@ class SimpleALRUCache:
                 self.cache.move_to_end(key)
                 self.hits += 1
                 return self.cache[key]
+        value = self.backing.get(key) if self.backing is not None else None
+        if value is None:
             self.misses += 1
             return None
+        self.backing_hits += 1
+        await self.put(key, value)
+        return value
 
     async def put(self, key, value):
         async with self.lock:
@@ -40,6 +50,170 @@ class SimpleALRUCache:
             self.cache.clear()
 
 
+class DimensionCaches:
+    """
+    Maps the natural key of each report dimension to its surrogate id.
+    """
+
+    def __init__(self, max_size=100_000):
+        self.sighting = SimpleALRUCache(max_size=max_size)
+        self.gear = SimpleALRUCache(max_size=max_size)
+        self.location = SimpleALRUCache(max_size=max_size)
+
+    def items(self) -> list[tuple[str, SimpleALRUCache]]:
+        return [
+            ("sighting", self.sighting),
+            ("gear", self.gear),
+            ("location", self.location),
+        ]
+
+    def stats(self) -> dict:
+        stats = {}
+        for name, cache in self.items():
+            hits = cache.hits + cache.backing_hits
+            lookups = hits + cache.misses
+            stats[name] = {
+                "hits": cache.hits,
+                "misses": cache.misses,
+                "snapshot_hits": cache.backing_hits,
+                "hit_ratio": round(hits / lookups, 4) if lookups else None,
+                "size": len(cache.cache),
+            }
+        return stats
+
+
+class Negative:
+    """
+    Cached absence of a key, returned by TTLCache.get for negative entries.
+    """
+
+    def __repr__(self) -> str:
+        return "NEGATIVE"
+
+
+NEGATIVE = Negative()
+
+
+def approx_size(key, value) -> int:
+    size = sys.getsizeof(key) + sys.getsizeof(value)
+    if hasattr(value, "__dict__"):
+        size += sum(sys.getsizeof(v) for v in value.__dict__.values())
+    return size
+
+
+class TTLCache:
+    """
+    LRU cache bounded by approximate memory, entries expire after ttl seconds
+    and negative entries after negative_ttl seconds.
+    get & put never await, so on a single event loop no lock is needed.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = None,
+        negative_ttl: float = 60,
+        size_fn=approx_size,
+    ):
+        # key: (value, expires_at, nbytes)
+        self.cache: OrderedDict = OrderedDict()
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size_fn = size_fn
+        self.nbytes: int = 0
+        self.counters = Counter()
+        # read only fallback for misses, e.g. a SnapshotView, its get returns
+        # (value, expires_at as unix time or None) or None
+        self.backing = None
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def get(self, key, default=None):
+        """
+        Returns the value, NEGATIVE for a cached absence or default on a miss.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return self._get_backing(key, default)
+
+        value, expires_at, _ = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._remove(key)
+            self.counters["expirations"] += 1
+            self.counters["misses"] += 1
+            return default
+
+        self.cache.move_to_end(key)
+        self.counters["negative_hits" if value is NEGATIVE else "hits"] += 1
+        return value
+
+    def _get_backing(self, key, default):
+        entry = self.backing.get(key) if self.backing is not None else None
+        if entry is None:
+            self.counters["misses"] += 1
+            return default
+
+        value, expires_at = entry
+        ttl = None if expires_at is None else expires_at - time.time()
+        if ttl is not None and ttl <= 0:
+            self.counters["misses"] += 1
+            return default
+
+        self.counters["snapshot_hits"] += 1
+        self.put(key, value, ttl=ttl)
+        return value
+
+    def put(self, key, value, ttl: float = None) -> None:
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        nbytes = self.size_fn(key, value)
+
+        if key in self.cache:
+            self._remove(key)
+        self.cache[key] = (value, expires_at, nbytes)
+        self.nbytes += nbytes
+
+        while self.nbytes > self.max_bytes and len(self.cache) > 1:
+            self._remove(next(iter(self.cache)))
+            self.counters["evictions"] += 1
+
+    def put_negative(self, key) -> None:
+        self.put(key, NEGATIVE, ttl=self.negative_ttl)
+
+    def _remove(self, key) -> None:
+        _, _, nbytes = self.cache.pop(key)
+        self.nbytes -= nbytes
+
+    def clear(self) -> None:
+        self.cache.clear()
+        self.nbytes = 0
+
+    def items(self) -> list[tuple]:
+        """
+        (key, value, expires_at as unix time or None) of the live entries,
+        negative entries are left out.
+        """
+        now, wall = time.monotonic(), time.time()
+        return [
+            (key, value, None if expires_at is None else wall + expires_at - now)
+            for key, (value, expires_at, _) in self.cache.items()
+            if value is not NEGATIVE and (expires_at is None or expires_at > now)
+        ]
+
+    def stats(self) -> dict:
+        hits = self.counters["hits"] + self.counters["negative_hits"]
+        hits += self.counters["snapshot_hits"]
+        lookups = hits + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_ratio": round(hits / lookups, 4) if lookups else None,
+            "size": len(self.cache),
+            "nbytes": self.nbytes,
+        }
+
+
 # Example usage
 async def main():
     cache = SimpleALRUCache(max_size=3)
@@ -0,0 +1,96 @@
+import hashlib
+import math
+import time
+
+
+class BloomFilter:
+    """
+    Bloom filter sized for capacity keys at fp_rate, the k bit positions are
+    derived from one blake2b digest with double hashing.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.bits_set: int = 0
+        self.count: int = 0
+
+    def _positions(self, key) -> list[int]:
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key) -> None:
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                self.bits_set += 1
+        self.count += 1
+
+    def __contains__(self, key) -> bool:
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                return False
+        return True
+
+    def fp_rate(self) -> float:
+        """
+        Estimated false positive rate from the fraction of bits that are set.
+        """
+        return (self.bits_set / self.size) ** self.hashes
+
+
+class WindowedBloomFilter:
+    """
+    Remembers keys for between window and 2 * window seconds, keys are added to
+    the current filter and looked up in the current and previous one, every
+    window seconds the previous filter is dropped.
+    """
+
+    def __init__(self, window: float, capacity: int, fp_rate: float):
+        self.window = window
+        self.capacity = capacity
+        self.target_fp_rate = fp_rate
+        self.current = BloomFilter(capacity, fp_rate)
+        self.previous: BloomFilter = None
+        self.rotated_at = time.monotonic()
+        self.rotations: int = 0
+
+    def rotate(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.rotated_at
+        if elapsed < self.window:
+            return
+        # the current filter is older than the window once it has not been rotated
+        self.previous = self.current if elapsed < 2 * self.window else None
+        self.current = BloomFilter(self.capacity, self.target_fp_rate)
+        self.rotated_at = now
+        self.rotations += 1
+
+    def add(self, key) -> None:
+        self.rotate()
+        self.current.add(key)
+
+    def __contains__(self, key) -> bool:
+        self.rotate()
+        if key in self.current:
+            return True
+        return self.previous is not None and key in self.previous
+
+    def fp_rate(self) -> float:
+        rate = 1 - self.current.fp_rate()
+        if self.previous is not None:
+            rate *= 1 - self.previous.fp_rate()
+        return 1 - rate
+
+    def stats(self) -> dict:
+        return {
+            "keys": self.current.count + (self.previous.count if self.previous else 0),
+            "fp_rate": round(self.fp_rate(), 6),
+            "rotations": self.rotations,
+        }
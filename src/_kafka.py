@@ -1,14 +1,249 @@
+import asyncio
+import json
+import logging
+import time
+
+from aiokafka import (
+    AIOKafkaConsumer,
+    AIOKafkaProducer,
+    ConsumerRebalanceListener,
+    TopicPartition,
+)
+from aiokafka.errors import CommitFailedError, KafkaError
 from AioKafkaEngine import ConsumerEngine, ProducerEngine
 
+from _offsets import CommittedOffsets, OffsetTracker
 from core.config import settings
 
-consumer = ConsumerEngine(
+logger = logging.getLogger(__name__)
+
+
+class ReportConsumer(ConsumerEngine):
+    """
+    ConsumerEngine that puts the full ConsumerRecord on the queue and does not
+    auto commit, offsets are committed once the OffsetTracker marks them done.
+    Fetching is paused while high_watermark or more offsets are in flight, and
+    resumed at low_watermark, the group heartbeats go on while paused.
+    """
+
+    def __init__(
+        self, *args, high_watermark: int = 0, low_watermark: int = 0, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.tracker = OffsetTracker()
+        self.ledger = CommittedOffsets()
+        # async callbacks, called with the newly assigned partitions
+        self.on_assign: list = []
+
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.paused_at: float = None
+        self.pauses: int = 0
+        # of the pauses that ended
+        self.paused_seconds: float = 0
+        self.draining = False
+
+    def check_backpressure(self) -> None:
+        if not self.high_watermark or self.consumer is None:
+            return
+        # paused for good
+        if self.draining:
+            return
+        in_flight = self.tracker.in_flight()
+        if self.paused_at is None and in_flight >= self.high_watermark:
+            self.consumer.pause(*self.consumer.assignment())
+            self.paused_at = time.monotonic()
+            self.pauses += 1
+            logger.warning({"consumer": "paused", "in_flight": in_flight})
+        elif self.paused_at is not None and in_flight <= self.low_watermark:
+            self.consumer.resume(*self.consumer.paused())
+            duration = time.monotonic() - self.paused_at
+            self.paused_at = None
+            self.paused_seconds += duration
+            logger.info(
+                {
+                    "consumer": "resumed",
+                    "in_flight": in_flight,
+                    "paused_seconds": round(duration, 3),
+                }
+            )
+
+    def stop_consuming(self) -> None:
+        """
+        Pause all partitions until stop_engine, the consumer stays in the group
+        so the offsets of the records in flight can still be committed.
+        """
+        self.draining = True
+        if self.consumer is not None:
+            self.consumer.pause(*self.consumer.assignment())
+
+    def paused_duration(self) -> float:
+        """
+        Seconds spent paused, including the current pause.
+        """
+        if self.paused_at is None:
+            return self.paused_seconds
+        return self.paused_seconds + time.monotonic() - self.paused_at
+
+    async def watch_backpressure(self, interval: float = 0.1) -> None:
+        # the consume loop does not run while everything is paused
+        while True:
+            self.check_backpressure()
+            await asyncio.sleep(interval)
+
+    def lag(self) -> dict[TopicPartition, int]:
+        """
+        Records of every consumed partition after the lowest offset that is not
+        done, up to the highwater of the last fetch.
+        """
+        lag = {}
+        if self.consumer is None:
+            return lag
+        for tp in self.consumer.assignment():
+            highwater = self.consumer.highwater(tp)
+            offset = self.tracker.next_offset(tp)
+            if highwater is not None and offset is not None:
+                lag[tp] = max(0, highwater - offset)
+        return lag
+
+    async def consume_messages(self, topics):
+        self.consumer = AIOKafkaConsumer(
+            bootstrap_servers=self.bootstrap_servers,
+            # with a decode pool the raw value is deserialized on the pool
+            value_deserializer=(
+                None
+                if settings.DECODE_EXECUTOR
+                else lambda x: json.loads(x.decode("utf-8"))
+            ),
+            group_id=self.group_id,
+            auto_offset_reset="earliest",
+            enable_auto_commit=False,
+        )
+        self.consumer.subscribe(topics=topics, listener=RebalanceListener(self))
+        await self.consumer.start()
+        watcher = asyncio.create_task(self.watch_backpressure())
+        try:
+            async for msg in self.consumer:
+                self.tracker.track(TopicPartition(msg.topic, msg.partition), msg.offset)
+                await self.receive_queue.put(msg)
+                self.consume_counter += 1
+                self.check_backpressure()
+                if self.stop_event.is_set():
+                    break
+        finally:
+            watcher.cancel()
+            await self.consumer.stop()
+
+    async def commit(self) -> None:
+        offsets = self.tracker.committable()
+        if not offsets or self.consumer is None:
+            return
+        try:
+            await self.consumer.commit(offsets)
+        except CommitFailedError as e:
+            # the group rebalanced, the new owner continues from the last commit
+            logger.warning({"error": e, "offsets": offsets})
+            return
+        self.tracker.committed(offsets)
+
+
+class RebalanceListener(ConsumerRebalanceListener):
+    def __init__(self, engine: ReportConsumer):
+        self.engine = engine
+
+    async def on_partitions_revoked(self, revoked):
+        await self.engine.commit()
+        self.engine.tracker.forget(revoked)
+        self.engine.ledger.forget(revoked)
+
+    async def on_partitions_assigned(self, assigned):
+        if self.engine.paused_at is not None or self.engine.draining:
+            self.engine.consumer.pause(*assigned)
+        for callback in self.engine.on_assign:
+            await callback(assigned)
+
+
+class ReportProducer(ProducerEngine):
+    """
+    ProducerEngine whose queue holds (value, future), the future is resolved
+    once the broker acknowledged the message, or set to the error.
+    """
+
+    async def send(self, value: dict) -> asyncio.Future:
+        delivered = asyncio.get_running_loop().create_future()
+        await self.send_queue.put((value, delivered))
+        return delivered
+
+    async def send_and_wait(self, values: list[dict]) -> None:
+        futures = [await self.send(value) for value in values]
+        await asyncio.gather(*futures)
+
+    async def produce_messages(self, topic):
+        self.producer = AIOKafkaProducer(
+            bootstrap_servers=self.bootstrap_servers,
+            value_serializer=lambda v: json.dumps(v).encode(),
+            acks="all",
+        )
+        await self.producer.start()
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    value, delivered = await asyncio.wait_for(
+                        self.send_queue.get(), timeout=1
+                    )
+                except TimeoutError:
+                    continue
+                try:
+                    ack = await self.producer.send(topic=topic, value=value)
+                except Exception as e:
+                    if not delivered.done():
+                        delivered.set_exception(e)
+                    continue
+                ack.add_done_callback(lambda f, d=delivered: resolve(d, f))
+                self.produce_counter += 1
+        finally:
+            self.fail_pending(KafkaError("producer stopped"))
+            await self.producer.stop()
+
+    def fail_pending(self, error: Exception) -> None:
+        # nobody sends the messages left on the queue
+        while not self.send_queue.empty():
+            _, delivered = self.send_queue.get_nowait()
+            if not delivered.done():
+                delivered.set_exception(error)
+
+    async def stop_engine(self):
+        await super().stop_engine()
+        self.fail_pending(KafkaError("producer stopped"))
+
+
+def resolve(delivered: asyncio.Future, ack: asyncio.Future) -> None:
+    if delivered.done():
+        return
+    if ack.cancelled():
+        delivered.set_exception(KafkaError("send cancelled"))
+    elif ack.exception() is not None:
+        delivered.set_exception(ack.exception())
+    else:
+        delivered.set_result(ack.result())
+
+
+consumer = ReportConsumer(
     bootstrap_servers=[settings.KAFKA_HOST],
     group_id="report-worker",
     queue_size=500,
     report_interval=60,
+    high_watermark=settings.BACKPRESSURE_HIGH,
+    low_watermark=settings.BACKPRESSURE_LOW,
+)
+# reports that failed on a transient error, consumed again after a delay
+retry_producer = ReportProducer(
+    bootstrap_servers=[settings.KAFKA_HOST],
+    report_interval=60,
+    queue_size=500,
 )
-producer = ProducerEngine(
+# reports that can not be inserted, with the error attached
+dlq_producer = ReportProducer(
     bootstrap_servers=[settings.KAFKA_HOST],
     report_interval=60,
     queue_size=500,
@@ -0,0 +1,64 @@
+import logging
+from asyncio import Queue
+from collections import Counter
+
+from aiokafka import ConsumerRecord
+
+from _pipeline import Stage
+
+logger = logging.getLogger(__name__)
+
+
+def partition_key(record: ConsumerRecord):
+    return record.partition
+
+
+def reporter_key(record: ConsumerRecord):
+    value = record.value
+    if isinstance(value, dict):
+        reporter = value.get("reporter_id", value.get("reporter"))
+        if reporter is not None:
+            return reporter
+    # raw values that are decoded on a pool, or messages without a reporter
+    return record.partition
+
+
+LANE_KEYS = {"partition": partition_key, "reporter": reporter_key}
+
+
+class Router(Stage):
+    """
+    Routes consumer records to the lane of their key, a lane handles the records
+    of a key in order, so a slow lane does not hold up the others.
+    A single task, more would reorder the records of a key.
+    """
+
+    def __init__(
+        self,
+        lanes: list[Queue],
+        key_fn=partition_key,
+        name: str = "route",
+        in_queue: Queue = None,
+        maxsize: int = 0,
+    ):
+        super().__init__(name=name, in_queue=in_queue, maxsize=maxsize)
+        self.lanes = lanes
+        self.key_fn = key_fn
+        # routed records per lane
+        self.routed = Counter()
+
+    def lane(self, key) -> int:
+        return hash(key) % len(self.lanes)
+
+    async def run(self, index: int = 0):
+        while index < self.workers:
+            record = await self.in_queue.get()
+            self.in_queue.task_done()
+            try:
+                lane = self.lane(self.key_fn(record))
+            except Exception as e:
+                logger.error({"stage": self.name, "error": e})
+                lane = self.lane(record.partition)
+            self.routed[lane] += 1
+            await self.lanes[lane].put(record)
+        self.tasks.pop(index, None)
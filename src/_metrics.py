@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import math
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[n] for n in self.labels)
+
+    @abstractmethod
+    def samples(self) -> list[str]: ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [
+            f"{self.name}{format_labels(self.labels, k)} {format_value(v)}"
+            for k, v in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels: (bucket counts, sum, count)
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts, _, _ = entry = self.values[key]
+        i = bisect_left(self.buckets, value)
+        if i < len(counts):
+            counts[i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = f'le="{format_value(float(bound))}"'
+                labels = format_labels(self.labels, key, le)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Collected(Counter):
+    """
+    Values read at scrape time, fn returns {label values: value}, for state
+    that is already counted elsewhere, e.g. queue sizes or a collections.Counter.
+    """
+
+    def __init__(self, name: str, help: str, type: str, fn, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.type = type
+        self.fn = fn
+
+    def samples(self) -> list[str]:
+        try:
+            self.values = {
+                k if isinstance(k, tuple) else (k,): v
+                for k, v in self.fn().items()
+                if v is not None
+            }
+        except Exception as e:
+            logger.error({"metric": self.name, "error": e})
+            self.values = {}
+        return super().samples()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(
+        self, name: str, help: str, buckets: tuple, labels: tuple = ()
+    ) -> Histogram:
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def collect(
+        self, name: str, help: str, type: str, fn, labels: tuple = ()
+    ) -> Collected:
+        return self.register(Collected(name, help, type, fn, labels))
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+
+async def render_registry() -> str:
+    return registry.render()
+
+
+async def handle_scrape(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, render
+):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+        if path.split(b"?")[0] == b"/metrics":
+            status = "200 OK"
+            body = (await render()).encode()
+        else:
+            status = "404 Not Found"
+            body = b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (
+        asyncio.TimeoutError,
+        asyncio.IncompleteReadError,
+        asyncio.LimitOverrunError,
+        ConnectionError,
+    ):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(
+    port: int, host: str = "0.0.0.0", render=render_registry
+) -> asyncio.Server:
+    """
+    render is an async callable returning the text to serve, the global registry
+    by default.
+    """
+    server = await asyncio.start_server(
+        partial(handle_scrape, render=render), host, port
+    )
+    logger.info(f"serving metrics on {host}:{port}/metrics")
+    return server
+
+
+async def scrape(host: str, port: int, timeout: float = 5) -> str:
+    """
+    GET /metrics of another process, e.g. a worker of the supervisor.
+    """
+    async with asyncio.timeout(timeout):
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(f"GET /metrics HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+            response = await reader.read()
+        finally:
+            writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    if not head.startswith(b"HTTP/1.1 200"):
+        raise ConnectionError(head.split(b"\r\n")[0].decode())
+    return body.decode()
+
+
+def merge(texts: dict[str, str], label: str) -> str:
+    """
+    Merge the text format of several processes into one, the samples of each
+    process get label=key, HELP & TYPE are written once per metric.
+    """
+    # name: (HELP & TYPE lines, samples)
+    families: dict[str, tuple[list[str], list[str]]] = {}
+    for value, text in texts.items():
+        extra = f'{label}="{escape(value)}"'
+        name = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    name = parts[2]
+                    header, _ = families.setdefault(name, ([], []))
+                    if len(header) < 2 and line not in header:
+                        header.append(line)
+                continue
+            sample, _, number = line.rpartition(" ")
+            if "{" in sample:
+                sample = sample[:-1] + "," + extra + "}"
+            else:
+                sample = sample + "{" + extra + "}"
+            families.setdefault(name or sample, ([], []))[1].append(
+                f"{sample} {number}"
+            )
+    lines = [line for header, samples in families.values() for line in header + samples]
+    return "\n".join(lines) + "\n" if lines else ""
@@ -0,0 +1,154 @@
+import hashlib
+import heapq
+from bisect import bisect_right
+
+from aiokafka import TopicPartition
+
+# a consumed record, (TopicPartition, offset)
+Offset = tuple[TopicPartition, int]
+
+
+def to_ranges(offsets: list[int]) -> list[tuple[int, int]]:
+    """
+    Collapse offsets into sorted, inclusive (start, end) ranges.
+    """
+    ranges = []
+    for offset in sorted(set(offsets)):
+        if ranges and ranges[-1][1] == offset - 1:
+            ranges[-1] = (ranges[-1][0], offset)
+        else:
+            ranges.append((offset, offset))
+    return ranges
+
+
+def format_ranges(ranges: list[tuple[int, int]]) -> str:
+    return ",".join(f"{start}-{end}" for start, end in ranges)
+
+
+def parse_ranges(text: str) -> list[tuple[int, int]]:
+    ranges = []
+    for part in text.split(","):
+        start, end = part.split("-")
+        ranges.append((int(start), int(end)))
+    return ranges
+
+
+def group_by_partition(offsets: list[Offset]) -> dict[TopicPartition, list[int]]:
+    grouped: dict[TopicPartition, list[int]] = {}
+    for tp, offset in offsets:
+        grouped.setdefault(tp, []).append(offset)
+    return grouped
+
+
+def fingerprint(offsets: list[Offset]) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    for tp, ranges in sorted(
+        (tp, to_ranges(o)) for tp, o in group_by_partition(offsets).items()
+    ):
+        digest.update(f"{tp.topic}:{tp.partition}:{ranges};".encode())
+    return digest.digest()
+
+
+class OffsetTracker:
+    """
+    Tracks consumed offsets per partition, a partition can be committed up to
+    its lowest offset that is not done, so nothing in flight is skipped on restart.
+    """
+
+    def __init__(self):
+        self.pending: dict[TopicPartition, list[int]] = {}
+        # the offsets in the pending heap of a partition
+        self.tracked: dict[TopicPartition, set[int]] = {}
+        self.finished: dict[TopicPartition, set[int]] = {}
+        # next offset after the highest tracked offset
+        self.position: dict[TopicPartition, int] = {}
+        self.last_committed: dict[TopicPartition, int] = {}
+        # retry attempt of in flight records that came from the retry topic
+        self.attempts: dict[Offset, int] = {}
+
+    def track(self, tp: TopicPartition, offset: int) -> None:
+        tracked = self.tracked.setdefault(tp, set())
+        if offset not in tracked:
+            tracked.add(offset)
+            heapq.heappush(self.pending.setdefault(tp, []), offset)
+        self.position[tp] = offset + 1
+
+    def done(self, offsets: list[Offset]) -> None:
+        for tp, offset in offsets:
+            # the partition may have been revoked, and re-assigned, in the meantime,
+            # an offset of the old assignment only counts if it was consumed again
+            if offset in self.tracked.get(tp, ()):
+                self.finished.setdefault(tp, set()).add(offset)
+            self.attempts.pop((tp, offset), None)
+
+    def attempt(self, offset: Offset) -> int:
+        return self.attempts.get(offset, 0)
+
+    def next_offset(self, tp: TopicPartition) -> int | None:
+        """
+        The lowest offset of the partition that is not done, or the position.
+        """
+        heap = self.pending.get(tp)
+        if heap is None:
+            return None
+        finished = self.finished.get(tp, set())
+        tracked = self.tracked[tp]
+        while heap and heap[0] in finished:
+            offset = heapq.heappop(heap)
+            finished.discard(offset)
+            tracked.discard(offset)
+        return heap[0] if heap else self.position[tp]
+
+    def committable(self) -> dict[TopicPartition, int]:
+        offsets = {}
+        for tp in self.pending:
+            offset = self.next_offset(tp)
+            if offset > self.last_committed.get(tp, -1):
+                offsets[tp] = offset
+        return offsets
+
+    def committed(self, offsets: dict[TopicPartition, int]) -> None:
+        self.last_committed.update(offsets)
+
+    def forget(self, tps: list[TopicPartition]) -> None:
+        for tp in tps:
+            self.pending.pop(tp, None)
+            self.tracked.pop(tp, None)
+            self.finished.pop(tp, None)
+            self.position.pop(tp, None)
+            self.last_committed.pop(tp, None)
+        self.attempts = {o: a for o, a in self.attempts.items() if o[0] not in tps}
+
+    def in_flight(self) -> int:
+        return sum(
+            len(heap) - len(self.finished.get(tp, ()))
+            for tp, heap in self.pending.items()
+        )
+
+
+class CommittedOffsets:
+    """
+    Offset ranges the ledger says are already in the database, used to skip
+    records that are replayed after a restart.
+    """
+
+    def __init__(self):
+        self.starts: dict[TopicPartition, list[int]] = {}
+        self.ends: dict[TopicPartition, list[int]] = {}
+
+    def load(self, tp: TopicPartition, ranges: list[tuple[int, int]]) -> None:
+        ranges = sorted(ranges)
+        self.starts[tp] = [start for start, _ in ranges]
+        self.ends[tp] = [end for _, end in ranges]
+
+    def forget(self, tps: list[TopicPartition]) -> None:
+        for tp in tps:
+            self.starts.pop(tp, None)
+            self.ends.pop(tp, None)
+
+    def contains(self, tp: TopicPartition, offset: int) -> bool:
+        starts = self.starts.get(tp)
+        if not starts:
+            return False
+        i = bisect_right(starts, offset) - 1
+        return i >= 0 and offset <= self.ends[tp][i]
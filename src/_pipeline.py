@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import traceback
+from asyncio import Queue
+from concurrent.futures import Executor
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """
+    A pipeline stage, `workers` tasks wait on the bounded in_queue and call
+    handler with up to max_items items that are ready.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler=None,
+        in_queue: Queue = None,
+        maxsize: int = 0,
+        workers: int = 1,
+        max_items: int = 1,
+    ):
+        self.name = name
+        self.handler = handler
+        self.in_queue = in_queue if in_queue is not None else Queue(maxsize=maxsize)
+        self.workers = workers
+        self.max_items = max_items
+        self.tasks: dict[int, asyncio.Task] = {}
+
+    def depth(self) -> int:
+        return self.in_queue.qsize()
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            if i not in self.tasks or self.tasks[i].done():
+                self.tasks[i] = asyncio.create_task(
+                    self.run(i), name=f"{self.name}-{i}"
+                )
+
+    def resize(self, workers: int) -> None:
+        """
+        Start missing workers, extra workers exit after the items they hold.
+        """
+        self.workers = workers
+        self.start()
+
+    async def stop(self) -> None:
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = {}
+
+    async def drain(self) -> None:
+        await self.in_queue.join()
+
+    async def get_items(self) -> list:
+        items = [await self.in_queue.get()]
+        while len(items) < self.max_items and not self.in_queue.empty():
+            items.append(self.in_queue.get_nowait())
+        return items
+
+    async def run(self, index: int = 0):
+        while index < self.workers:
+            items = await self.get_items()
+            try:
+                await self.handler(items)
+            except Exception as e:
+                logger.error({"stage": self.name, "error": e})
+                logger.debug(f"Traceback: \n{traceback.format_exc()}")
+            finally:
+                for _ in items:
+                    self.in_queue.task_done()
+        self.tasks.pop(index, None)
+
+
+class OffloadPool:
+    """
+    Runs blocking calls on an executor, calls beyond the number of workers wait
+    in the queue of the executor.
+    """
+
+    def __init__(self, name: str, executor: Executor, workers: int):
+        self.name = name
+        self.executor = executor
+        self.workers = workers
+        # submitted calls that did not finish
+        self.pending: int = 0
+
+    def depth(self) -> int:
+        return max(0, self.pending - self.workers)
+
+    def busy(self) -> int:
+        return min(self.pending, self.workers)
+
+    async def run(self, fn, *args):
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Pipeline:
+    def __init__(self, stages: list[Stage], pools: list[OffloadPool] = ()):
+        self.stages = stages
+        self.pools = list(pools)
+
+    def start(self) -> None:
+        for stage in self.stages:
+            stage.start()
+
+    async def drain(self) -> None:
+        """
+        Wait for every stage to finish its items, in order, so nothing may be put
+        on the first stage meanwhile.
+        """
+        for stage in self.stages:
+            await stage.drain()
+
+    async def stop(self) -> None:
+        for stage in self.stages:
+            await stage.stop()
+        for pool in self.pools:
+            pool.shutdown()
+
+    def depths(self) -> dict[str, int]:
+        return {
+            **{stage.name: stage.depth() for stage in self.stages},
+            **{pool.name: pool.depth() for pool in self.pools},
+        }
+
+    def busy(self) -> dict[str, int]:
+        return {pool.name: pool.busy() for pool in self.pools}
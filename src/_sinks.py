@@ -0,0 +1,243 @@
+import asyncio
+import importlib.util
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+
+from _metrics import registry
+from app.controllers.report import ReportController
+from app.views.report import ReportRow
+
+logger = logging.getLogger(__name__)
+
+sink_reports = registry.counter(
+    "report_worker_sink_reports_total", "Reports written by a sink", labels=("sink",)
+)
+sink_errors = registry.counter(
+    "report_worker_sink_errors_total",
+    "Batches a sink failed to write after the insert committed",
+    labels=("sink",),
+)
+archive_files = registry.counter(
+    "report_worker_archive_files_total", "Closed archive files", labels=("reason",)
+)
+
+# ReportRow fields that are not int64 columns in the archive
+ARCHIVE_TYPES = {
+    "timestamp": "timestamp",
+    "manual_detect": "bool",
+    "on_pvp_world": "bool",
+}
+
+
+class Sink(ABC):
+    """
+    Destination of the inserted batches. Transactional sinks write with the
+    ReportController of the insert transaction, so a batch is in all of them
+    or in none, the others get the batch once the transaction committed.
+    """
+
+    name: str = "sink"
+    transactional: bool = True
+
+    @abstractmethod
+    async def write(
+        self, reports: list[ReportRow], controller: ReportController = None
+    ) -> None: ...
+
+    async def close(self) -> None:
+        pass
+
+
+class NormalizedSink(Sink):
+    """
+    report, with its report_sighting, report_gear & report_location ids.
+    """
+
+    name = "normalized"
+
+    def __init__(
+        self,
+        insert_mode: str = "cached",
+        load_data_min_rows: int = 0,
+        load_data_dir: str = None,
+    ):
+        self.insert_mode = insert_mode
+        self.load_data_min_rows = load_data_min_rows
+        self.load_data_dir = load_data_dir
+
+    async def write(
+        self, reports: list[ReportRow], controller: ReportController = None
+    ) -> None:
+        if self.insert_mode == "procedure":
+            await controller.insert_report_temp_table(
+                reports=reports,
+                load_data=0 < self.load_data_min_rows <= len(reports),
+                load_data_dir=self.load_data_dir,
+            )
+        else:
+            await controller.insert_report(reports=reports)
+
+
+class StagingSink(Sink):
+    """
+    The legacy stgReports table.
+    """
+
+    name = "staging"
+
+    async def write(
+        self, reports: list[ReportRow], controller: ReportController = None
+    ) -> None:
+        await controller.insert(reports=reports)
+
+
+class ParquetWriter:
+    """
+    Writes every batch as a row group of a parquet file.
+    """
+
+    def __init__(self, path: str, compression: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        types = {"timestamp": pa.timestamp("s"), "bool": pa.bool_()}
+        self.pa = pa
+        self.schema = pa.schema(
+            [
+                (field, types.get(ARCHIVE_TYPES.get(field), pa.int64()))
+                for field in ReportRow._fields
+            ]
+        )
+        self.writer = pq.ParquetWriter(path, self.schema, compression=compression)
+
+    def write(self, reports: list[ReportRow]) -> None:
+        columns = zip(*reports)
+        arrays = [
+            self.pa.array(column, type=field.type)
+            for column, field in zip(columns, self.schema)
+        ]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class ArchiveSink(Sink):
+    """
+    Appends the committed batches to compressed columnar files in directory,
+    a file is closed once it reached max_bytes or is max_age seconds old.
+    Open files end in .tmp and are renamed when closed, so readers only see
+    complete files. pyarrow is only imported when the first file is opened.
+    """
+
+    name = "archive"
+    transactional = False
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        max_age: float,
+        compression: str = "zstd",
+        open_writer=None,
+    ):
+        if open_writer is None:
+            if importlib.util.find_spec("pyarrow") is None:
+                raise ImportError("the archive sink needs pyarrow")
+            open_writer = ParquetWriter
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compression = compression
+        # called with (path, compression), returns an object with write & close
+        self.open_writer = open_writer
+        self.lock = asyncio.Lock()
+
+        self.writer = None
+        self.path: str = None
+        self.opened_at: float = None
+        self.rows: int = 0
+        self.sequence: int = 0
+
+    def open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        now = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        self.sequence += 1
+        name = f"reports-{now}-{os.getpid()}-{self.sequence}.parquet"
+        self.path = os.path.join(self.directory, name)
+        self.writer = self.open_writer(self.path + ".tmp", self.compression)
+        self.opened_at = time.monotonic()
+        self.rows = 0
+
+    def rotate(self, reason: str) -> None:
+        if self.writer is None:
+            return
+        self.writer.close()
+        os.replace(self.path + ".tmp", self.path)
+        archive_files.inc(reason=reason)
+        logger.info({"archive": self.path, "rows": self.rows, "reason": reason})
+        self.writer, self.path, self.opened_at = None, None, None
+
+    def due(self) -> str | None:
+        """
+        The reason to close the open file, if any.
+        """
+        if self.writer is None:
+            return None
+        if os.path.getsize(self.path + ".tmp") >= self.max_bytes:
+            return "bytes"
+        if time.monotonic() - self.opened_at >= self.max_age:
+            return "age"
+        return None
+
+    def _write(self, reports: list[ReportRow]) -> None:
+        if reason := self.due():
+            self.rotate(reason)
+        if self.writer is None:
+            self.open()
+        self.writer.write(reports)
+        self.rows += len(reports)
+        if reason := self.due():
+            self.rotate(reason)
+
+    async def write(
+        self, reports: list[ReportRow], controller: ReportController = None
+    ) -> None:
+        if not reports:
+            return
+        # the file is encoded & written in a thread, one batch at a time
+        async with self.lock:
+            await asyncio.to_thread(self._write, reports)
+
+    async def close(self) -> None:
+        async with self.lock:
+            await asyncio.to_thread(self.rotate, "close")
+
+    async def run(self, interval: float) -> None:
+        """
+        Close files that reached max_age while no batch came in.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            async with self.lock:
+                if self.due() == "age":
+                    await asyncio.to_thread(self.rotate, "age")
+
+
+async def write_committed(sinks: list[Sink], reports: list[ReportRow]) -> None:
+    """
+    Hand a committed batch to the sinks that are not transactional, a failure
+    is only logged, the batch is in the database.
+    """
+    for sink in sinks:
+        if sink.transactional:
+            continue
+        try:
+            await sink.write(reports)
+            sink_reports.inc(len(reports), sink=sink.name)
+        except Exception as e:
+            sink_errors.inc(sink=sink.name)
+            logger.error({"sink": sink.name, "error": e, "reports": len(reports)})
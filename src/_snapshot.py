@@ -0,0 +1,196 @@
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b"RWSNAP"
+# bump when the layout of the file or of the cache keys changes
+VERSION = 1
+
+# magic, version, built at, number of tables, offset of the blob
+HEADER = struct.Struct("<6sHdIQ")
+# name, key size, value size, number of records, offset of the records
+TABLE = struct.Struct("<16sIIQQ")
+# offset in the blob & length of a value
+BLOB_REF = struct.Struct("<QI")
+INT_VALUE = struct.Struct("<q")
+# unix time, nan for never
+EXPIRES = struct.Struct("<d")
+# stands in for None in int keys
+NULL = -(2**63)
+
+
+class InvalidSnapshot(ValueError): ...
+
+
+def int_key(size: int):
+    """
+    Encoder of a tuple of size ints, bools or None into a fixed width key.
+    """
+    packer = struct.Struct(f"<{size}q")
+
+    def encode(key: tuple) -> bytes:
+        return packer.pack(*(NULL if v is None else v for v in key))
+
+    encode.size = packer.size
+    return encode
+
+
+def text_key(size: int):
+    """
+    Encoder of a str into a fixed width key, None if it does not fit.
+    """
+
+    def encode(key: str) -> bytes | None:
+        data = key.encode()
+        if len(data) > size or b"\0" in data:
+            return None
+        return data.ljust(size, b"\0")
+
+    encode.size = size
+    return encode
+
+
+class SnapshotTable:
+    """
+    Records of (key, value) sorted by key, looked up with a binary search
+    directly on the memory map.
+    """
+
+    def __init__(self, buf, offset: int, count: int, key_size: int, value_size: int):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        self.key_size = key_size
+        self.record_size = key_size + value_size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def get(self, key: bytes) -> bytes | None:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.offset + mid * self.record_size
+            probe = self.buf[start : start + self.key_size]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return self.buf[start + self.key_size : start + self.record_size]
+        return None
+
+
+class SnapshotView:
+    """
+    Dict like get on a table, with the key encoder and value decoder of a cache.
+    """
+
+    def __init__(self, table: SnapshotTable, encode_key, decode_value):
+        self.table = table
+        self.encode_key = encode_key
+        self.decode_value = decode_value
+
+    def get(self, key):
+        key = self.encode_key(key)
+        if key is None:
+            return None
+        value = self.table.get(key)
+        return None if value is None else self.decode_value(value)
+
+
+class Snapshot:
+    """
+    A read only snapshot file, the file stays mapped until close.
+    """
+
+    def __init__(self, path: str, max_age: float):
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self.buf) < HEADER.size:
+                raise InvalidSnapshot(f"{path} is truncated")
+            magic, version, self.built_at, ntables, self.blob_offset = (
+                HEADER.unpack_from(self.buf)
+            )
+            if magic != MAGIC or version != VERSION:
+                raise InvalidSnapshot(f"{path} has version {version}, not {VERSION}")
+            age = time.time() - self.built_at
+            if age > max_age:
+                raise InvalidSnapshot(f"{path} is {age:.0f}s old")
+
+            if HEADER.size + ntables * TABLE.size > len(self.buf):
+                raise InvalidSnapshot(f"{path} is truncated")
+
+            self.tables: dict[str, SnapshotTable] = {}
+            for i in range(ntables):
+                name, key_size, value_size, count, offset = TABLE.unpack_from(
+                    self.buf, HEADER.size + i * TABLE.size
+                )
+                if offset + count * (key_size + value_size) > self.blob_offset:
+                    raise InvalidSnapshot(f"{path} is truncated")
+                self.tables[name.rstrip(b"\0").decode()] = SnapshotTable(
+                    self.buf, offset, count, key_size, value_size
+                )
+            if self.blob_offset > len(self.buf):
+                raise InvalidSnapshot(f"{path} is truncated")
+        except Exception:
+            self.buf.close()
+            raise
+
+    def view(self, name: str, encode_key, decode_value) -> SnapshotView | None:
+        table = self.tables.get(name)
+        return None if table is None else SnapshotView(table, encode_key, decode_value)
+
+    def blob(self, ref: bytes) -> bytes:
+        offset, length = BLOB_REF.unpack(ref)
+        offset += self.blob_offset
+        return self.buf[offset : offset + length]
+
+    def close(self) -> None:
+        self.buf.close()
+
+
+class SnapshotWriter:
+    def __init__(self):
+        # name: (key size, value size, {key: value})
+        self.tables: dict[str, tuple[int, int, dict[bytes, bytes]]] = {}
+        self.blob = bytearray()
+
+    def add_table(
+        self, name: str, key_size: int, value_size: int, records: dict[bytes, bytes]
+    ) -> None:
+        self.tables[name] = (key_size, value_size, records)
+
+    def add_blob(self, data: bytes) -> bytes:
+        """
+        Append data to the blob, returns the BLOB_REF to store as value.
+        """
+        ref = BLOB_REF.pack(len(self.blob), len(data))
+        self.blob += data
+        return ref
+
+    def write(self, path: str) -> None:
+        """
+        The file is written next to path and renamed, so readers never see a
+        partial snapshot and existing memory maps stay valid.
+        """
+        offset = HEADER.size + len(self.tables) * TABLE.size
+        directory = []
+        for name, (key_size, value_size, records) in self.tables.items():
+            directory.append(
+                TABLE.pack(name.encode(), key_size, value_size, len(records), offset)
+            )
+            offset += len(records) * (key_size + value_size)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, time.time(), len(self.tables), offset))
+            f.writelines(directory)
+            for _, _, records in self.tables.values():
+                for key in sorted(records):
+                    f.write(key)
+                    f.write(records[key])
+            f.write(self.blob)
+        os.replace(tmp_path, path)
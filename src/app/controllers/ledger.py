@@ -0,0 +1,77 @@
+import logging
+
+import sqlalchemy as sqla
+from _offsets import (
+    Offset,
+    fingerprint,
+    format_ranges,
+    group_by_partition,
+    parse_ranges,
+    to_ranges,
+)
+from aiokafka import TopicPartition
+from database.models.report import ReportBatchLedger as DBLedger
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+
+class LedgerController:
+    """
+    report_batch_ledger holds the kafka offsets of every committed batch,
+    it is written in the same transaction as the batch.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    def _since(self, minutes: int):
+        return sqla.func.date_sub(
+            sqla.func.now(), sqla.text(f"INTERVAL {int(minutes)} MINUTE")
+        )
+
+    async def get(
+        self, partitions: list[TopicPartition], minutes: int
+    ) -> dict[TopicPartition, list[tuple[int, int]]]:
+        if not partitions:
+            return {}
+        sql = sqla.select(
+            DBLedger.topic, DBLedger.partition_id, DBLedger.offsets
+        ).where(
+            sqla.and_(
+                sqla.tuple_(DBLedger.topic, DBLedger.partition_id).in_(
+                    [(tp.topic, tp.partition) for tp in partitions]
+                ),
+                DBLedger.created_at >= self._since(minutes),
+            )
+        )
+        result = await self.session.execute(sql)
+
+        ranges: dict[TopicPartition, list[tuple[int, int]]] = {}
+        for topic, partition_id, offsets in result.all():
+            tp = TopicPartition(topic, partition_id)
+            ranges.setdefault(tp, []).extend(parse_ranges(offsets))
+        return ranges
+
+    async def insert(self, offsets: list[Offset]) -> bool:
+        """
+        Returns False if the batch is already in the ledger.
+        """
+        _fingerprint = fingerprint(offsets)
+        values = [
+            {
+                "fingerprint": _fingerprint,
+                "topic": tp.topic,
+                "partition_id": tp.partition,
+                "offsets": format_ranges(to_ranges(_offsets)),
+            }
+            for tp, _offsets in group_by_partition(offsets).items()
+        ]
+        sql = sqla.insert(DBLedger).values(values).prefix_with("IGNORE")
+        result = await self.session.execute(sql)
+        return result.rowcount > 0
+
+    async def prune(self, minutes: int) -> int:
+        sql = sqla.delete(DBLedger).where(DBLedger.created_at < self._since(minutes))
+        result = await self.session.execute(sql)
+        return result.rowcount
@@ -1,24 +1,38 @@
 import logging
+from collections.abc import AsyncIterator
 
 import sqlalchemy as sqla
-from _cache import SimpleALRUCache
+from _cache import NEGATIVE, TTLCache
 from app.controllers.db_handler import DatabaseHandler
 from app.views.player import PlayerCreate, PlayerInDB
 from database.database import model_to_dict
 from database.models.player import Player as DBPlayer
+from database.models.report import ReportSighting as DBReportSighting
 from sqlalchemy.ext.asyncio import AsyncSession
 
 logger = logging.getLogger(__name__)
 
+# Players.name is unique on its first 50 characters, a longer name can be ignored
+# by the insert because of another name with the same prefix
+UNIQUE_NAME_PREFIX = 50
+
+
+class UnresolvedPlayer(LookupError):
+    """
+    A player that has no row after the insert, the batch is retried.
+    """
+
 
 class PlayerController(DatabaseHandler):
     def __init__(
         self,
         session: AsyncSession = None,
-        cache: SimpleALRUCache = SimpleALRUCache(),
+        cache: TTLCache = TTLCache(),
     ):
         self.session = session
         self.cache = cache
+        # players found during the transaction, only cached once it is committed
+        self.pending: list[tuple[str, PlayerInDB]] = []
 
     def sanitize_name(self, player_name: str) -> str:
         return player_name.lower().replace("_", " ").replace("-", " ").strip()
@@ -35,19 +49,71 @@ class PlayerController(DatabaseHandler):
 
         return PlayerInDB(**model_to_dict(data[0])) if data else None
 
+    async def get_many(
+        self, player_names: list[str], lock: bool = False
+    ) -> dict[str, PlayerInDB]:
+        """
+        Select all players in one round trip, keyed by sanitized name, a locking
+        read also sees the players committed after the transaction's snapshot.
+        """
+        if not player_names:
+            return {}
+        sql = sqla.select(DBPlayer).where(DBPlayer.name.in_(player_names))
+        if lock:
+            sql = sql.with_for_update(read=True)
+        result = await self.session.execute(sql)
+        data = result.scalars().all()
+
+        return {
+            self.sanitize_name(p.name): PlayerInDB(**model_to_dict(p)) for p in data
+        }
+
+    async def stream_recent(
+        self, sightings: int, partition_size: int = 10_000
+    ) -> AsyncIterator[dict[str, PlayerInDB]]:
+        """
+        Stream the reporters & reported players of the most recent sightings,
+        keyed by sanitized name.
+        """
+        recent = (
+            sqla.select(DBReportSighting.reporting_id, DBReportSighting.reported_id)
+            .order_by(DBReportSighting.report_sighting_id.desc())
+            .limit(sightings)
+            .subquery()
+        )
+        sql = sqla.select(DBPlayer).where(
+            sqla.or_(
+                DBPlayer.id.in_(sqla.select(recent.c.reporting_id)),
+                DBPlayer.id.in_(sqla.select(recent.c.reported_id)),
+            )
+        )
+        result = await self.session.stream_scalars(sql)
+        try:
+            async for players in result.partitions(partition_size):
+                yield {
+                    self.sanitize_name(p.name): PlayerInDB(**model_to_dict(p))
+                    for p in players
+                }
+        finally:
+            # the rest of an unbuffered result has to be read before the next query
+            await result.close()
+
     async def get_cache(self, player_name: str) -> PlayerInDB:
         player_name = self.sanitize_name(player_name)
-        player = await self.cache.get(key=player_name)
+        player = self.cache.get(key=player_name)
+
+        if player is NEGATIVE:
+            return None
 
         if isinstance(player, PlayerInDB):
-            if self.cache.hits % 1000 == 0 and self.cache.hits > 0:
-                logger.info(f"hits: {self.cache.hits}, misses: {self.cache.misses}")
             return player
 
         player = await self.get(player_name=player_name)
 
         if isinstance(player, PlayerInDB):
-            await self.cache.put(key=player_name, value=player)
+            self.cache.put(key=player_name, value=player)
+        else:
+            self.cache.put_negative(key=player_name)
 
         return player
 
@@ -57,6 +123,16 @@ class PlayerController(DatabaseHandler):
         await self.session.execute(sql)
         return await self.get(player_name=player.name)
 
+    async def insert_many(self, players: list[PlayerCreate]) -> None:
+        if not players:
+            return
+        values = []
+        for player in players:
+            player.name = self.sanitize_name(player.name)
+            values.append(player.model_dump())
+        sql = sqla.insert(DBPlayer).values(values).prefix_with("IGNORE")
+        await self.session.execute(sql)
+
     async def get_or_insert(self, player_name: str, cached=True) -> PlayerInDB:
         player_name = self.sanitize_name(player_name)
 
@@ -69,3 +145,57 @@ class PlayerController(DatabaseHandler):
             player = await self.insert(PlayerCreate(name=player_name))
 
         return player
+
+    async def get_or_insert_many(
+        self, player_names: list[str]
+    ) -> dict[str, PlayerInDB]:
+        """
+        Resolve a batch of names with one select, one multi-row insert ignore
+        for the misses and one locking re-select, the result is keyed by
+        sanitized name. Raises UnresolvedPlayer for a missing name the insert
+        should have accepted.
+        """
+        player_names = {self.sanitize_name(n) for n in player_names}
+
+        players: dict[str, PlayerInDB] = {}
+        misses: list[str] = []
+        for player_name in player_names:
+            player = self.cache.get(key=player_name)
+            if player is NEGATIVE:
+                continue
+            if isinstance(player, PlayerInDB):
+                players[player_name] = player
+            else:
+                misses.append(player_name)
+
+        if not misses:
+            return players
+
+        found = await self.get_many(player_names=misses)
+        missing = [n for n in misses if n not in found]
+
+        if missing:
+            await self.insert_many([PlayerCreate(name=n) for n in missing])
+            found.update(await self.get_many(player_names=missing, lock=True))
+
+        unresolved = [n for n in missing if n not in found]
+        # only a name longer than the unique prefix can be ignored for good
+        if retry := [n for n in unresolved if len(n) <= UNIQUE_NAME_PREFIX]:
+            raise UnresolvedPlayer(f"players not found after insert: {retry[:5]}")
+
+        self.pending.extend(found.items())
+        self.pending.extend((n, NEGATIVE) for n in unresolved)
+
+        players.update(found)
+        return players
+
+    def cache_pending(self) -> None:
+        """
+        Call after commit, players inserted by a rolled back transaction do not exist.
+        """
+        for player_name, player in self.pending:
+            if player is NEGATIVE:
+                self.cache.put_negative(key=player_name)
+            else:
+                self.cache.put(key=player_name, value=player)
+        self.pending = []
@@ -1,22 +1,139 @@
 import logging
+import tempfile
+from collections.abc import AsyncIterator
+from operator import attrgetter
 
 import sqlalchemy as sqla
-from _cache import SimpleALRUCache
+from _cache import DimensionCaches, SimpleALRUCache
+from _metrics import SECONDS_BUCKETS, registry
 from app.controllers.db_handler import DatabaseHandler
-from app.views.report import StgReportCreate, StgReportInDB
+from app.views.report import ReportRow, StgReportInDB
 from database.database import model_to_dict
 from database.models.report import Report as DBReport
+from database.models.report import ReportGear as DBReportGear
+from database.models.report import ReportLocation as DBReportLocation
+from database.models.report import ReportSighting as DBReportSighting
 from database.models.report import StgReport as DBSTGReport
-from sqlalchemy import TextClause
+from sqlalchemy import Column, TextClause
 from sqlalchemy.ext.asyncio import AsyncSession
 
 logger = logging.getLogger(__name__)
 
+SIGHTING_KEYS = (
+    "reportingID",
+    "reportedID",
+    "manual_detect",
+)
+GEAR_KEYS = (
+    "equip_head_id",
+    "equip_amulet_id",
+    "equip_torso_id",
+    "equip_legs_id",
+    "equip_boots_id",
+    "equip_cape_id",
+    "equip_hands_id",
+    "equip_weapon_id",
+    "equip_shield_id",
+)
+LOCATION_KEYS = (
+    "region_id",
+    "x_coord",
+    "y_coord",
+    "z_coord",
+)
+REPORT_KEYS = (
+    "timestamp",
+    "on_members_world",
+    "on_pvp_world",
+    "world_number",
+)
+# the report primary key, (sighting, location, region)
+report_key = attrgetter(*SIGHTING_KEYS, *LOCATION_KEYS)
+
+statement_seconds = registry.histogram(
+    "report_worker_statement_seconds",
+    "Duration of the statements of a report insert",
+    buckets=SECONDS_BUCKETS,
+    labels=("statement",),
+)
+
+
+class UnresolvedDimension(LookupError):
+    """
+    A dimension key that has no row after the insert, the batch is retried.
+    """
+
+
+# dimension: (model, id column, natural key columns)
+DIMENSIONS = {
+    "sighting": (
+        DBReportSighting,
+        DBReportSighting.report_sighting_id,
+        [
+            DBReportSighting.reporting_id,
+            DBReportSighting.reported_id,
+            DBReportSighting.manual_detect,
+        ],
+    ),
+    "gear": (
+        DBReportGear,
+        DBReportGear.report_gear_id,
+        [getattr(DBReportGear, k) for k in GEAR_KEYS],
+    ),
+    "location": (
+        DBReportLocation,
+        DBReportLocation.report_location_id,
+        [getattr(DBReportLocation, k) for k in LOCATION_KEYS],
+    ),
+}
+
+# temp_report column: ReportRow field, in the column order of the LOAD DATA file
+TEMP_REPORT_COLUMNS = {
+    "reporting_id": "reportingID",
+    "reported_id": "reportedID",
+    "manual_detect": "manual_detect",
+    **{k: k for k in GEAR_KEYS},
+    **{k: k for k in LOCATION_KEYS},
+    "reported_at": "timestamp",
+    "on_members_world": "on_members_world",
+    "on_pvp_world": "on_pvp_world",
+    "world_number": "world_number",
+}
+temp_report_fields = attrgetter(*TEMP_REPORT_COLUMNS.values())
+
+
+def to_tsv(reports: list[ReportRow]) -> bytes:
+    """
+    The temp_report rows in the default format of LOAD DATA, tab separated with
+    \\N for NULL.
+    """
+    lines = []
+    for report in reports:
+        values = [
+            "\\N" if v is None else str(int(v)) if isinstance(v, bool) else str(v)
+            for v in temp_report_fields(report)
+        ]
+        lines.append("\t".join(values))
+    lines.append("")
+    return "\n".join(lines).encode()
+
+
+# the normalized report table, it is written with text sql
+report_table = sqla.table(
+    "report",
+    sqla.column("report_sighting_id"),
+    sqla.column("report_location_id"),
+    sqla.column("report_gear_id"),
+)
+
 
 class ReportController(DatabaseHandler):
-    def __init__(self, session: AsyncSession):
+    def __init__(self, session: AsyncSession, dimension_cache: DimensionCaches = None):
         self.session = session
         self.cache = SimpleALRUCache(max_size=2000)
+        self.dimension_cache = dimension_cache or DimensionCaches()
+        # ids found during the transaction, only cached once it is committed
+        self.pending_ids: list[tuple[SimpleALRUCache, tuple, int]] = []
 
     async def get(
         self, reported_id: int, reporting_id: int, region_id: int
@@ -44,47 +161,19 @@ class ReportController(DatabaseHandler):
             )
         return report
 
-    async def insert(self, reports: list[StgReportCreate]) -> None:
-        sql = sqla.insert(DBSTGReport).values([r.model_dump() for r in reports])
+    async def insert(self, reports: list[ReportRow]) -> None:
+        sql = sqla.insert(DBSTGReport).values([r._asdict() for r in reports])
         await self.session.execute(sql)
         return
 
-    def _parse_reports(self, reports: list[StgReportCreate]) -> list[dict]:
-        sighting_keys = (
-            "reportingID",
-            "reportedID",
-            "manual_detect",
-        )
-        gear_keys = (
-            "equip_head_id",
-            "equip_amulet_id",
-            "equip_torso_id",
-            "equip_legs_id",
-            "equip_boots_id",
-            "equip_cape_id",
-            "equip_hands_id",
-            "equip_weapon_id",
-            "equip_shield_id",
-        )
-        location_keys = (
-            "region_id",
-            "x_coord",
-            "y_coord",
-            "z_coord",
-        )
-        report_keys = (
-            "timestamp",
-            "on_members_world",
-            "on_pvp_world",
-            "world_number",
-        )
-        keys = [*sighting_keys, *gear_keys, *location_keys, *report_keys]
-        return [{k: v for k, v in r.model_dump().items() if k in keys} for r in reports]
+    def _parse_reports(self, reports: list[ReportRow]) -> list[dict]:
+        keys = [*SIGHTING_KEYS, *GEAR_KEYS, *LOCATION_KEYS, *REPORT_KEYS]
+        return [{k: v for k, v in r._asdict().items() if k in keys} for r in reports]
 
     def _create_temp_report(self) -> TextClause:
         return sqla.text(
             """
-            CREATE TEMPORARY TABLE temp_report (
+            CREATE TEMPORARY TABLE IF NOT EXISTS temp_report (
                 /*sighting*/
                 reporting_id INT,
                 reported_id INT,
@@ -163,152 +252,259 @@ class ReportController(DatabaseHandler):
                 :on_members_world,
                 :on_pvp_world,
                 :world_number
-            );
+            )
         """
         )
 
-    def _insert_sighting(self) -> TextClause:
+    def _load_temp_report(self) -> TextClause:
+        # needs local_infile on the client & the server
         return sqla.text(
+            f"""
+            LOAD DATA LOCAL INFILE :path INTO TABLE temp_report
+            ({", ".join(TEMP_REPORT_COLUMNS)})
             """
-            INSERT INTO report_sighting (reporting_id, reported_id, manual_detect)
-            SELECT DISTINCT tr.reporting_id, tr.reported_id, tr.manual_detect FROM temp_report tr
-            WHERE NOT EXISTS (
-                SELECT 1 FROM report_sighting rs
-                WHERE 1
-                    AND tr.reporting_id = rs.reporting_id
-                    AND tr.reported_id = rs.reported_id
-                    AND tr.manual_detect = rs.manual_detect
-            );
-        """
         )
 
-    def _insert_gear(self) -> TextClause:
+    def _insert_report_ids(self) -> TextClause:
         return sqla.text(
             """
-            INSERT INTO report_gear (
-                equip_head_id,
-                equip_amulet_id,
-                equip_torso_id,
-                equip_legs_id,
-                equip_boots_id,
-                equip_cape_id,
-                equip_hands_id,
-                equip_weapon_id,
-                equip_shield_id
+            INSERT IGNORE INTO report (
+                report_sighting_id,
+                report_location_id,
+                report_gear_id,
+                reported_at,
+                on_members_world,
+                on_pvp_world,
+                world_number,
+                region_id
             )
-            SELECT DISTINCT
-                tr.equip_head_id,
-                tr.equip_amulet_id,
-                tr.equip_torso_id,
-                tr.equip_legs_id,
-                tr.equip_boots_id,
-                tr.equip_cape_id,
-                tr.equip_hands_id,
-                tr.equip_weapon_id,
-                tr.equip_shield_id
-            FROM temp_report tr
-            WHERE NOT EXISTS (
-                SELECT
-                    1
-                FROM report_gear rg
-                WHERE tr.equip_head_id = rg.equip_head_id
-                AND tr.equip_amulet_id = rg.equip_amulet_id
-                AND tr.equip_torso_id = rg.equip_torso_id
-                AND tr.equip_legs_id = rg.equip_legs_id
-                AND tr.equip_boots_id = rg.equip_boots_id
-                AND tr.equip_cape_id = rg.equip_cape_id
-                AND tr.equip_hands_id = rg.equip_hands_id
-                AND tr.equip_weapon_id = rg.equip_weapon_id
-                AND tr.equip_shield_id = rg.equip_shield_id
-            );
-        """
+            VALUES (
+                :report_sighting_id,
+                :report_location_id,
+                :report_gear_id,
+                :timestamp,
+                :on_members_world,
+                :on_pvp_world,
+                :world_number,
+                :region_id
+            )
+            """
         )
 
-    def _insert_location(self) -> TextClause:
-        return sqla.text(
-            """
-            INSERT INTO report_location (region_id, x_coord, y_coord, z_coord)
-            SELECT DISTINCT tr.region_id, tr.x_coord, tr.y_coord, tr.z_coord FROM temp_report tr
-            WHERE NOT EXISTS (
-                SELECT 1 FROM report_location rl
-                WHERE 1
-                    AND tr.region_id = rl.region_id
-                    AND tr.x_coord = rl.x_coord
-                    AND tr.y_coord = rl.y_coord
-                    AND tr.z_coord = rl.z_coord
-            );
-            """
+    async def _select_dimension(
+        self,
+        id_column: Column,
+        columns: list[Column],
+        keys: list[tuple],
+        lock: bool = False,
+    ) -> dict[tuple, int]:
+        # tuple IN does not match NULL, so nullable keys (gear) are matched one by one
+        not_null = [k for k in keys if None not in k]
+        nullable = [k for k in keys if None in k]
+
+        clauses = []
+        if not_null:
+            clauses.append(sqla.tuple_(*columns).in_(not_null))
+        for key in nullable:
+            clauses.append(sqla.and_(*[c == v for c, v in zip(columns, key)]))
+
+        sql = sqla.select(id_column, *columns).where(sqla.or_(*clauses))
+        # a locking read sees the rows committed after the transaction's snapshot
+        if lock:
+            sql = sql.with_for_update(read=True)
+        with statement_seconds.time(statement=f"{id_column.table.name}_select"):
+            result = await self.session.execute(sql)
+
+        ids = {}
+        for _id, *key in result.all():
+            key = tuple(key)
+            # the unique key does not cover NULL, keep the lowest id on duplicates
+            if key not in ids or _id < ids[key]:
+                ids[key] = _id
+        return ids
+
+    async def _get_or_insert_dimension(
+        self,
+        cache: SimpleALRUCache,
+        model,
+        id_column: Column,
+        columns: list[Column],
+        keys: set[tuple],
+    ) -> dict[tuple, int]:
+        ids: dict[tuple, int] = {}
+        misses: list[tuple] = []
+        for key in keys:
+            _id = await cache.get(key=key)
+            if _id is None:
+                misses.append(key)
+            else:
+                ids[key] = _id
+
+        if not misses:
+            return ids
+
+        found = await self._select_dimension(id_column, columns, misses)
+        missing = [k for k in misses if k not in found]
+
+        if missing:
+            names = [c.name for c in columns]
+            values = [dict(zip(names, k)) for k in missing]
+            sql = sqla.insert(model).values(values).prefix_with("IGNORE")
+            with statement_seconds.time(statement=f"{model.__tablename__}_insert"):
+                await self.session.execute(sql)
+            # rows another writer committed are ignored by the insert but are not
+            # in the snapshot of a plain select under REPEATABLE READ
+            found.update(
+                await self._select_dimension(id_column, columns, missing, lock=True)
+            )
+            if unresolved := [k for k in missing if k not in found]:
+                raise UnresolvedDimension(f"{model.__tablename__}: {unresolved[:5]}")
+
+        self.pending_ids.extend((cache, key, _id) for key, _id in found.items())
+
+        ids.update(found)
+        return ids
+
+    async def stream_recent_dimension(
+        self, dimension: str, limit: int, partition_size: int = 10_000
+    ) -> AsyncIterator[dict[tuple, int]]:
+        """
+        Stream the {key: id} of the dimension rows of the most recent sightings,
+        the sightings themselves or the gear & locations their reports use.
+        """
+        _, id_column, columns = DIMENSIONS[dimension]
+        if dimension == "sighting":
+            sql = sqla.select(id_column, *columns).order_by(id_column.desc())
+            sql = sql.limit(limit)
+        else:
+            recent = (
+                sqla.select(report_table.c[id_column.name])
+                .order_by(report_table.c.report_sighting_id.desc())
+                .limit(limit)
+                .subquery()
+            )
+            sql = sqla.select(id_column, *columns).where(
+                id_column.in_(sqla.select(recent.c[id_column.name]))
+            )
+
+        result = await self.session.stream(sql)
+        try:
+            async for rows in result.partitions(partition_size):
+                yield {tuple(key): _id for _id, *key in rows}
+        finally:
+            await result.close()
+
+    async def cache_pending_ids(self) -> None:
+        """
+        Call after commit, ids inserted by a rolled back transaction do not exist.
+        """
+        for cache, key, _id in self.pending_ids:
+            await cache.put(key=key, value=_id)
+        self.pending_ids = []
+
+    async def insert_report(self, reports: list[ReportRow]) -> None:
+        """
+        Resolve the dimension ids through the dimension cache, only keys that
+        are not cached are selected or inserted, the report rows are then
+        inserted with the ids the worker holds.
+        """
+        sighting_key = attrgetter(*SIGHTING_KEYS)
+        gear_key = attrgetter(*GEAR_KEYS)
+        location_key = attrgetter(*LOCATION_KEYS)
+
+        sighting_ids = await self._get_or_insert_dimension(
+            self.dimension_cache.sighting,
+            *DIMENSIONS["sighting"],
+            keys={sighting_key(r) for r in reports},
+        )
+        gear_ids = await self._get_or_insert_dimension(
+            self.dimension_cache.gear,
+            *DIMENSIONS["gear"],
+            keys={gear_key(r) for r in reports},
+        )
+        location_ids = await self._get_or_insert_dimension(
+            self.dimension_cache.location,
+            *DIMENSIONS["location"],
+            keys={location_key(r) for r in reports},
         )
 
-    def _insert_report(self) -> TextClause:
-        return sqla.text(
-            """
-                INSERT IGNORE INTO report (
-                    report_sighting_id,
-                    report_location_id,
-                    report_gear_id,
-                    reported_at,
-                    on_members_world,
-                    on_pvp_world,
-                    world_number,
-                    region_id
-                )
-                SELECT DISTINCT
-                    rs.report_sighting_id,
-                    rl.report_location_id,
-                    rg.report_gear_id,
-                    tr.reported_at,
-                    tr.on_members_world,
-                    tr.on_pvp_world,
-                    tr.world_number,
-                    tr.region_id
-                FROM temp_report tr
-                JOIN report_sighting rs
-                    ON rs.reporting_id = tr.reporting_id
-                    AND rs.reported_id = tr.reported_id
-                JOIN report_location rl
-                    ON rl.region_id = tr.region_id
-                    AND rl.x_coord = tr.x_coord
-                    AND rl.y_coord = tr.y_coord
-                    AND rl.z_coord = tr.z_coord
-                JOIN report_gear rg
-                    ON rg.equip_head_id = tr.equip_head_id
-                    AND rg.equip_amulet_id = tr.equip_amulet_id
-                    AND rg.equip_torso_id = tr.equip_torso_id
-                    AND rg.equip_legs_id = tr.equip_legs_id
-                    AND rg.equip_boots_id = tr.equip_boots_id
-                    AND rg.equip_cape_id = tr.equip_cape_id
-                    AND rg.equip_hands_id = tr.equip_hands_id
-                    AND rg.equip_weapon_id = tr.equip_weapon_id
-                    AND rg.equip_shield_id = tr.equip_shield_id
-                WHERE NOT EXISTS (
-                    SELECT 1 FROM report rp
-                    WHERE 1
-                        AND rs.report_sighting_id = rp.report_sighting_id
-                        AND rl.report_location_id = rp.report_location_id
-                        AND tr.region_id = rp.region_id
+        rows = []
+        for r in reports:
+            sighting_id = sighting_ids.get(sighting_key(r))
+            gear_id = gear_ids.get(gear_key(r))
+            location_id = location_ids.get(location_key(r))
+
+            if None in (sighting_id, gear_id, location_id):
+                raise UnresolvedDimension(f"could not resolve dimension ids: {r}")
+
+            rows.append(
+                {
+                    "report_sighting_id": sighting_id,
+                    "report_location_id": location_id,
+                    "report_gear_id": gear_id,
+                    "timestamp": r.timestamp,
+                    "on_members_world": r.on_members_world,
+                    "on_pvp_world": r.on_pvp_world,
+                    "world_number": r.world_number,
+                    "region_id": r.region_id,
+                }
+            )
+
+        if rows:
+            with statement_seconds.time(statement="report_insert"):
+                await self.session.execute(self._insert_report_ids(), params=rows)
+
+    async def _prepare_temp_report(self) -> None:
+        """
+        temp_report lives as long as the pooled connection, it is only created
+        once per connection and emptied if a previous batch did not finish.
+        """
+        connection = await self.session.connection()
+        state = connection.info.get("temp_report")
+
+        if state is None:
+            await self.session.execute(self._create_temp_report())
+        elif state == "dirty":
+            # ENGINE=MEMORY is not transactional, a rollback leaves the rows
+            await self.session.execute(sqla.text("DELETE FROM temp_report"))
+
+        connection.info["temp_report"] = "dirty"
+
+    async def _stage_temp_report(
+        self, reports: list[ReportRow], directory: str = None
+    ) -> None:
+        """
+        Stream the batch into temp_report with LOAD DATA LOCAL INFILE, the driver
+        reads the file by name, so it is written to directory, ideally a tmpfs.
+        """
+        with tempfile.NamedTemporaryFile(dir=directory, suffix=".tsv") as f:
+            f.write(to_tsv(reports))
+            f.flush()
+            with statement_seconds.time(statement="temp_report_load"):
+                await self.session.execute(
+                    self._load_temp_report(), params={"path": f.name}
                 )
-                ;
-            """
-        )
 
-    async def insert_report(self, reports: list[StgReportCreate]) -> None:
-        _reports = self._parse_reports(reports=reports)
-        sql_create_temp_report = self._create_temp_report()
-        sql_insert_temp_report = self._insert_temp_report()
-        sql_insert_sighting = self._insert_sighting()
-        sql_insert_gear = self._insert_gear()
-        sql_insert_location = self._insert_location()
-        sql_insert_report = self._insert_report()
-
-        await self.session.execute(sqla.text("DROP TABLE IF EXISTS temp_report;"))
-        await self.session.execute(sql_create_temp_report)
-        await self.session.execute(sql_insert_temp_report, params=_reports)
-        await self.session.execute(sql_insert_sighting)
-        await self.session.execute(sql_insert_gear)
-        await self.session.execute(sql_insert_location)
-        await self.session.execute(sql_insert_report)
-        await self.session.execute(sqla.text("DROP TABLE IF EXISTS temp_report;"))
+    async def insert_report_temp_table(
+        self, reports: list[ReportRow], load_data: bool = False, load_data_dir=None
+    ) -> None:
+        """
+        Normalize the batch server side, one round trip to fill temp_report
+        and one to call normalize_temp_report(), with load_data temp_report is
+        filled with LOAD DATA LOCAL INFILE instead of a parameterized insert.
+        """
+        await self._prepare_temp_report()
+        if load_data:
+            await self._stage_temp_report(reports, load_data_dir)
+        else:
+            _reports = self._parse_reports(reports=reports)
+            with statement_seconds.time(statement="temp_report_insert"):
+                await self.session.execute(self._insert_temp_report(), params=_reports)
+        with statement_seconds.time(statement="normalize_temp_report"):
+            await self.session.execute(sqla.text("CALL normalize_temp_report()"))
+
+        connection = await self.session.connection()
+        connection.info["temp_report"] = "clean"
 
     async def get_or_insert(self):
         raise NotImplementedError()
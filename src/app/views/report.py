@@ -1,9 +1,12 @@
+import json
 import logging
 import time
+from collections import Counter
 from datetime import datetime
-from typing import Optional
+from typing import NamedTuple, Optional
 
-from pydantic import BaseModel
+import numpy as np
+from pydantic import BaseModel, ValidationError
 
 logger = logging.getLogger(__name__)
 
@@ -92,6 +95,34 @@ class StgReportCreate(BaseModel):
     equip_ge_value: Optional[int] = None
 
 
+class ReportRow(NamedTuple):
+    """
+    Flat report as it moves through the pipeline, same fields as StgReportCreate.
+    """
+
+    reportedID: int
+    reportingID: int
+    region_id: int
+    x_coord: int
+    y_coord: int
+    z_coord: int
+    timestamp: datetime
+    manual_detect: Optional[bool] = None
+    on_members_world: Optional[int] = None
+    on_pvp_world: Optional[bool] = None
+    world_number: Optional[int] = None
+    equip_head_id: Optional[int] = None
+    equip_amulet_id: Optional[int] = None
+    equip_torso_id: Optional[int] = None
+    equip_legs_id: Optional[int] = None
+    equip_boots_id: Optional[int] = None
+    equip_cape_id: Optional[int] = None
+    equip_hands_id: Optional[int] = None
+    equip_weapon_id: Optional[int] = None
+    equip_shield_id: Optional[int] = None
+    equip_ge_value: Optional[int] = None
+
+
 class StgReportUpdate(BaseModel):
     reportedID: Optional[int] = None
     reportingID: Optional[int] = None
@@ -124,49 +155,6 @@ class StgReport(StgReportInDB):
     pass
 
 
-def convert_report_q_to_db(
-    reported_id: int, reporting_id: int, report_in_queue: ReportInQueue
-) -> StgReportCreate:
-    # If the timestamp is too large, assume it's in milliseconds and convert to seconds
-    if report_in_queue.ts > 10**10:
-        report_in_queue.ts = report_in_queue.ts / 1000
-
-    if report_in_queue.ts > 1735736400:
-        logger.warning(f"{report_in_queue.ts=} > 2025-01-01, {report_in_queue=}")
-        return None
-
-    if report_in_queue.ts < 1577883600:
-        logger.warning(f"{report_in_queue.ts=} < 2020-01-01, {report_in_queue=}")
-        return None
-
-    gmt = time.gmtime(report_in_queue.ts)
-    human_time = time.strftime("%Y-%m-%d %H:%M:%S", gmt)
-    human_time = datetime.fromtimestamp(report_in_queue.ts)
-    return StgReportCreate(
-        reportedID=reported_id,
-        reportingID=reporting_id,
-        timestamp=human_time,
-        region_id=report_in_queue.region_id,
-        x_coord=report_in_queue.x_coord,
-        y_coord=report_in_queue.y_coord,
-        z_coord=report_in_queue.z_coord,
-        manual_detect=bool(report_in_queue.manual_detect),
-        on_members_world=report_in_queue.on_members_world,
-        on_pvp_world=bool(report_in_queue.on_pvp_world),
-        world_number=report_in_queue.world_number,
-        equip_head_id=report_in_queue.equipment.equip_head_id,
-        equip_amulet_id=report_in_queue.equipment.equip_amulet_id,
-        equip_torso_id=report_in_queue.equipment.equip_torso_id,
-        equip_legs_id=report_in_queue.equipment.equip_legs_id,
-        equip_boots_id=report_in_queue.equipment.equip_boots_id,
-        equip_cape_id=report_in_queue.equipment.equip_cape_id,
-        equip_hands_id=report_in_queue.equipment.equip_hands_id,
-        equip_weapon_id=report_in_queue.equipment.equip_weapon_id,
-        equip_shield_id=report_in_queue.equipment.equip_shield_id,
-        equip_ge_value=report_in_queue.equip_ge_value,
-    )
-
-
 def convert_stg_to_kafka_report(stg_report: StgReportCreate) -> KafkaReport:
     equipment = Equipment(
         equip_head_id=stg_report.equip_head_id,
@@ -206,3 +194,196 @@ def convert_stg_to_kafka_report(stg_report: StgReportCreate) -> KafkaReport:
         reported_id=stg_report.reportedID,
         metadata=Metadata(version="v2.0.0"),
     )
+
+
+def compile_schema(model: type[BaseModel]) -> tuple[tuple[str, bool, bool], ...]:
+    """
+    (name, required, nullable) of the int fields of a model
+    """
+    schema = []
+    for name, field in model.model_fields.items():
+        if field.annotation is int:
+            schema.append((name, field.is_required(), False))
+        elif field.annotation == Optional[int]:
+            schema.append((name, field.is_required(), True))
+    return tuple(schema)
+
+
+V2_SCHEMA = compile_schema(ReportInQV2)
+EQUIPMENT_SCHEMA = compile_schema(Equipment)
+
+
+class SchemaMismatch(ValueError):
+    ...
+
+
+def _check(data: dict, schema: tuple[tuple[str, bool, bool], ...]) -> None:
+    for name, required, nullable in schema:
+        if name not in data:
+            if required:
+                raise SchemaMismatch(name)
+            continue
+        value = data[name]
+        # strict, anything pydantic would have to coerce takes the slow path
+        if type(value) is not int and not (nullable and value is None):
+            raise SchemaMismatch(name)
+
+
+def check_report_v2(raw_msg: dict) -> None:
+    """
+    Raises SchemaMismatch if the message should go through ReportInQV2.
+    """
+    _check(raw_msg, V2_SCHEMA)
+    equipment = raw_msg.get("equipment")
+    if type(equipment) is not dict:
+        raise SchemaMismatch("equipment")
+    _check(equipment, EQUIPMENT_SCHEMA)
+
+
+def normalize_reports(
+    msgs: list[dict],
+) -> tuple[list[int], list[ReportRow], Counter]:
+    """
+    Converts a micro batch of checked v2 shaped messages column by column, ts in
+    milliseconds is converted to seconds, reports outside 2020-2025 are dropped
+    and equipment ids over 32767 are set to 0. Returns the index and ReportRow of
+    every surviving message and the drop counts by reason.
+    """
+    if not msgs:
+        return [], [], Counter()
+
+    ts = np.array([m["ts"] for m in msgs], dtype=np.float64)
+    # If the timestamp is too large, assume it's in milliseconds and convert to seconds
+    ts = np.where(ts > 10**10, ts / 1000, ts)
+
+    # 2025-01-01 & 2020-01-01
+    too_new = ts > 1735736400
+    too_old = ts < 1577883600
+    # unary + drops the reasons that did not occur
+    drops = +Counter(ts_future=int(too_new.sum()), ts_past=int(too_old.sum()))
+
+    keep = np.flatnonzero(~(too_new | too_old))
+    msgs = [msgs[i] for i in keep]
+    if not msgs:
+        return [], [], drops
+
+    flags = np.array(
+        [(m["manual_detect"], m["on_pvp_world"]) for m in msgs], dtype=np.int64
+    )
+    manual_detect, on_pvp_world = (flags != 0).T.tolist()
+
+    # None becomes nan, which never compares greater
+    gear = np.array(
+        [[m["equipment"].get(k) for k, _, _ in EQUIPMENT_SCHEMA] for m in msgs],
+        dtype=np.float64,
+    )
+    missing = np.isnan(gear)
+    clamped = gear > 32767
+    if clamped.any():
+        logger.warning(f"clamped {int(clamped.any(axis=1).sum())} reports equipment")
+        gear[clamped] = 0
+    gear = np.where(missing, 0, gear).astype(np.int64).astype(object)
+    gear[missing] = None
+
+    rows = zip(
+        [m["reported_id"] for m in msgs],
+        [m["reporter_id"] for m in msgs],
+        [m["region_id"] for m in msgs],
+        [m["x_coord"] for m in msgs],
+        [m["y_coord"] for m in msgs],
+        [m["z_coord"] for m in msgs],
+        map(datetime.fromtimestamp, ts[keep].tolist()),
+        manual_detect,
+        [m["on_members_world"] for m in msgs],
+        on_pvp_world,
+        [m["world_number"] for m in msgs],
+        *gear.T.tolist(),
+        [m["equip_ge_value"] for m in msgs],
+    )
+    return keep.tolist(), list(map(ReportRow._make, rows)), drops
+
+
+class Decoded(NamedTuple):
+    # "delay", "v1", "v2" or "drop"
+    kind: str
+    retry: dict | None
+    version: str | None
+    # v1: the validated message, v2: a ReportRow
+    payload: dict | ReportRow | None = None
+
+
+def decode_messages(values: list[bytes | dict]) -> tuple[list[Decoded], Counter]:
+    """
+    The cpu bound part of process_data for a micro batch of kafka values, json
+    or already deserialized, returns a Decoded for every value and the drop counts.
+    Only plain data goes in and out, so it can run in a process pool.
+    """
+    decoded: list[Decoded] = []
+    drops = Counter()
+    # index in decoded & checked message of every v2 message
+    v2_msgs: list[tuple[int, dict]] = []
+    for value in values:
+        try:
+            raw_msg: dict = json.loads(value) if isinstance(value, bytes) else value
+
+            retry: dict = raw_msg.get("retry")
+            if retry:
+                raw_msg = {k: v for k, v in raw_msg.items() if k != "retry"}
+                if retry["not_before"] > time.time():
+                    decoded.append(Decoded("delay", retry, None))
+                    continue
+
+            msg_metadata: dict = raw_msg.get("metadata")
+            msg_version = msg_metadata.get("version") if msg_metadata else None
+        # not json, not an object, a bad retry header
+        except (ValueError, TypeError, AttributeError, KeyError) as e:
+            logger.error({"error": e, "value": repr(value)[:200]})
+            drops["malformed"] += 1
+            decoded.append(Decoded("drop", None, None))
+            continue
+
+        try:
+            if msg_version in [None, "v1.0.0"]:
+                msg = ReportInQV1(**raw_msg).model_dump()
+                decoded.append(Decoded("v1", retry, msg_version, msg))
+                continue
+            elif msg_version in ["v2.0.0"]:
+                try:
+                    check_report_v2(raw_msg)
+                except SchemaMismatch:
+                    raw_msg = ReportInQV2(**raw_msg).model_dump()
+                v2_msgs.append((len(decoded), raw_msg))
+                decoded.append(Decoded("drop", retry, msg_version))
+                continue
+            drops["version"] += 1
+        # pydantic error
+        except ValidationError as e:
+            logger.error({"error": e})
+            drops["invalid"] += 1
+        # e.g. keys that are not strings
+        except (TypeError, AttributeError) as e:
+            logger.error({"error": e})
+            drops["malformed"] += 1
+        decoded.append(Decoded("drop", retry, msg_version))
+
+    try:
+        keep, rows, normalize_drops = normalize_reports([msg for _, msg in v2_msgs])
+    # a message the vectorized checks can not handle, normalize one by one
+    except (ValueError, TypeError, KeyError) as e:
+        logger.error({"error": e, "normalize": len(v2_msgs)})
+        keep, rows, normalize_drops = [], [], Counter()
+        for i, (_, msg) in enumerate(v2_msgs):
+            try:
+                _keep, _rows, _drops = normalize_reports([msg])
+            except (ValueError, TypeError, KeyError):
+                normalize_drops["malformed"] += 1
+                continue
+            if _keep:
+                keep.append(i)
+                rows.extend(_rows)
+            normalize_drops.update(_drops)
+    drops.update(normalize_drops)
+    for i, row in zip(keep, rows):
+        index = v2_msgs[i][0]
+        decoded[index] = decoded[index]._replace(kind="v2", payload=row)
+    return decoded, drops
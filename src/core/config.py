@@ -7,6 +7,83 @@ class Settings(BaseSettings):
     POOL_TIMEOUT: int
     POOL_RECYCLE: int
     ENV: str = "PRD"
+    # comma separated sinks of every batch, "normalized" report tables, "staging"
+    # the legacy stgReports table, "archive" parquet files in ARCHIVE_DIR (needs
+    # pyarrow), a file is closed at ARCHIVE_MAX_BYTES or ARCHIVE_MAX_AGE seconds
+    SINKS: str = "normalized"
+    ARCHIVE_DIR: str | None = None
+    ARCHIVE_MAX_BYTES: int = 128 * 1024 * 1024
+    ARCHIVE_MAX_AGE: int = 3600
+    ARCHIVE_COMPRESSION: str = "zstd"
+    # cached: dimension ids cached in the worker, procedure: normalize_temp_report()
+    REPORT_INSERT_MODE: str = "cached"
+    # procedure mode stages batches of at least LOAD_DATA_MIN_ROWS reports with
+    # LOAD DATA LOCAL INFILE from a file in LOAD_DATA_DIR (e.g. /dev/shm, the
+    # system temp dir if not set), 0 disables it
+    LOAD_DATA_MIN_ROWS: int = 0
+    LOAD_DATA_DIR: str | None = None
+    # number of concurrent database writers, reports are sharded by sighting, the
+    # gear & location rows are shared between writers
+    DB_WRITERS: int = 2
+    DB_LOCK_RETRIES: int = 3
+    # LANES > 0 routes records by "partition" or "reporter" hash to LANES lanes,
+    # each with one process task, batcher & writer, instead of DB_WRITERS shards
+    LANES: int = 0
+    LANE_KEY: str = "partition"
+    # AIMD of the batch size & process tasks toward ADAPT_TARGET_SECONDS per insert
+    ADAPTIVE: bool = False
+    ADAPT_INTERVAL: int = 10
+    ADAPT_TARGET_SECONDS: float = 1.0
+    BATCH_SIZE_MIN: int = 100
+    BATCH_SIZE_MAX: int = 5_000
+    PROCESS_TASKS_MIN: int = 1
+    PROCESS_TASKS_MAX: int = 10
+    # how long committed batches are kept in report_batch_ledger
+    LEDGER_RETENTION_MINUTES: int = 60
+    REPORT_TOPIC: str = "report"
+    RETRY_TOPIC: str = "report-retry"
+    DLQ_TOPIC: str = "report-dlq"
+    # kafka fetching pauses at BACKPRESSURE_HIGH offsets in flight and resumes at
+    # BACKPRESSURE_LOW, 0 disables it
+    BACKPRESSURE_HIGH: int = 20_000
+    BACKPRESSURE_LOW: int = 10_000
+    # seconds to drain the pipeline on SIGTERM, what is left is consumed again
+    SHUTDOWN_TIMEOUT: int = 20
+    # retry n waits RETRY_BASE_DELAY * 2 ** (n - 1) seconds, then the dead letter topic
+    RETRY_MAX_ATTEMPTS: int = 5
+    RETRY_BASE_DELAY: int = 5
+    PLAYER_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    # seconds until a cached player is selected again, None keeps it until evicted
+    PLAYER_CACHE_TTL: int | None = 3600
+    # seconds a name that could not be resolved is not looked up again
+    PLAYER_CACHE_NEGATIVE_TTL: int = 60
+    # reports with the same primary key as a report committed within the window
+    # are dropped, capacity is the number of keys per window
+    DEDUPE_WINDOW: int = 3600
+    DEDUPE_CAPACITY: int = 1_000_000
+    DEDUPE_FP_RATE: float = 0.001
+    # fill the caches from the players & dimensions of the most recent sightings
+    # before consuming, stops at WARMUP_SECONDS or WARMUP_MAX_BYTES
+    WARMUP: bool = False
+    WARMUP_SIGHTINGS: int = 500_000
+    WARMUP_SECONDS: int = 60
+    WARMUP_MAX_BYTES: int = 128 * 1024 * 1024
+    # the caches are saved to SNAPSHOT_PATH every SNAPSHOT_INTERVAL seconds and on
+    # shutdown, a snapshot older than SNAPSHOT_MAX_AGE seconds is not loaded
+    SNAPSHOT_PATH: str | None = None
+    SNAPSHOT_INTERVAL: int = 300
+    SNAPSHOT_MAX_AGE: int = 3600
+    # only one process writes the snapshot, the others map the same file
+    SNAPSHOT_WRITE: bool = True
+    # decode & validate messages on a "thread" or "process" pool instead of the loop
+    DECODE_EXECUTOR: str | None = None
+    DECODE_WORKERS: int = 2
+    # prometheus text format on :METRICS_PORT/metrics, 0 disables it
+    METRICS_PORT: int = 9100
+    METRICS_HOST: str = "0.0.0.0"
+    # worker processes of src/supervisor.py, if not set the cpus this process may
+    # run on, capped by the cgroup cpu quota
+    WORKER_PROCESSES: int | None = None
 
 
 settings = Settings()
@@ -9,6 +9,8 @@ engine = create_async_engine(
     pool_timeout=settings.POOL_TIMEOUT,
     pool_recycle=settings.POOL_RECYCLE,
     echo=(settings.ENV != "PRD"),
+    # LOAD DATA LOCAL INFILE is refused unless the client allows it
+    connect_args={"local_infile": True} if settings.LOAD_DATA_MIN_ROWS else {},
 )
 
 # Create a session factory
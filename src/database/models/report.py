@@ -1,4 +1,14 @@
-from sqlalchemy import BigInteger, Boolean, Column, DateTime, Integer
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    Integer,
+    LargeBinary,
+    SmallInteger,
+    String,
+    Text,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 
@@ -59,3 +69,47 @@ class Report(Base):
     equip_weapon_id = Column(Integer)
     equip_shield_id = Column(Integer)
     equip_ge_value = Column(BigInteger)
+
+
+class ReportSighting(Base):
+    __tablename__ = "report_sighting"
+
+    report_sighting_id = Column(Integer, primary_key=True, autoincrement=True)
+    reporting_id = Column(Integer, nullable=False)
+    reported_id = Column(Integer, nullable=False)
+    manual_detect = Column(Boolean)
+
+
+class ReportGear(Base):
+    __tablename__ = "report_gear"
+
+    report_gear_id = Column(Integer, primary_key=True, autoincrement=True)
+    equip_head_id = Column(SmallInteger)
+    equip_amulet_id = Column(SmallInteger)
+    equip_torso_id = Column(SmallInteger)
+    equip_legs_id = Column(SmallInteger)
+    equip_boots_id = Column(SmallInteger)
+    equip_cape_id = Column(SmallInteger)
+    equip_hands_id = Column(SmallInteger)
+    equip_weapon_id = Column(SmallInteger)
+    equip_shield_id = Column(SmallInteger)
+
+
+class ReportLocation(Base):
+    __tablename__ = "report_location"
+
+    report_location_id = Column(Integer, primary_key=True, autoincrement=True)
+    region_id = Column(Integer, nullable=False)
+    x_coord = Column(Integer, nullable=False)
+    y_coord = Column(Integer, nullable=False)
+    z_coord = Column(Integer, nullable=False)
+
+
+class ReportBatchLedger(Base):
+    __tablename__ = "report_batch_ledger"
+
+    fingerprint = Column(LargeBinary(16), primary_key=True)
+    topic = Column(String(255), primary_key=True)
+    partition_id = Column(Integer, primary_key=True)
+    offsets = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
@@ -6,15 +6,26 @@ logger = logging.getLogger(__name__)
 
 
 class GracefulShutdown:
+    """
+    On SIGINT or SIGTERM, sets the shutdown_event and runs the shutdown_sequence
+    coroutine function as self.task, further signals are ignored.
+    Created within the running loop.
+    """
+
     def __init__(self, shutdown_event: asyncio.Event, shutdown_sequence):
-        signal.signal(signal.SIGINT, self.exit_gracefully)
-        signal.signal(signal.SIGTERM, self.exit_gracefully)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.exit_gracefully, signum, None)
         self.shutdown_event = shutdown_event
         self.shutdown_sequence = shutdown_sequence
+        self.task: asyncio.Task = None
 
     def exit_gracefully(self, signum, frame):
+        if self.shutdown_event.is_set():
+            logger.info({"shutdown": "in progress", "signal": signum})
+            return
         logger.info("shutdown")
         self.shutdown_event.set()
 
         loop = asyncio.get_event_loop()
-        loop.create_task(self.shutdown_sequence)
+        self.task = loop.create_task(self.shutdown_sequence())
@@ -1,260 +1,1216 @@
 import asyncio
 import logging
+import math
+import random
 import time
 import traceback
 from asyncio import Queue
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import aclosing
+from functools import partial
 
-from _cache import SimpleALRUCache
-from _kafka import consumer, producer
-from app.controllers.player import PlayerController
-from app.controllers.report import ReportController
+from _adaptive import AIMDController, Bounds
+from _batcher import Batch, Batcher
+from _cache import DimensionCaches, TTLCache, approx_size
+from _dedupe import WindowedBloomFilter
+from _kafka import consumer, dlq_producer, retry_producer
+from _lanes import LANE_KEYS, Router, partition_key
+from _metrics import SECONDS_BUCKETS, registry, serve_metrics
+from _offsets import Offset
+from _pipeline import OffloadPool, Pipeline, Stage
+from _sinks import (
+    ArchiveSink,
+    NormalizedSink,
+    Sink,
+    StagingSink,
+    sink_reports,
+    write_committed,
+)
+from _snapshot import (
+    BLOB_REF,
+    EXPIRES,
+    INT_VALUE,
+    Snapshot,
+    SnapshotWriter,
+    int_key,
+    text_key,
+)
+from aiokafka import ConsumerRecord, TopicPartition
+from app.controllers.ledger import LedgerController
+from app.controllers.player import PlayerController, UnresolvedPlayer
+from app.controllers.report import (
+    GEAR_KEYS,
+    LOCATION_KEYS,
+    SIGHTING_KEYS,
+    ReportController,
+    UnresolvedDimension,
+    report_key,
+)
+from app.views.player import PlayerInDB
 from app.views.report import (
-    ReportInQV1,
-    ReportInQV2,
-    StgReportCreate,
-    convert_report_q_to_db,
+    ReportRow,
     convert_stg_to_kafka_report,
+    decode_messages,
+    normalize_reports,
 )
+from core.config import settings
 from database.database import get_session
-from pydantic import ValidationError
-from sqlalchemy.exc import OperationalError
+from gracefull_shutdown import GracefulShutdown
+from sqlalchemy.exc import DBAPIError, OperationalError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 logger = logging.getLogger(__name__)
 
+# reports sent to the retry & dead letter topics
+requeue_counts = Counter()
+# messages that did not become a report, by reason
+drop_counts = Counter()
+# records from the retry topic waiting for their delay
+delayed: set[asyncio.Task] = set()
 
-class PlayerDoesNotExist(Exception):
-    ...
+messages_total = registry.counter(
+    "report_worker_messages_total", "Consumed messages by version", labels=("version",)
+)
+batch_size = registry.histogram(
+    "report_worker_batch_size",
+    "Reports per inserted batch",
+    buckets=(1, 10, 50, 100, 250, 500, 1_000, 2_500, 5_000, 10_000),
+)
+insert_seconds = registry.histogram(
+    "report_worker_insert_seconds",
+    "Duration of a committed batch insert transaction",
+    buckets=SECONDS_BUCKETS,
+)
 
 
-class ReporterDoesNotExist(PlayerDoesNotExist):
-    ...
+BATCH_SIZE = 1_000
+BATCH_MAX_BYTES = 2_000_000
+BATCH_MAX_AGE = 5
+MICRO_BATCH_SIZE = 100
+DIMENSION_CACHE_SIZE = 100_000
 
+# key encoder of the snapshot table of each cache
+SNAPSHOT_KEYS = {
+    "players": text_key(32),
+    "sighting": int_key(len(SIGHTING_KEYS)),
+    "gear": int_key(len(GEAR_KEYS)),
+    "location": int_key(len(LOCATION_KEYS)),
+}
 
-class ReportedDoesNotExist(PlayerDoesNotExist):
-    ...
+# mysql lock wait timeout & deadlock
+MYSQL_LOCK_ERRORS = (1205, 1213)
 
 
-async def create_batch(batch_size: int, batch_queue: Queue, report_queue: Queue):
-    batch = []
-    _time = time.time()
-    MAX_INTERVAL = 60
-    while True:
-        if report_queue.empty():
-            await asyncio.sleep(1)
-            continue
+def is_lock_error(error: DBAPIError) -> bool:
+    args = getattr(error.orig, "args", None)
+    return bool(args) and args[0] in MYSQL_LOCK_ERRORS
 
-        report = await report_queue.get()
-        report_queue.task_done()
 
-        batch.append(report)
+def shard(report: ReportRow, shards: int) -> int:
+    """
+    Route by sighting key, each sighting (and the report rows keyed on it)
+    is written by one writer. Gear & location rows are shared by sightings, so
+    writers can still meet on those, their inserts are INSERT IGNORE and lock
+    errors are retried.
+    """
+    return hash((report.reportingID, report.reportedID, report.manual_detect)) % shards
 
-        delta = _time - time.time()
-        if len(batch) == batch_size or delta > MAX_INTERVAL:
-            await batch_queue.put(batch)
-            batch = []
-            _time = time.time()
 
+def remember(reports: list[ReportRow], seen: WindowedBloomFilter) -> None:
+    if seen is None:
+        return
+    for report in reports:
+        seen.add(report_key(report))
 
-async def insert_batch(batch_queue: Queue, error_queue: Queue):
-    while True:
-        if batch_queue.empty():
-            await asyncio.sleep(1)
-            continue
-        batch = await batch_queue.get()
-        batch_queue.task_done()
+
+async def insert_reports(
+    reports: list[ReportRow],
+    offsets: list[Offset],
+    dimension_cache: DimensionCaches,
+    sinks: list[Sink],
+    seen: WindowedBloomFilter = None,
+) -> None:
+    """
+    Write the reports to the transactional sinks and their ledger entry in one
+    transaction, retried on deadlock & lock wait timeout, the committed keys are
+    added to seen and the reports handed to the other sinks.
+    """
+    offsets = [o for o in offsets if o is not None]
+    for attempt in range(settings.DB_LOCK_RETRIES + 1):
         try:
+            started_at = time.perf_counter()
             # Acquire an asynchronous database session
             session: AsyncSession = await get_session()
             async with session.begin():
-                report_controller = ReportController(session=session)
-                logger.debug(f"batch inserting: {len(batch)}")
-                # stage report
-                # await report_controller.insert(reports=batch)
-                # normalized report
-                await report_controller.insert_report(reports=batch)
+                ledger_controller = LedgerController(session=session)
+                if offsets and not await ledger_controller.insert(offsets=offsets):
+                    logger.info(f"batch already committed: {len(reports)}")
+                    remember(reports, seen)
+                    return
+
+                report_controller = ReportController(
+                    session=session, dimension_cache=dimension_cache
+                )
+                logger.debug(f"batch inserting: {len(reports)}")
+                for sink in sinks:
+                    if sink.transactional:
+                        await sink.write(reports, controller=report_controller)
                 await session.commit()
-                logger.debug("inserted")
-        except OperationalError as e:
-            logger.error({"error": e})
-            await asyncio.gather(
-                *[
-                    error_queue.put(convert_stg_to_kafka_report(m).model_dump())
-                    for m in batch
-                ]
+            insert_seconds.observe(time.perf_counter() - started_at)
+            for sink in sinks:
+                if sink.transactional:
+                    sink_reports.inc(len(reports), sink=sink.name)
+            await report_controller.cache_pending_ids()
+            remember(reports, seen)
+            logger.debug("inserted")
+            await write_committed(sinks, reports)
+            return
+        except DBAPIError as e:
+            if not is_lock_error(e) or attempt == settings.DB_LOCK_RETRIES:
+                raise
+            delay = 0.1 * 2**attempt + random.uniform(0, 0.1)
+            logger.warning({"error": e.orig, "attempt": attempt + 1, "delay": delay})
+            await asyncio.sleep(delay)
+
+
+def retry_message(msg: dict, attempt: int, error: Exception) -> dict:
+    delay = settings.RETRY_BASE_DELAY * 2 ** (attempt - 1)
+    retry = {"attempt": attempt, "not_before": time.time() + delay, "error": str(error)}
+    return {**msg, "retry": retry}
+
+
+def dead_letter_message(msg: dict, error: Exception) -> dict:
+    return {
+        "report": msg,
+        "error": str(error),
+        "error_type": type(error).__name__,
+        "failed_at": int(time.time()),
+    }
+
+
+async def dead_letter(msgs: list[dict], error: Exception) -> None:
+    """
+    Returns once the broker acknowledged the messages.
+    """
+    await dlq_producer.send_and_wait([dead_letter_message(m, error) for m in msgs])
+    requeue_counts["dead_letter"] += len(msgs)
+
+
+async def retry_later(msgs: list[dict], offsets: list[Offset], error: Exception):
+    """
+    Send the messages to the retry topic with an increasing delay, or to the
+    dead letter topic once RETRY_MAX_ATTEMPTS is reached. Returns once the
+    broker acknowledged them, only then can their offsets be committed.
+    """
+    retries, dead = [], []
+    for msg, offset in zip(msgs, offsets):
+        attempt = consumer.tracker.attempt(offset) + 1 if offset else 1
+        if attempt > settings.RETRY_MAX_ATTEMPTS:
+            dead.append(msg)
+            continue
+        retries.append(retry_message(msg, attempt, error))
+    await asyncio.gather(
+        retry_producer.send_and_wait(retries), dead_letter(dead, error=error)
+    )
+    requeue_counts["retry"] += len(retries)
+
+
+async def insert_bisect(
+    reports: list[ReportRow],
+    offsets: list[Offset],
+    dimension_cache: DimensionCaches,
+    sinks: list[Sink],
+    seen: WindowedBloomFilter = None,
+) -> None:
+    """
+    On failure the batch is split in halves until the bad reports are isolated,
+    the good halves are still committed.
+    """
+    try:
+        await insert_reports(
+            reports=reports,
+            offsets=offsets,
+            dimension_cache=dimension_cache,
+            sinks=sinks,
+            seen=seen,
+        )
+        return
+    # database error, e.g. connection lost, or a dimension row another writer
+    # inserted concurrently, retry the whole batch later
+    except (OperationalError, UnresolvedDimension) as e:
+        logger.error({"error": e, "reports": len(reports)})
+        msgs = [convert_stg_to_kafka_report(r).model_dump() for r in reports]
+        await retry_later(msgs=msgs, offsets=offsets, error=e)
+        await asyncio.sleep(5)
+        return
+    except Exception as e:
+        error = e
+        logger.debug(f"Traceback: \n{traceback.format_exc()}")
+
+    if len(reports) == 1:
+        logger.error({"error": error, "report": reports[0]})
+        msgs = [convert_stg_to_kafka_report(reports[0]).model_dump()]
+        await dead_letter(msgs, error=error)
+        return
+
+    logger.warning({"error": error, "bisect": len(reports)})
+    half = len(reports) // 2
+    await insert_bisect(reports[:half], offsets[:half], dimension_cache, sinks, seen)
+    await insert_bisect(reports[half:], offsets[half:], dimension_cache, sinks, seen)
+
+
+async def dead_letter_batch(reports: list[ReportRow], error: Exception) -> None:
+    """
+    Last resort for a batch that could neither be inserted nor requeued, when
+    the dead letter topic is not reachable either the reports are dropped, a
+    partition can not be committed past offsets that are never done.
+    """
+    try:
+        msgs = [convert_stg_to_kafka_report(r).model_dump() for r in reports]
+        await dead_letter(msgs, error=error)
+    except Exception as e:
+        drop_counts["error"] += len(reports)
+        logger.error({"error": e, "dropped": len(reports)})
+
+
+async def insert_batch(
+    batches: list[Batch],
+    dimension_cache: DimensionCaches,
+    sinks: list[Sink],
+    seen: WindowedBloomFilter = None,
+):
+    for batch in batches:
+        batch_size.observe(len(batch.items))
+        # a batch can consist of dropped duplicates only
+        if batch.items:
+            try:
+                await insert_bisect(
+                    reports=batch.items,
+                    offsets=batch.offsets,
+                    dimension_cache=dimension_cache,
+                    sinks=sinks,
+                    seen=seen,
+                )
+            except Exception as e:
+                logger.error({"error": e, "reports": len(batch.items)})
+                logger.debug(f"Traceback: \n{traceback.format_exc()}")
+                await dead_letter_batch(batch.items, error=e)
+        # the reports are in the database or acknowledged by the broker
+        offsets = batch.offsets + batch.dropped_offsets
+        consumer.tracker.done([o for o in offsets if o is not None])
+        await consumer.commit()
+
+
+def get_router(pipeline: Pipeline) -> Router | None:
+    return next((s for s in pipeline.stages if isinstance(s, Router)), None)
+
+
+def lane_lag(pipeline: Pipeline, router: Router) -> dict[int, int]:
+    """
+    Records a lane is behind, the kafka lag of its partitions when lanes are
+    keyed by partition, otherwise every lane reads every partition and its lag
+    is the records waiting in its queues.
+    """
+    if router.key_fn is partition_key:
+        lag = Counter({i: 0 for i in range(len(router.lanes))})
+        for tp, n in consumer.lag().items():
+            lag[router.lane(tp.partition)] += n
+        return lag
+    depths = pipeline.depths()
+    return {
+        i: depths[f"process-{i}"] + depths[f"batch-{i}"]
+        for i in range(len(router.lanes))
+    }
+
+
+async def report_stats(
+    pipeline: Pipeline,
+    player_cache: TTLCache,
+    dimension_cache: DimensionCaches,
+    seen: WindowedBloomFilter,
+    batchers: list[Batcher],
+    interval: int,
+):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(
+            {
+                "queue_depth": pipeline.depths(),
+                "pool_busy": pipeline.busy(),
+                "retry_producer_queue_depth": retry_producer.get_queue().qsize(),
+                "dlq_producer_queue_depth": dlq_producer.get_queue().qsize(),
+                "offsets_in_flight": consumer.tracker.in_flight(),
+                "consumer_pauses": consumer.pauses,
+                "consumer_paused_seconds": round(consumer.paused_duration(), 3),
+            }
+        )
+        logger.info({"player_cache": player_cache.stats()})
+        logger.info({"dimension_cache": dimension_cache.stats()})
+        logger.info({"dedupe": seen.stats()})
+        logger.info({"requeued": dict(requeue_counts)})
+        logger.info({"dropped": dict(drop_counts)})
+        if router := get_router(pipeline):
+            logger.info(
+                {
+                    "lane_records": dict(router.routed),
+                    "lane_lag": dict(lane_lag(pipeline, router)),
+                }
             )
-            await asyncio.sleep(5)
-        except Exception as e:
-            logger.error({"error": e})
-            logger.debug(f"Traceback: \n{traceback.format_exc()}")
-            await asyncio.gather(
-                *[
-                    error_queue.put(convert_stg_to_kafka_report(m).model_dump())
-                    for m in batch
-                ]
+        for batcher in batchers:
+            logger.info(
+                {
+                    "stage": batcher.name,
+                    "batches": dict(batcher.flush_reasons),
+                    "batched_reports": batcher.flushed_items,
+                    "duplicates": dict(batcher.duplicates),
+                }
             )
-            await asyncio.sleep(5)
 
 
-async def process_msg_v1(
-    msg: ReportInQV1, player_controller: PlayerController
-) -> StgReportCreate:
+def register_metrics(
+    pipeline: Pipeline,
+    player_cache: TTLCache,
+    dimension_cache: DimensionCaches,
+    seen: WindowedBloomFilter,
+    batchers: list[Batcher],
+):
+    """
+    Expose the state report_stats logs on the metrics endpoint.
+    """
+
+    def queue_depths() -> dict:
+        return {
+            **pipeline.depths(),
+            "retry_producer": retry_producer.get_queue().qsize(),
+            "dlq_producer": dlq_producer.get_queue().qsize(),
+        }
+
+    def cache_stats() -> dict:
+        return {"player": player_cache.stats(), **dimension_cache.stats()}
+
+    registry.collect(
+        "report_worker_queue_depth",
+        "Items waiting in the queue of a stage or producer",
+        "gauge",
+        queue_depths,
+        labels=("queue",),
+    )
+    registry.collect(
+        "report_worker_batch_size_limit",
+        "Reports at which a batch is flushed, set by the adaptive controller",
+        "gauge",
+        lambda: {(): batchers[0].max_records},
+    )
+    registry.collect(
+        "report_worker_stage_tasks",
+        "Tasks of a pipeline stage",
+        "gauge",
+        lambda: {s.name: s.workers for s in pipeline.stages},
+        labels=("stage",),
+    )
+    registry.collect(
+        "report_worker_pool_busy",
+        "Workers of an executor pool that are running a call",
+        "gauge",
+        pipeline.busy,
+        labels=("pool",),
+    )
+    registry.collect(
+        "report_worker_offsets_in_flight",
+        "Consumed offsets that are not committed yet",
+        "gauge",
+        lambda: {(): consumer.tracker.in_flight()},
+    )
+    registry.collect(
+        "report_worker_consumer_paused",
+        "1 while fetching is paused for backpressure",
+        "gauge",
+        lambda: {(): int(consumer.paused_at is not None)},
+    )
+    registry.collect(
+        "report_worker_consumer_pauses_total",
+        "Times fetching was paused for backpressure",
+        "counter",
+        lambda: {(): consumer.pauses},
+    )
+    registry.collect(
+        "report_worker_consumer_paused_seconds_total",
+        "Seconds fetching was paused for backpressure",
+        "counter",
+        lambda: {(): consumer.paused_duration()},
+    )
+    if router := get_router(pipeline):
+        registry.collect(
+            "report_worker_lane_records_total",
+            "Consumed records routed to a lane",
+            "counter",
+            lambda: router.routed,
+            labels=("lane",),
+        )
+        registry.collect(
+            "report_worker_lane_lag",
+            "Records a lane is behind",
+            "gauge",
+            partial(lane_lag, pipeline, router),
+            labels=("lane",),
+        )
+    registry.collect(
+        "report_worker_dropped_total",
+        "Messages that did not become a report, by reason",
+        "counter",
+        lambda: drop_counts,
+        labels=("reason",),
+    )
+    registry.collect(
+        "report_worker_requeued_total",
+        "Reports sent to the retry or dead letter topic",
+        "counter",
+        lambda: requeue_counts,
+        labels=("topic",),
+    )
+    registry.collect(
+        "report_worker_batches_total",
+        "Flushed batches by batcher and flush reason",
+        "counter",
+        lambda: {
+            (b.name, reason): n
+            for b in batchers
+            for reason, n in b.flush_reasons.items()
+        },
+        labels=("batcher", "reason"),
+    )
+    registry.collect(
+        "report_worker_duplicates_total",
+        "Dropped duplicate reports, by where the key was found",
+        "counter",
+        lambda: {(b.name, k): n for b in batchers for k, n in b.duplicates.items()},
+        labels=("batcher", "found_in"),
+    )
+    registry.collect(
+        "report_worker_dedupe_fp_rate",
+        "Estimated false positive rate of the duplicate filter",
+        "gauge",
+        lambda: {(): seen.stats()["fp_rate"]},
+    )
+    registry.collect(
+        "report_worker_cache_lookups_total",
+        "Cache lookups by result",
+        "counter",
+        lambda: {
+            (cache, result): stats[result]
+            for cache, stats in cache_stats().items()
+            for result in ("hits", "negative_hits", "snapshot_hits", "misses")
+            if result in stats
+        },
+        labels=("cache", "result"),
+    )
+    registry.collect(
+        "report_worker_cache_hit_ratio",
+        "Cache hits over lookups",
+        "gauge",
+        lambda: {cache: stats["hit_ratio"] for cache, stats in cache_stats().items()},
+        labels=("cache",),
+    )
+    registry.collect(
+        "report_worker_cache_entries",
+        "Entries in the cache",
+        "gauge",
+        lambda: {cache: stats["size"] for cache, stats in cache_stats().items()},
+        labels=("cache",),
+    )
+
+
+async def process_msgs_v1(
+    msgs: list[dict], player_controller: PlayerController
+) -> list[dict | None]:
+    """
+    Resolve all reporter & reported names of a micro batch of validated v1
+    messages in one session, returns a v2 shaped message or None for every message
+    """
+    player_names = [n for msg in msgs for n in (msg["reporter"], msg["reported"])]
+
     # Acquire an asynchronous database session
     session: AsyncSession = await get_session()
     async with session.begin():
         await player_controller.update_session(session=session)
-        reporter = await player_controller.get_or_insert(player_name=msg.reporter)
-        reported = await player_controller.get_or_insert(player_name=msg.reported)
+        players = await player_controller.get_or_insert_many(player_names=player_names)
+    player_controller.cache_pending()
 
-    # double check reporter & reported
-    if reporter is None:
-        logger.error(f"reporter does not exist: '{msg.reporter}'")
-        raise ReporterDoesNotExist()
+    v2_msgs = []
+    for msg in msgs:
+        reporter = players.get(player_controller.sanitize_name(msg["reporter"]))
+        reported = players.get(player_controller.sanitize_name(msg["reported"]))
 
-    if reported is None:
-        logger.error(f"reported does not exist: '{msg.reported}'")
-        raise ReportedDoesNotExist
-    report = convert_report_q_to_db(
-        reported_id=reported.id,
-        reporting_id=reporter.id,
-        report_in_queue=msg,
-    )
-    return report
+        # double check reporter & reported
+        if reporter is None:
+            logger.error(f"reporter does not exist: '{msg['reporter']}'")
+            v2_msgs.append(None)
+            continue
 
+        if reported is None:
+            logger.error(f"reported does not exist: '{msg['reported']}'")
+            v2_msgs.append(None)
+            continue
 
-async def process_msg_v2(msg: ReportInQV2) -> StgReportCreate:
-    # If the timestamp is too large, assume it's in milliseconds and convert to seconds
-    if msg.ts > 10**10:
-        msg.ts = msg.ts / 1000
+        v2_msg = {k: v for k, v in msg.items() if k not in ("reporter", "reported")}
+        v2_msg.update(reporter_id=reporter.id, reported_id=reported.id)
+        v2_msgs.append(v2_msg)
+    return v2_msgs
 
-    if msg.ts > 1735736400:
-        logger.warning(f"{msg.ts=} > 2025-01-01, {msg=}")
-        return None
 
-    if msg.ts < 1577883600:
-        logger.warning(f"{msg.ts=} < 2020-01-01, {msg=}")
-        return None
+async def process_data(
+    records: list[ConsumerRecord],
+    report_queues: list[Queue],
+    player_cache: TTLCache,
+    decode_pool: OffloadPool = None,
+):
+    """
+    Convert kafka messages to Reports, put (offset, Report) into the report_queues,
+    the messages are decoded on the decode_pool if there is one.
+    The offsets of the records that are not handed on are always released, also
+    when the micro batch fails, a partition can not be committed past them.
+    """
+    player_controller = PlayerController(cache=player_cache)
 
-    gmt = time.gmtime(msg.ts)
-    human_time = time.strftime("%Y-%m-%d %H:%M:%S", gmt)
-    human_time = datetime.fromtimestamp(msg.ts)
-
-    equipment = msg.equipment.model_dump()
-    item_bug = 0
-
-    for k, v in equipment.items():
-        if v > 32767:
-            setattr(msg.equipment, k, 0)
-            item_bug = 1
-
-    if item_bug:
-        logger.warning(equipment)
-
-    report = StgReportCreate(
-        reportedID=msg.reported_id,
-        reportingID=msg.reporter_id,
-        timestamp=human_time,
-        region_id=msg.region_id,
-        x_coord=msg.x_coord,
-        y_coord=msg.y_coord,
-        z_coord=msg.z_coord,
-        manual_detect=bool(msg.manual_detect),
-        on_members_world=msg.on_members_world,
-        on_pvp_world=bool(msg.on_pvp_world),
-        world_number=msg.world_number,
-        equip_head_id=msg.equipment.equip_head_id,
-        equip_amulet_id=msg.equipment.equip_amulet_id,
-        equip_torso_id=msg.equipment.equip_torso_id,
-        equip_legs_id=msg.equipment.equip_legs_id,
-        equip_boots_id=msg.equipment.equip_boots_id,
-        equip_cape_id=msg.equipment.equip_cape_id,
-        equip_hands_id=msg.equipment.equip_hands_id,
-        equip_weapon_id=msg.equipment.equip_weapon_id,
-        equip_shield_id=msg.equipment.equip_shield_id,
-        equip_ge_value=msg.equip_ge_value,
-    )
-    return report
-
-
-async def process_data(report_queue: Queue, player_cache: SimpleALRUCache):
-    """
-    Convert kafka messages to Reports, put Reports into the report_Queue
-    """
-    receive_queue = consumer.get_queue()
-    error_queue = producer.get_queue()
+    offsets = [(TopicPartition(r.topic, r.partition), r.offset) for r in records]
+    # offsets that stay in flight, put on a report queue or delayed
+    handed: set[Offset] = set()
+    # offsets of the records that were dropped or requeued
+    done: set[Offset] = set()
+    try:
+        await process_records(
+            records=records,
+            report_queues=report_queues,
+            player_controller=player_controller,
+            decode_pool=decode_pool,
+            handed=handed,
+            done=done,
+        )
+    except asyncio.CancelledError:
+        # shutdown, the records are consumed again after the restart
+        handed.update(offsets)
+        raise
+    except Exception as e:
+        failed = [o for o in offsets if o not in handed and o not in done]
+        drop_counts["error"] += len(failed)
+        logger.error({"error": e, "failed": len(failed)})
+        logger.debug(f"Traceback: \n{traceback.format_exc()}")
+    finally:
+        consumer.tracker.done([o for o in offsets if o not in handed])
 
-    player_controller = PlayerController(cache=player_cache)
 
-    while True:
-        # Check if both queues are empty
-        if receive_queue.empty():
-            await asyncio.sleep(1)
+async def process_records(
+    records: list[ConsumerRecord],
+    report_queues: list[Queue],
+    player_controller: PlayerController,
+    decode_pool: OffloadPool,
+    handed: set[Offset],
+    done: set[Offset],
+):
+    """
+    The work of process_data, adds the offsets that stay in flight to handed
+    and those of dropped or requeued records to done.
+    """
+    pending: list[tuple[Offset, ConsumerRecord]] = []
+    for record in records:
+        offset = (TopicPartition(record.topic, record.partition), record.offset)
+        if consumer.ledger.contains(*offset):
+            drop_counts["committed"] += 1
+            done.add(offset)
             continue
+        pending.append((offset, record))
 
-        raw_msg: dict = await receive_queue.get()
-        receive_queue.task_done()
+    values = [record.value for _, record in pending]
+    if decode_pool is None:
+        decoded, drops = decode_messages(values)
+    else:
+        decoded, drops = await decode_pool.run(decode_messages, values)
+    drop_counts.update(drops)
 
-        msg_metadata: dict = raw_msg.get("metadata")
-        msg_version = msg_metadata.get("version") if msg_metadata else None
+    v1_msgs: list[tuple[Offset, dict]] = []
+    reports: list[tuple[Offset, ReportRow]] = []
+    for (offset, record), (kind, retry, version, payload) in zip(pending, decoded):
+        if retry:
+            consumer.tracker.attempts[offset] = retry["attempt"]
+        if kind == "delay":
+            handed.add(offset)
+            task = asyncio.create_task(
+                redeliver(record, retry["not_before"] - time.time())
+            )
+            delayed.add(task)
+            task.add_done_callback(delayed.discard)
+            continue
 
+        messages_total.inc(version=version or "none")
+        if kind == "v1":
+            v1_msgs.append((offset, payload))
+        elif kind == "v2":
+            reports.append((offset, payload))
+        else:
+            done.add(offset)
+
+    if v1_msgs:
+        v2_msgs: list[tuple[Offset, dict]] = []
         try:
-            if msg_version in [None, "v1.0.0"]:
-                msg = ReportInQV1(**raw_msg)
-                report = await process_msg_v1(
-                    msg=msg, player_controller=player_controller
-                )
-            elif msg_version in ["v2.0.0"]:
-                msg = ReportInQV2(**raw_msg)
-                report = await process_msg_v2(msg=msg)
-        except (ReporterDoesNotExist, ReportedDoesNotExist):
-            continue
-        # pydantic error
-        except ValidationError as e:
+            resolved = await process_msgs_v1(
+                msgs=[msg for _, msg in v1_msgs],
+                player_controller=player_controller,
+            )
+            for (offset, _), msg in zip(v1_msgs, resolved):
+                if msg is None:
+                    drop_counts["player"] += 1
+                    done.add(offset)
+                else:
+                    v2_msgs.append((offset, msg))
+        # database error, or a player another writer inserted concurrently
+        except (OperationalError, UnresolvedPlayer) as e:
+            logger.error({"error": e})
+            await retry_later(
+                msgs=[msg for _, msg in v1_msgs],
+                offsets=[offset for offset, _ in v1_msgs],
+                error=e,
+            )
+            done.update(offset for offset, _ in v1_msgs)
+            await asyncio.sleep(5)
+        # e.g. DataError, retrying does not help
+        except DBAPIError as e:
             logger.error({"error": e})
-        # database error
+            await dead_letter([msg for _, msg in v1_msgs], error=e)
+            done.update(offset for offset, _ in v1_msgs)
+
+        keep, rows, drops = normalize_reports([msg for _, msg in v2_msgs])
+        drop_counts.update(drops)
+        kept = set(keep)
+        done.update(offset for i, (offset, _) in enumerate(v2_msgs) if i not in kept)
+        reports.extend((v2_msgs[i][0], row) for i, row in zip(keep, rows))
+
+    for offset, report in reports:
+        handed.add(offset)
+        await report_queues[shard(report, len(report_queues))].put((offset, report))
+
+
+async def redeliver(record: ConsumerRecord, delay: float):
+    """
+    Put a record from the retry topic back on the receive queue once it is due,
+    its offset stays in flight until then.
+    """
+    await asyncio.sleep(delay)
+    await consumer.get_queue().put(record)
+
+
+async def load_ledger(partitions: list[TopicPartition]):
+    """
+    Load the recently committed offsets of the assigned partitions, so replayed
+    records are skipped.
+    """
+    session: AsyncSession = await get_session()
+    async with session.begin():
+        ledger_controller = LedgerController(session=session)
+        ranges = await ledger_controller.get(
+            partitions=partitions, minutes=settings.LEDGER_RETENTION_MINUTES
+        )
+    for tp, _ranges in ranges.items():
+        consumer.ledger.load(tp, _ranges)
+    logger.info({"ledger": {str(tp): len(r) for tp, r in ranges.items()}})
+
+
+async def prune_ledger(interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            session: AsyncSession = await get_session()
+            async with session.begin():
+                ledger_controller = LedgerController(session=session)
+                pruned = await ledger_controller.prune(
+                    minutes=settings.LEDGER_RETENTION_MINUTES
+                )
+            logger.info({"ledger_pruned": pruned})
         except OperationalError as e:
-            await error_queue.put(raw_msg)
             logger.error({"error": e})
-            await asyncio.sleep(5)
-        if report is None:
+
+
+async def warm_up(player_cache: TTLCache, dimension_cache: DimensionCaches):
+    """
+    Load the players & dimension ids of the most recent sightings into the caches
+    with a few streaming selects, within WARMUP_SECONDS and WARMUP_MAX_BYTES.
+    """
+    started_at = time.monotonic()
+    loaded = Counter()
+    nbytes = 0
+
+    session: AsyncSession = await get_session()
+    try:
+        async with asyncio.timeout(settings.WARMUP_SECONDS), session.begin():
+            player_controller = PlayerController(session=session, cache=player_cache)
+            partitions = player_controller.stream_recent(
+                sightings=settings.WARMUP_SIGHTINGS
+            )
+            async with aclosing(partitions):
+                async for players in partitions:
+                    for name, player in players.items():
+                        player_cache.put(key=name, value=player)
+                        nbytes += approx_size(name, player)
+                    loaded["players"] += len(players)
+                    if nbytes >= settings.WARMUP_MAX_BYTES:
+                        break
+
+            report_controller = ReportController(
+                session=session, dimension_cache=dimension_cache
+            )
+            for name, cache in dimension_cache.items():
+                if nbytes >= settings.WARMUP_MAX_BYTES:
+                    break
+                partitions = report_controller.stream_recent_dimension(
+                    dimension=name,
+                    limit=min(settings.WARMUP_SIGHTINGS, cache.max_size),
+                )
+                async with aclosing(partitions):
+                    async for ids in partitions:
+                        for key, _id in ids.items():
+                            await cache.put(key=key, value=_id)
+                            nbytes += approx_size(key, _id)
+                        loaded[name] += len(ids)
+                        if nbytes >= settings.WARMUP_MAX_BYTES:
+                            break
+    except TimeoutError:
+        logger.warning("cache warm up stopped at the time budget")
+    finally:
+        await session.close()
+
+    logger.info(
+        {
+            "warm_up": dict(loaded),
+            "nbytes": nbytes,
+            "seconds": round(time.monotonic() - started_at, 3),
+        }
+    )
+
+
+def load_snapshot(
+    path: str, player_cache: TTLCache, dimension_cache: DimensionCaches
+) -> Snapshot | None:
+    """
+    Map the snapshot and use it as backing of the caches, entries are only
+    decoded when a lookup misses the cache.
+    """
+    try:
+        snapshot = Snapshot(path, max_age=settings.SNAPSHOT_MAX_AGE)
+    # also InvalidSnapshot
+    except (OSError, ValueError) as e:
+        logger.warning({"snapshot": path, "error": e})
+        return None
+
+    def decode_player(value: bytes) -> tuple[PlayerInDB, float | None]:
+        player = PlayerInDB.model_validate_json(snapshot.blob(value[: BLOB_REF.size]))
+        (expires_at,) = EXPIRES.unpack(value[BLOB_REF.size :])
+        return player, None if math.isnan(expires_at) else expires_at
+
+    def decode_id(value: bytes) -> int:
+        return INT_VALUE.unpack(value)[0]
+
+    player_cache.backing = snapshot.view(
+        "players", SNAPSHOT_KEYS["players"], decode_player
+    )
+    for name, cache in dimension_cache.items():
+        cache.backing = snapshot.view(name, SNAPSHOT_KEYS[name], decode_id)
+
+    logger.info(
+        {
+            "snapshot": path,
+            "age": round(time.time() - snapshot.built_at),
+            "entries": {name: len(t) for name, t in snapshot.tables.items()},
+        }
+    )
+    return snapshot
+
+
+def write_snapshot(
+    path: str,
+    players: list[tuple[str, PlayerInDB, float | None]],
+    dimensions: dict[str, list[tuple[tuple, int]]],
+) -> None:
+    writer = SnapshotWriter()
+
+    encode = SNAPSHOT_KEYS["players"]
+    records = {}
+    for name, player, expires_at in players:
+        key = encode(name)
+        if key is None:
             continue
-        await report_queue.put(report)
+        ref = writer.add_blob(player.model_dump_json(warnings=False).encode())
+        records[key] = ref + EXPIRES.pack(
+            math.nan if expires_at is None else expires_at
+        )
+    writer.add_table("players", encode.size, BLOB_REF.size + EXPIRES.size, records)
 
+    for name, items in dimensions.items():
+        encode = SNAPSHOT_KEYS[name]
+        records = {encode(key): INT_VALUE.pack(_id) for key, _id in items}
+        writer.add_table(name, encode.size, INT_VALUE.size, records)
 
-async def main():
-    report_queue = Queue(maxsize=1_000)
-    batch_queue = Queue(maxsize=10)
-    BATCH_SIZE = 1_000
+    writer.write(path)
+
+
+async def save_snapshot(
+    path: str, player_cache: TTLCache, dimension_cache: DimensionCaches
+):
+    """
+    Write the live cache entries to the snapshot, the encoding and writing
+    happens in a thread.
+    """
+    started_at = time.monotonic()
+    players = player_cache.items()
+    dimensions = {
+        name: list(cache.cache.items()) for name, cache in dimension_cache.items()
+    }
+    try:
+        await asyncio.to_thread(write_snapshot, path, players, dimensions)
+    except OSError as e:
+        logger.error({"snapshot": path, "error": e})
+        return
+    logger.info(
+        {
+            "snapshot": path,
+            "players": len(players),
+            **{name: len(items) for name, items in dimensions.items()},
+            "seconds": round(time.monotonic() - started_at, 3),
+        }
+    )
 
-    await producer.start_engine(topic="report")
-    await consumer.start_engine(topics=["report"])
 
-    player_cache = SimpleALRUCache()
+async def save_snapshots(
+    path: str, interval: int, player_cache: TTLCache, dimension_cache: DimensionCaches
+):
+    while True:
+        await asyncio.sleep(interval)
+        await save_snapshot(path, player_cache, dimension_cache)
 
-    for _ in range(5):
-        asyncio.create_task(
-            process_data(
-                report_queue=report_queue,
-                player_cache=player_cache,
+
+def build_decode_pool(executor: str | None, workers: int) -> OffloadPool | None:
+    if not executor:
+        return None
+    if executor == "thread":
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
+    elif executor == "process":
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError(f"unknown DECODE_EXECUTOR: {executor}")
+    return OffloadPool(name="decode", executor=pool, workers=workers)
+
+
+def build_sinks(names: str) -> list[Sink]:
+    sinks = []
+    for name in names.split(","):
+        name = name.strip()
+        if name == "normalized":
+            sink = NormalizedSink(
+                insert_mode=settings.REPORT_INSERT_MODE,
+                load_data_min_rows=settings.LOAD_DATA_MIN_ROWS,
+                load_data_dir=settings.LOAD_DATA_DIR,
             )
+        elif name == "staging":
+            sink = StagingSink()
+        elif name == "archive":
+            if not settings.ARCHIVE_DIR:
+                raise ValueError("the archive sink needs ARCHIVE_DIR")
+            sink = ArchiveSink(
+                directory=settings.ARCHIVE_DIR,
+                max_bytes=settings.ARCHIVE_MAX_BYTES,
+                max_age=settings.ARCHIVE_MAX_AGE,
+                compression=settings.ARCHIVE_COMPRESSION,
+            )
+        else:
+            raise ValueError(f"unknown sink: {name}")
+        sinks.append(sink)
+    return sinks
+
+
+def build_writer(
+    index: int,
+    dimension_cache: DimensionCaches,
+    seen: WindowedBloomFilter,
+    sinks: list[Sink],
+    batch_size: int,
+    batch_max_age: float,
+) -> tuple[Batcher, Stage]:
+    """
+    batch-i -> insert-i
+    """
+    insert_stage = Stage(
+        name=f"insert-{index}",
+        maxsize=10,
+        handler=partial(
+            insert_batch, dimension_cache=dimension_cache, sinks=sinks, seen=seen
+        ),
+    )
+    batcher = Batcher(
+        name=f"batch-{index}",
+        maxsize=1_000,
+        out_queue=insert_stage.in_queue,
+        max_records=batch_size,
+        max_bytes=BATCH_MAX_BYTES,
+        max_age=batch_max_age,
+        key_fn=report_key,
+        seen=seen,
+    )
+    return batcher, insert_stage
+
+
+def build_lanes(
+    player_cache: TTLCache,
+    dimension_cache: DimensionCaches,
+    seen: WindowedBloomFilter,
+    sinks: list[Sink],
+    batch_size: int,
+    batch_max_age: float,
+    decode_pool: OffloadPool = None,
+) -> tuple[Pipeline, list[Batcher]]:
+    """
+    consumer queue -> route -> process-i -> batch-i -> insert-i, one lane per
+    LANE_KEY hash, each with a single process task & its own batch
+    """
+    if settings.LANE_KEY not in LANE_KEYS:
+        raise ValueError(f"unknown LANE_KEY: {settings.LANE_KEY}")
+
+    process_stages: list[Stage] = []
+    batchers: list[Batcher] = []
+    insert_stages: list[Stage] = []
+    for i in range(settings.LANES):
+        batcher, insert_stage = build_writer(
+            i, dimension_cache, seen, sinks, batch_size, batch_max_age
         )
-    asyncio.create_task(
-        create_batch(
-            batch_size=BATCH_SIZE,
-            batch_queue=batch_queue,
-            report_queue=report_queue,
+        process_stage = Stage(
+            name=f"process-{i}",
+            maxsize=500,
+            max_items=MICRO_BATCH_SIZE,
+            handler=partial(
+                process_data,
+                report_queues=[batcher.in_queue],
+                player_cache=player_cache,
+                decode_pool=decode_pool,
+            ),
         )
+        process_stages.append(process_stage)
+        batchers.append(batcher)
+        insert_stages.append(insert_stage)
+
+    router = Router(
+        in_queue=consumer.get_queue(),
+        lanes=[s.in_queue for s in process_stages],
+        key_fn=LANE_KEYS[settings.LANE_KEY],
     )
-    asyncio.create_task(
-        insert_batch(
-            batch_queue=batch_queue,
-            error_queue=producer.send_queue,
+    pipeline = Pipeline(
+        stages=[router, *process_stages, *batchers, *insert_stages],
+        pools=[decode_pool] if decode_pool else [],
+    )
+    return pipeline, batchers
+
+
+def build_pipeline(
+    player_cache: TTLCache,
+    dimension_cache: DimensionCaches,
+    seen: WindowedBloomFilter,
+    batch_size: int = BATCH_SIZE,
+    batch_max_age: float = BATCH_MAX_AGE,
+    sinks: list[Sink] = None,
+) -> tuple[Pipeline, list[Batcher]]:
+    """
+    consumer queue -> process -> batch-i -> insert-i, one batcher & writer per shard,
+    or partition affine lanes if LANES is set, the sinks of SINKS if not given
+    """
+    if sinks is None:
+        sinks = build_sinks(settings.SINKS)
+    decode_pool = build_decode_pool(settings.DECODE_EXECUTOR, settings.DECODE_WORKERS)
+    if settings.LANES:
+        return build_lanes(
+            player_cache=player_cache,
+            dimension_cache=dimension_cache,
+            seen=seen,
+            sinks=sinks,
+            batch_size=batch_size,
+            batch_max_age=batch_max_age,
+            decode_pool=decode_pool,
         )
+
+    batchers: list[Batcher] = []
+    insert_stages: list[Stage] = []
+    for i in range(settings.DB_WRITERS):
+        batcher, insert_stage = build_writer(
+            i, dimension_cache, seen, sinks, batch_size, batch_max_age
+        )
+        batchers.append(batcher)
+        insert_stages.append(insert_stage)
+
+    process_stage = Stage(
+        name="process",
+        in_queue=consumer.get_queue(),
+        workers=5,
+        max_items=MICRO_BATCH_SIZE,
+        handler=partial(
+            process_data,
+            report_queues=[b.in_queue for b in batchers],
+            player_cache=player_cache,
+            decode_pool=decode_pool,
+        ),
+    )
+    pipeline = Pipeline(
+        stages=[process_stage, *batchers, *insert_stages],
+        pools=[decode_pool] if decode_pool else [],
     )
+    return pipeline, batchers
 
-    while True:
-        await asyncio.sleep(60)
+
+def insert_latency() -> tuple[float, int]:
+    """
+    (sum, count) of the insert transaction durations so far.
+    """
+    _, total, count = insert_seconds.values.get((), (None, 0.0, 0))
+    return total, count
+
+
+def build_controller(pipeline: Pipeline, batchers: list[Batcher]) -> AIMDController:
+    stages = {stage.name: stage for stage in pipeline.stages}
+    task_bounds = Bounds(settings.PROCESS_TASKS_MIN, settings.PROCESS_TASKS_MAX)
+    process_stage = stages.get("process")
+    # lanes keep a single task each, only the batch size is adapted
+    if process_stage is None:
+        process_stage = stages["route"]
+        task_bounds = Bounds(1, 1)
+    return AIMDController(
+        process_stage=process_stage,
+        batchers=batchers,
+        insert_stages=[s for name, s in stages.items() if name.startswith("insert-")],
+        insert_latency=insert_latency,
+        target_seconds=settings.ADAPT_TARGET_SECONDS,
+        batch_bounds=Bounds(settings.BATCH_SIZE_MIN, settings.BATCH_SIZE_MAX),
+        task_bounds=task_bounds,
+    )
+
+
+async def drain(pipeline: Pipeline, timeout: float) -> None:
+    """
+    Shutdown sequence, stop consuming, finish the records in the pipeline incl.
+    the partial batches, send the requeued reports and commit, within timeout
+    seconds. Records that are not done are abandoned, they are consumed again
+    after the restart.
+    """
+    started_at = time.monotonic()
+    producers = (retry_producer, dlq_producer)
+    consumer.stop_consuming()
+    # records from the retry topic that are not due yet
+    for task in list(delayed):
+        task.cancel()
+
+    try:
+        async with asyncio.timeout(timeout):
+            await pipeline.drain()
+            while any(not p.get_queue().empty() for p in producers):
+                await asyncio.sleep(0.1)
+    except TimeoutError:
+        logger.warning({"shutdown": "deadline passed", "timeout": timeout})
+
+    unsent = sum(p.get_queue().qsize() for p in producers)
+    for producer in producers:
+        await producer.stop_engine()
+    await consumer.commit()
+    abandoned = consumer.tracker.in_flight()
+    await consumer.stop_engine()
+    logger.info(
+        {
+            "shutdown_seconds": round(time.monotonic() - started_at, 3),
+            "abandoned": abandoned,
+            "unsent": unsent,
+        }
+    )
+
+
+async def main():
+    player_cache = TTLCache(
+        max_bytes=settings.PLAYER_CACHE_MAX_BYTES,
+        ttl=settings.PLAYER_CACHE_TTL,
+        negative_ttl=settings.PLAYER_CACHE_NEGATIVE_TTL,
+    )
+    dimension_cache = DimensionCaches(max_size=DIMENSION_CACHE_SIZE)
+    snapshot = None
+    if settings.SNAPSHOT_PATH:
+        snapshot = load_snapshot(settings.SNAPSHOT_PATH, player_cache, dimension_cache)
+    # the snapshot is cheaper than the database
+    if settings.WARMUP and snapshot is None:
+        await warm_up(player_cache=player_cache, dimension_cache=dimension_cache)
+
+    consumer.on_assign.append(load_ledger)
+    await retry_producer.start_engine(topic=settings.RETRY_TOPIC)
+    await dlq_producer.start_engine(topic=settings.DLQ_TOPIC)
+    await consumer.start_engine(topics=[settings.REPORT_TOPIC, settings.RETRY_TOPIC])
+
+    # primary keys of recently committed reports
+    seen = WindowedBloomFilter(
+        window=settings.DEDUPE_WINDOW,
+        capacity=settings.DEDUPE_CAPACITY,
+        fp_rate=settings.DEDUPE_FP_RATE,
+    )
+    sinks = build_sinks(settings.SINKS)
+    pipeline, batchers = build_pipeline(
+        player_cache=player_cache,
+        dimension_cache=dimension_cache,
+        seen=seen,
+        sinks=sinks,
+    )
+    pipeline.start()
+    register_metrics(
+        pipeline=pipeline,
+        player_cache=player_cache,
+        dimension_cache=dimension_cache,
+        seen=seen,
+        batchers=batchers,
+    )
+    if settings.METRICS_PORT:
+        await serve_metrics(port=settings.METRICS_PORT, host=settings.METRICS_HOST)
+    asyncio.create_task(prune_ledger(interval=600))
+    if settings.ADAPTIVE:
+        controller = build_controller(pipeline, batchers)
+        asyncio.create_task(controller.run(interval=settings.ADAPT_INTERVAL))
+    for sink in sinks:
+        if isinstance(sink, ArchiveSink):
+            asyncio.create_task(sink.run(interval=min(60, sink.max_age)))
+    if settings.SNAPSHOT_PATH and settings.SNAPSHOT_WRITE:
+        asyncio.create_task(
+            save_snapshots(
+                path=settings.SNAPSHOT_PATH,
+                interval=settings.SNAPSHOT_INTERVAL,
+                player_cache=player_cache,
+                dimension_cache=dimension_cache,
+            )
+        )
+
+    shutdown_event = asyncio.Event()
+    shutdown = GracefulShutdown(
+        shutdown_event=shutdown_event,
+        shutdown_sequence=partial(
+            drain, pipeline=pipeline, timeout=settings.SHUTDOWN_TIMEOUT
+        ),
+    )
+    stats = asyncio.create_task(
+        report_stats(
+            pipeline=pipeline,
+            player_cache=player_cache,
+            dimension_cache=dimension_cache,
+            seen=seen,
+            batchers=batchers,
+            interval=60,
+        )
+    )
+    try:
+        await shutdown_event.wait()
+        await shutdown.task
+    finally:
+        stats.cancel()
+        await pipeline.stop()
+        for sink in sinks:
+            await sink.close()
+        if settings.SNAPSHOT_PATH and settings.SNAPSHOT_WRITE:
+            await save_snapshot(settings.SNAPSHOT_PATH, player_cache, dimension_cache)
 
 
 if __name__ == "__main__":
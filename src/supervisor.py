@@ -0,0 +1,205 @@
+"""
+Runs WORKER_PROCESSES copies of main.py in forked processes, every one joins the
+report-worker consumer group, so kafka spreads the partitions over them.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+import main
+from _metrics import Registry, merge, scrape, serve_metrics
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# a worker that ran shorter than this counts as crash looping
+MIN_UPTIME = 60
+MAX_RESTART_DELAY = 60
+# "<quota> <period>" or "max <period>" in microseconds, cgroup v2
+CPU_MAX = "/sys/fs/cgroup/cpu.max"
+
+registry = Registry()
+restarts_total = registry.counter(
+    "report_worker_restarts_total", "Restarts of crashed workers", labels=("worker",)
+)
+
+
+def default_processes() -> int:
+    """
+    The cpus this process may run on, capped by the cpu quota of its cgroup,
+    os.cpu_count() is the cpus of the host also in a container.
+    """
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        with open(CPU_MAX) as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def run_worker(index: int, metrics_port: int, inherited: tuple = ()) -> None:
+    """
+    Entry point of a worker process, SIGTERM drains & ends main(), or is a
+    KeyboardInterrupt until main() handles it.
+    inherited are the fds of the supervisor's listening sockets.
+    """
+    # a worker that is restarted is forked after the metrics server started
+    for fd in inherited:
+        os.close(fd)
+    # the supervisor loop set a wakeup fd & handlers that the fork inherited
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    settings.METRICS_HOST = "127.0.0.1"
+    settings.METRICS_PORT = metrics_port
+    settings.SNAPSHOT_WRITE = index == 0
+    try:
+        asyncio.run(main.main())
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    def __init__(self, processes: int, metrics_port: int = 0):
+        self.processes = processes
+        # workers serve their metrics on the ports after metrics_port
+        self.metrics_port = metrics_port
+        self.context = multiprocessing.get_context("fork")
+        self.workers: dict[int, multiprocessing.Process] = {}
+        self.started_at: dict[int, float] = {}
+        # consecutive short lived runs of a worker
+        self.crashes: dict[int, int] = {}
+        self.restart_at: dict[int, float] = {}
+        # metrics server of the supervisor, its sockets are closed in the workers
+        self.server: asyncio.Server = None
+        registry.collect(
+            "report_worker_processes",
+            "Running worker processes",
+            "gauge",
+            lambda: {(): sum(p.is_alive() for p in self.workers.values())},
+        )
+
+    def worker_port(self, index: int) -> int:
+        return self.metrics_port + 1 + index if self.metrics_port else 0
+
+    def start_worker(self, index: int) -> None:
+        inherited = ()
+        if self.server is not None:
+            inherited = tuple(s.fileno() for s in self.server.sockets)
+        process = self.context.Process(
+            target=run_worker,
+            name=f"report-worker-{index}",
+            args=(index, self.worker_port(index), inherited),
+        )
+        process.start()
+        self.workers[index] = process
+        self.started_at[index] = time.monotonic()
+        self.restart_at.pop(index, None)
+        logger.info({"worker": index, "pid": process.pid, "started": True})
+
+    def start(self) -> None:
+        for index in range(self.processes):
+            self.start_worker(index)
+
+    def check(self) -> None:
+        """
+        Schedule a restart for exited workers, with a backoff when they crash loop.
+        """
+        now = time.monotonic()
+        for index, process in self.workers.items():
+            if process.exitcode is None:
+                continue
+            if index in self.restart_at:
+                if now >= self.restart_at[index]:
+                    restarts_total.inc(worker=index)
+                    self.start_worker(index)
+                continue
+
+            uptime = now - self.started_at[index]
+            if uptime < MIN_UPTIME:
+                self.crashes[index] = self.crashes.get(index, 0) + 1
+            else:
+                self.crashes[index] = 0
+            delay = min(MAX_RESTART_DELAY, 2 ** self.crashes[index] - 1)
+            self.restart_at[index] = now + delay
+            logger.error(
+                {
+                    "worker": index,
+                    "pid": process.pid,
+                    "exitcode": process.exitcode,
+                    "uptime": round(uptime, 1),
+                    "restart_in": delay,
+                }
+            )
+
+    async def watch(self, interval: float = 1) -> None:
+        while True:
+            self.check()
+            await asyncio.sleep(interval)
+
+    async def render(self) -> str:
+        """
+        The supervisor metrics & those of every worker, labeled with worker="i".
+        """
+        indexes = [i for i, p in self.workers.items() if p.is_alive()]
+        results = await asyncio.gather(
+            *(scrape("127.0.0.1", self.worker_port(i)) for i in indexes),
+            return_exceptions=True,
+        )
+        texts = {}
+        for index, result in zip(indexes, results):
+            if isinstance(result, Exception):
+                # e.g. a worker that is still starting
+                logger.warning({"worker": index, "scrape": result})
+                continue
+            texts[str(index)] = result
+        return registry.render() + merge(texts, label="worker")
+
+    async def stop(self, timeout: float = 30) -> None:
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for index, process in self.workers.items():
+            await asyncio.to_thread(process.join, max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning({"worker": index, "pid": process.pid, "killed": True})
+                process.kill()
+                await asyncio.to_thread(process.join)
+
+
+async def supervise():
+    processes = settings.WORKER_PROCESSES or default_processes()
+    supervisor = Supervisor(processes=processes, metrics_port=settings.METRICS_PORT)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    supervisor.start()
+    if settings.METRICS_PORT:
+        supervisor.server = await serve_metrics(
+            port=settings.METRICS_PORT,
+            host=settings.METRICS_HOST,
+            render=supervisor.render,
+        )
+    watcher = asyncio.create_task(supervisor.watch())
+    try:
+        await stop.wait()
+    finally:
+        watcher.cancel()
+        logger.info("stopping workers")
+        await supervisor.stop(timeout=settings.SHUTDOWN_TIMEOUT + 10)
+
+
+if __name__ == "__main__":
+    asyncio.run(supervise())
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from _adaptive import AIMDController, Bounds
+from _batcher import Batcher
+from _pipeline import Stage
+
+
+async def noop(items):
+    await asyncio.sleep(0)
+
+
+def get_controller(latency: list) -> AIMDController:
+    process = Stage(name="process", handler=noop, maxsize=10, workers=4)
+    insert = Stage(name="insert-0", handler=noop, maxsize=10)
+    batcher = Batcher(
+        out_queue=insert.in_queue, max_records=1_000, max_bytes=10**9, max_age=1
+    )
+    return AIMDController(
+        process_stage=process,
+        batchers=[batcher],
+        insert_stages=[insert],
+        insert_latency=lambda: tuple(latency),
+        target_seconds=1.0,
+        batch_bounds=Bounds(100, 2_000),
+        task_bounds=Bounds(1, 8),
+    )
+
+
+@pytest.mark.asyncio
+async def test_decrease_on_latency():
+    latency = [0.0, 0]
+    controller = get_controller(latency)
+    controller.process_stage.start()
+
+    latency[:] = [6.0, 3]
+    controller.step()
+    assert (controller.batch_size, controller.tasks) == (500, 2)
+    assert controller.batchers[0].max_records == 500
+
+    # the extra tasks finish after their current items
+    for _ in range(4):
+        controller.process_stage.in_queue.put_nowait(None)
+    await controller.process_stage.in_queue.join()
+    await asyncio.sleep(0)
+    assert sorted(controller.process_stage.tasks) == [0, 1]
+    await controller.process_stage.stop()
+
+
+@pytest.mark.asyncio
+async def test_increase_with_headroom():
+    latency = [0.0, 0]
+    controller = get_controller(latency)
+    controller.batchers[0].flush_reasons["records"] += 1
+    for _ in range(6):
+        controller.process_stage.in_queue.put_nowait(None)
+
+    latency[:] = [0.5, 2]
+    controller.step()
+    assert (controller.batch_size, controller.tasks) == (1_100, 5)
+    assert sorted(controller.process_stage.tasks) == [0, 1, 2, 3, 4]
+    await controller.process_stage.stop()
+
+
+def test_no_change_without_signal():
+    controller = get_controller([0.0, 0])
+    controller.step()
+    assert controller.adjustments == 0
@@ -0,0 +1,95 @@
+import pytest
+from _kafka import ReportConsumer, RebalanceListener
+from aiokafka import TopicPartition
+
+TPS = [TopicPartition("report", 0), TopicPartition("report", 1)]
+
+
+class FakeConsumer:
+    def __init__(self, assigned):
+        self.assigned = set(assigned)
+        self.paused_partitions = set()
+
+    def assignment(self):
+        return set(self.assigned)
+
+    def pause(self, *partitions):
+        self.paused_partitions.update(partitions)
+
+    def resume(self, *partitions):
+        self.paused_partitions.difference_update(partitions)
+
+    def paused(self):
+        return set(self.paused_partitions)
+
+
+@pytest.mark.asyncio
+async def test_pause_above_high_resume_at_low_watermark():
+    engine = ReportConsumer(
+        bootstrap_servers=["kafka"],
+        group_id="test",
+        high_watermark=4,
+        low_watermark=2,
+    )
+    engine.consumer = FakeConsumer(TPS)
+
+    for offset in range(3):
+        engine.tracker.track(TPS[0], offset)
+        engine.check_backpressure()
+    assert engine.paused_at is None
+
+    engine.tracker.track(TPS[0], 3)
+    engine.check_backpressure()
+    assert engine.consumer.paused() == set(TPS)
+    assert engine.pauses == 1
+
+    engine.tracker.done([(TPS[0], 0)])
+    engine.check_backpressure()
+    assert engine.consumer.paused() == set(TPS)
+
+    engine.tracker.done([(TPS[0], 1)])
+    engine.check_backpressure()
+    assert engine.consumer.paused() == set()
+    assert engine.paused_at is None
+    assert engine.paused_duration() == engine.paused_seconds > 0
+
+
+@pytest.mark.asyncio
+async def test_partitions_assigned_while_paused_stay_paused():
+    engine = ReportConsumer(
+        bootstrap_servers=["kafka"],
+        group_id="test",
+        high_watermark=1,
+        low_watermark=0,
+    )
+    engine.consumer = FakeConsumer(TPS[:1])
+    engine.tracker.track(TPS[0], 0)
+    engine.check_backpressure()
+
+    engine.consumer.assigned.add(TPS[1])
+    await RebalanceListener(engine).on_partitions_assigned({TPS[1]})
+    assert engine.consumer.paused() == set(TPS)
+
+
+@pytest.mark.asyncio
+async def test_disabled_without_high_watermark():
+    engine = ReportConsumer(bootstrap_servers=["kafka"], group_id="test")
+    engine.consumer = FakeConsumer(TPS)
+    engine.tracker.track(TPS[0], 0)
+    engine.check_backpressure()
+    assert engine.pauses == 0
+
+
+@pytest.mark.asyncio
+async def test_stop_consuming_is_not_resumed():
+    engine = ReportConsumer(
+        bootstrap_servers=["kafka"],
+        group_id="test",
+        high_watermark=4,
+        low_watermark=2,
+    )
+    engine.consumer = FakeConsumer(TPS)
+    engine.stop_consuming()
+    engine.check_backpressure()
+    assert engine.consumer.paused() == set(TPS)
+    assert engine.pauses == 0
@@ -0,0 +1,77 @@
+import asyncio
+from asyncio import Queue
+
+import pytest
+from _batcher import Batcher
+
+
+def get_batcher(max_records=10, max_bytes=1_000, max_age=60) -> Batcher:
+    return Batcher(
+        in_queue=Queue(),
+        out_queue=Queue(),
+        max_records=max_records,
+        max_bytes=max_bytes,
+        max_age=max_age,
+        size_fn=lambda item: item,
+    )
+
+
+@pytest.mark.asyncio
+async def test_flush_on_records():
+    batcher = get_batcher(max_records=3)
+    task = asyncio.create_task(batcher.run())
+    for offset in range(3):
+        await batcher.in_queue.put((offset, 1))
+
+    batch = await asyncio.wait_for(batcher.out_queue.get(), 1)
+    task.cancel()
+
+    assert batch.items == [1, 1, 1]
+    assert batch.offsets == [0, 1, 2]
+    assert batch.reason == "records"
+
+
+@pytest.mark.asyncio
+async def test_flush_on_bytes():
+    batcher = get_batcher(max_bytes=100)
+    task = asyncio.create_task(batcher.run())
+    await batcher.in_queue.put((None, 60))
+    await batcher.in_queue.put((None, 60))
+
+    batch = await asyncio.wait_for(batcher.out_queue.get(), 1)
+    task.cancel()
+
+    assert batch.items == [60, 60]
+    assert batch.reason == "bytes"
+
+
+@pytest.mark.asyncio
+async def test_flush_on_age():
+    batcher = get_batcher(max_age=0.05)
+    task = asyncio.create_task(batcher.run())
+    await batcher.in_queue.put((None, 1))
+
+    batch = await asyncio.wait_for(batcher.out_queue.get(), 1)
+    task.cancel()
+
+    assert batch.items == [1]
+    assert batch.reason == "age"
+    assert batcher.flush_reasons == {"age": 1}
+
+
+@pytest.mark.asyncio
+async def test_drop_duplicates():
+    batcher = get_batcher(max_records=2)
+    batcher.key_fn = lambda item: item
+    batcher.seen = {3}
+    task = asyncio.create_task(batcher.run())
+    for offset, item in enumerate([1, 1, 3, 2]):
+        await batcher.in_queue.put((offset, item))
+
+    batch = await asyncio.wait_for(batcher.out_queue.get(), 1)
+    task.cancel()
+
+    assert batch.items == [1, 2]
+    assert batch.offsets == [0, 3]
+    assert batch.dropped_offsets == [1, 2]
+    assert batcher.duplicates == {"batch": 1, "window": 1}
@@ -0,0 +1,37 @@
+import time
+
+from _cache import NEGATIVE, TTLCache
+
+
+def test_evicts_least_recently_used_over_max_bytes():
+    cache = TTLCache(max_bytes=3, size_fn=lambda key, value: 1)
+    for key in "abc":
+        cache.put(key, key)
+    assert cache.get("a") == "a"
+
+    cache.put("d", "d")
+    assert cache.get("b") is None
+    assert cache.get("a") == "a"
+    assert cache.nbytes == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_expire(monkeypatch):
+    now = time.monotonic()
+    cache = TTLCache(ttl=10, negative_ttl=1)
+    cache.put("a", 1)
+    cache.put_negative("b")
+    assert cache.get("b") is NEGATIVE
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 5)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["negative_hits"] == 1
+    assert stats["expirations"] == 2
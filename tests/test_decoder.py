@@ -0,0 +1,146 @@
+import json
+import pickle
+import time
+from datetime import datetime
+
+import pytest
+from app.views.report import (
+    SchemaMismatch,
+    check_report_v2,
+    decode_messages,
+    normalize_reports,
+)
+
+
+def get_msg(**kwargs) -> dict:
+    msg = {
+        "reporter_id": 1,
+        "reported_id": 2,
+        "region_id": 14652,
+        "x_coord": 3682,
+        "y_coord": 3851,
+        "z_coord": 0,
+        "ts": 1704223737,
+        "manual_detect": 0,
+        "on_members_world": 1,
+        "on_pvp_world": 0,
+        "world_number": 330,
+        "equipment": {
+            "equip_head_id": 13592,
+            "equip_amulet_id": None,
+            "equip_torso_id": 13596,
+            "equip_legs_id": 40000,
+            "equip_boots_id": 13598,
+            "equip_cape_id": 13594,
+            "equip_hands_id": 13599,
+            "equip_weapon_id": 1381,
+            "equip_shield_id": None,
+        },
+        "equip_ge_value": 0,
+        "metadata": {"version": "v2.0.0"},
+    }
+    msg.update(kwargs)
+    return msg
+
+
+def test_normalize_matches_pydantic():
+    # x_coord is coerced by ReportInQV2 before the message is normalized
+    decoded, drops = decode_messages([get_msg(), get_msg(x_coord="3682")])
+
+    assert [d.kind for d in decoded] == ["v2", "v2"]
+    assert decoded[0].payload == decoded[1].payload
+    assert drops == {}
+
+
+def test_normalize_clamps_gear():
+    _, rows, _ = normalize_reports([get_msg()])
+    assert rows[0].equip_legs_id == 0
+    assert rows[0].equip_amulet_id is None
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{"reporter_id": "1"}, {"x_coord": 1.5}, {"equipment": None}]
+)
+def test_check_mismatch(kwargs):
+    with pytest.raises(SchemaMismatch):
+        check_report_v2(get_msg(**kwargs))
+
+
+def test_normalize_reports():
+    msgs = [
+        get_msg(),
+        get_msg(ts=1234),
+        get_msg(ts=1704223737000, manual_detect=1),
+        get_msg(ts=1835736400),
+        get_msg(equipment={}),
+    ]
+    keep, rows, drops = normalize_reports(msgs)
+
+    assert keep == [0, 2, 4]
+    assert drops == {"ts_past": 1, "ts_future": 1}
+    assert {r.timestamp for r in rows} == {datetime.fromtimestamp(1704223737)}
+    assert [r.reportingID for r in rows] == [1, 1, 1]
+    assert type(rows[0].equip_head_id) is int
+    assert rows[1].manual_detect is True
+    assert rows[2].equip_head_id is None
+
+
+def test_decode_messages():
+    v1 = {k: v for k, v in get_msg().items() if k not in ("reporter_id", "reported_id")}
+    v1.update(reporter="Player_1", reported="player2", metadata=None)
+    retry = {"attempt": 2, "not_before": time.time() + 60}
+    values = [
+        json.dumps(get_msg()).encode(),
+        get_msg(ts=1234),
+        v1,
+        get_msg(metadata={"version": "v3.0.0"}),
+        get_msg(reporter_id="x"),
+        {**get_msg(), "retry": retry},
+    ]
+    decoded, drops = decode_messages(values)
+
+    assert [d.kind for d in decoded] == ["v2", "drop", "v1", "drop", "drop", "delay"]
+    assert decoded[0].payload == normalize_reports([get_msg()])[1][0]
+    assert decoded[2].payload["reporter"] == "Player_1"
+    assert decoded[5].retry == retry
+    assert drops == {"ts_past": 1, "version": 1, "invalid": 1}
+    # results cross the boundary of a process pool
+    assert pickle.loads(pickle.dumps(decoded)) == decoded
+
+
+def test_decode_messages_malformed():
+    values = [b"{not json", json.dumps([1, 2]).encode(), {1: 2}, get_msg()]
+    decoded, drops = decode_messages(values)
+
+    assert [d.kind for d in decoded] == ["drop", "drop", "drop", "v2"]
+    assert drops == {"malformed": 3}
+
+
+@pytest.mark.asyncio
+async def test_failed_micro_batch_releases_offsets(monkeypatch):
+    import main
+    from aiokafka import ConsumerRecord, TopicPartition
+
+    async def process_records(records, handed, done, **kwargs):
+        handed.add((TopicPartition("report", 0), 1))
+        done.add((TopicPartition("report", 0), 2))
+        raise RuntimeError("boom")
+
+    tracker = main.consumer.tracker
+    tp = TopicPartition("report", 0)
+    records = [
+        ConsumerRecord("report", 0, offset, 0, 0, None, {}, None, 0, 0, [])
+        for offset in range(3)
+    ]
+    for record in records:
+        tracker.track(tp, record.offset)
+    monkeypatch.setattr(main, "process_records", process_records)
+    errors = main.drop_counts["error"]
+    try:
+        await main.process_data(records, report_queues=[], player_cache=None)
+
+        # the handed on record is still in flight, the others are released
+        assert tracker.committable() == {tp: 1}
+        assert main.drop_counts["error"] == errors + 1
+    finally:
+        tracker.forget([tp])
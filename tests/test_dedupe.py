@@ -0,0 +1,32 @@
+import time
+
+from _dedupe import BloomFilter, WindowedBloomFilter
+
+
+def test_bloom_filter_fp_rate():
+    bloom = BloomFilter(capacity=10_000, fp_rate=0.01)
+    for i in range(10_000):
+        bloom.add((i, i))
+
+    assert all((i, i) in bloom for i in range(10_000))
+    false_positives = sum((i, -i) in bloom for i in range(1, 10_001))
+    assert false_positives < 200
+    assert 0.005 < bloom.fp_rate() < 0.02
+
+
+def test_windowed_bloom_filter_forgets(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    seen = WindowedBloomFilter(window=10, capacity=100, fp_rate=0.01)
+    seen.add("a")
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 15)
+    seen.add("b")
+    assert "a" in seen
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 26)
+    assert "a" not in seen
+    assert "b" in seen
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 100)
+    assert "b" not in seen
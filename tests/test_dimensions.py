@@ -0,0 +1,56 @@
+import pytest
+from app.controllers.report import (
+    DIMENSIONS,
+    ReportController,
+    UnresolvedDimension,
+)
+
+
+class Session:
+    async def execute(self, sql, params=None):
+        # INSERT IGNORE, the row of the concurrent writer wins
+        pass
+
+
+class Reports(ReportController):
+    """
+    committed holds the rows of another writer, committed after the snapshot
+    of this transaction, only a locking read sees them.
+    """
+
+    def __init__(self, committed: dict):
+        super().__init__(session=Session())
+        self.committed = committed
+        self.locks = []
+
+    async def _select_dimension(self, id_column, columns, keys, lock=False):
+        self.locks.append(lock)
+        if not lock:
+            return {}
+        return {k: self.committed[k] for k in keys if k in self.committed}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_insert_is_resolved_by_locking_read():
+    controller = Reports(committed={(1, 2, 0, 0): 7})
+    ids = await controller._get_or_insert_dimension(
+        controller.dimension_cache.location,
+        *DIMENSIONS["location"],
+        keys={(1, 2, 0, 0)},
+    )
+
+    assert ids == {(1, 2, 0, 0): 7}
+    assert controller.locks == [False, True]
+
+
+@pytest.mark.asyncio
+async def test_unresolved_dimension_raises():
+    controller = Reports(committed={})
+    with pytest.raises(UnresolvedDimension):
+        await controller._get_or_insert_dimension(
+            controller.dimension_cache.location,
+            *DIMENSIONS["location"],
+            keys={(1, 2, 0, 0)},
+        )
+    # nothing is cached for a batch that is retried
+    assert controller.pending_ids == []
@@ -0,0 +1,50 @@
+import asyncio
+from asyncio import Queue
+
+import pytest
+from _lanes import Router, partition_key, reporter_key
+from aiokafka import ConsumerRecord
+
+
+def record(partition: int, offset: int, value=None) -> ConsumerRecord:
+    return ConsumerRecord(
+        topic="report",
+        partition=partition,
+        offset=offset,
+        timestamp=0,
+        timestamp_type=0,
+        key=None,
+        value=value,
+        checksum=None,
+        serialized_key_size=0,
+        serialized_value_size=0,
+        headers=(),
+    )
+
+
+@pytest.mark.asyncio
+async def test_partition_lanes_keep_order():
+    lanes = [Queue() for _ in range(3)]
+    router = Router(lanes=lanes, key_fn=partition_key)
+    router.start()
+    for offset in range(4):
+        for partition in range(6):
+            await router.in_queue.put(record(partition, offset))
+    await router.in_queue.join()
+    await asyncio.sleep(0)
+    await router.stop()
+
+    for i, lane in enumerate(lanes):
+        records = [lane.get_nowait() for _ in range(lane.qsize())]
+        assert {r.partition % 3 for r in records} == {i}
+        for partition in {r.partition for r in records}:
+            offsets = [r.offset for r in records if r.partition == partition]
+            assert offsets == sorted(offsets)
+    assert router.routed == {0: 8, 1: 8, 2: 8}
+
+
+def test_reporter_key():
+    assert reporter_key(record(1, 0, {"reporter_id": 7})) == 7
+    assert reporter_key(record(1, 0, {"reporter": "name"})) == "name"
+    # not decoded yet
+    assert reporter_key(record(1, 0, b"{}")) == 1
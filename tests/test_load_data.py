@@ -0,0 +1,66 @@
+import asyncio
+from datetime import datetime
+
+from app.controllers.report import ReportController, to_tsv
+from app.views.report import ReportRow
+
+
+def get_report(**kwargs) -> ReportRow:
+    report = ReportRow(
+        reportedID=2,
+        reportingID=1,
+        region_id=14652,
+        x_coord=3682,
+        y_coord=3851,
+        z_coord=0,
+        timestamp=datetime(2024, 1, 2, 19, 28, 57),
+        manual_detect=False,
+        on_members_world=1,
+        on_pvp_world=True,
+        world_number=330,
+        equip_head_id=13592,
+    )
+    return report._replace(**kwargs)
+
+
+def test_to_tsv():
+    tsv = to_tsv([get_report(), get_report(reportingID=3, manual_detect=True)])
+    assert tsv.decode().splitlines() == [
+        "1\t2\t0\t13592" + "\t\\N" * 8 + "\t14652\t3682\t3851\t0"
+        "\t2024-01-02 19:28:57\t1\t1\t330",
+        "3\t2\t1\t13592" + "\t\\N" * 8 + "\t14652\t3682\t3851\t0"
+        "\t2024-01-02 19:28:57\t1\t1\t330",
+    ]
+
+
+class Connection:
+    info = {"temp_report": "clean"}
+
+
+class Session:
+    def __init__(self):
+        self.executed = []
+
+    async def connection(self):
+        return Connection()
+
+    async def execute(self, sql, params=None):
+        if "LOAD DATA" in str(sql):
+            with open(params["path"], "rb") as f:
+                params = f.read()
+        self.executed.append((str(sql).split()[0], params))
+
+
+def test_stage_with_load_data(tmp_path):
+    session = Session()
+    controller = ReportController(session=session)
+    reports = [get_report()]
+    asyncio.run(
+        controller.insert_report_temp_table(
+            reports, load_data=True, load_data_dir=str(tmp_path)
+        )
+    )
+
+    assert session.executed == [("LOAD", to_tsv(reports)), ("CALL", None)]
+    # the file is removed once loaded
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,84 @@
+import asyncio
+from collections import Counter
+
+import pytest
+from _metrics import Registry
+
+
+def test_render_prometheus_text():
+    registry = Registry()
+    messages = registry.counter("messages_total", "Messages", labels=("version",))
+    latency = registry.histogram("insert_seconds", "Inserts", buckets=(0.1, 1))
+    drops = Counter(ts_past=2)
+    registry.collect(
+        "dropped_total", "Drops", "counter", lambda: drops, labels=("reason",)
+    )
+
+    messages.inc(version="v2.0.0")
+    messages.inc(2, version="v2.0.0")
+    for value in (0.05, 0.1, 0.5, 5):
+        latency.observe(value)
+
+    assert registry.render().splitlines() == [
+        "# HELP messages_total Messages",
+        "# TYPE messages_total counter",
+        'messages_total{version="v2.0.0"} 3',
+        "# HELP insert_seconds Inserts",
+        "# TYPE insert_seconds histogram",
+        'insert_seconds_bucket{le="0.1"} 2',
+        'insert_seconds_bucket{le="1.0"} 3',
+        'insert_seconds_bucket{le="+Inf"} 4',
+        "insert_seconds_sum 5.65",
+        "insert_seconds_count 4",
+        "# HELP dropped_total Drops",
+        "# TYPE dropped_total counter",
+        'dropped_total{reason="ts_past"} 2',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_serve_metrics():
+    from _metrics import registry, serve_metrics
+
+    registry.gauge("up", "Up").set(1)
+    server = await serve_metrics(port=0, host="127.0.0.1")
+    port = server.sockets[0].getsockname()[1]
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    response = await reader.read()
+    writer.close()
+    server.close()
+
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert b"\nup 1\n" in response
+
+
+def test_merge_worker_metrics():
+    from _metrics import merge
+
+    worker = Registry()
+    messages = worker.counter("messages_total", "Messages", labels=("version",))
+    latency = worker.histogram("insert_seconds", "Inserts", buckets=(1,))
+    messages.inc(version="v2.0.0")
+    latency.observe(0.5)
+    first = worker.render()
+    messages.inc(version="v2.0.0")
+    second = worker.render()
+
+    assert merge({"0": first, "1": second}, label="worker").splitlines() == [
+        "# HELP messages_total Messages",
+        "# TYPE messages_total counter",
+        'messages_total{version="v2.0.0",worker="0"} 1',
+        'messages_total{version="v2.0.0",worker="1"} 2',
+        "# HELP insert_seconds Inserts",
+        "# TYPE insert_seconds histogram",
+        'insert_seconds_bucket{le="1.0",worker="0"} 1',
+        'insert_seconds_bucket{le="+Inf",worker="0"} 1',
+        'insert_seconds_sum{worker="0"} 0.5',
+        'insert_seconds_count{worker="0"} 1',
+        'insert_seconds_bucket{le="1.0",worker="1"} 1',
+        'insert_seconds_bucket{le="+Inf",worker="1"} 1',
+        'insert_seconds_sum{worker="1"} 0.5',
+        'insert_seconds_count{worker="1"} 1',
+    ]
@@ -0,0 +1,78 @@
+from _offsets import CommittedOffsets, OffsetTracker, fingerprint, to_ranges
+from aiokafka import TopicPartition
+
+TP = TopicPartition("report", 0)
+
+
+def test_to_ranges():
+    assert to_ranges([5, 1, 2, 3, 7, 8]) == [(1, 3), (5, 5), (7, 8)]
+
+
+def test_commit_waits_for_lowest_pending_offset():
+    tracker = OffsetTracker()
+    for offset in range(5):
+        tracker.track(TP, offset)
+
+    tracker.done([(TP, 1), (TP, 2)])
+    assert tracker.committable() == {TP: 0}
+
+    tracker.done([(TP, 0)])
+    assert tracker.committable() == {TP: 3}
+
+    tracker.committed({TP: 3})
+    tracker.done([(TP, 3), (TP, 4)])
+    assert tracker.committable() == {TP: 5}
+    assert tracker.in_flight() == 0
+
+
+def test_late_done_after_revoke_and_reassign():
+    tracker = OffsetTracker()
+    for offset in range(10, 15):
+        tracker.track(TP, offset)
+    tracker.forget([TP])
+
+    # re-assigned, consumed from the last commit of the other owner
+    for offset in range(20, 23):
+        tracker.track(TP, offset)
+    # batches of the old assignment finish late
+    tracker.done([(TP, 10), (TP, 11), (TP, 12)])
+    assert tracker.in_flight() == 3
+    assert tracker.committable() == {TP: 20}
+
+    tracker.done([(TP, 20), (TP, 21), (TP, 22)])
+    assert tracker.in_flight() == 0
+    assert tracker.committable() == {TP: 23}
+
+
+def test_nothing_to_commit_after_commit():
+    tracker = OffsetTracker()
+    tracker.track(TP, 0)
+    tracker.done([(TP, 0)])
+    tracker.committed(tracker.committable())
+    assert tracker.committable() == {}
+
+
+def test_committed_offsets():
+    ledger = CommittedOffsets()
+    ledger.load(TP, [(10, 20), (1, 3)])
+    assert ledger.contains(TP, 2)
+    assert ledger.contains(TP, 20)
+    assert not ledger.contains(TP, 5)
+    assert not ledger.contains(TopicPartition("report", 1), 2)
+
+
+def test_fingerprint_ignores_order():
+    other = TopicPartition("report", 1)
+    assert fingerprint([(TP, 1), (other, 2)]) == fingerprint([(other, 2), (TP, 1)])
+    assert fingerprint([(TP, 1)]) != fingerprint([(TP, 2)])
+
+
+def test_next_offset():
+    tracker = OffsetTracker()
+    assert tracker.next_offset(TP) is None
+    for offset in range(3):
+        tracker.track(TP, offset)
+    tracker.done([(TP, 0), (TP, 2)])
+    assert tracker.next_offset(TP) == 1
+    tracker.done([(TP, 1)])
+    assert tracker.next_offset(TP) == 3
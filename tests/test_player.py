@@ -0,0 +1,75 @@
+from datetime import datetime
+
+import pytest
+from _cache import NEGATIVE, TTLCache
+from app.controllers.player import PlayerController, UnresolvedPlayer
+from app.views.player import PlayerInDB
+
+
+def get_player(id: int, name: str) -> PlayerInDB:
+    return PlayerInDB(
+        id=id, name=name, created_at=datetime(2024, 1, 1), updated_at=None
+    )
+
+
+class Players(PlayerController):
+    """
+    concurrent holds the players another writer committed after the snapshot of
+    this transaction, only a locking read sees them.
+    """
+
+    def __init__(self, cache: TTLCache, existing: dict, concurrent: dict = None):
+        super().__init__(cache=cache)
+        self.existing = existing
+        self.concurrent = concurrent or {}
+
+    async def get_many(self, player_names: list[str], lock: bool = False):
+        visible = {**self.existing, **self.concurrent} if lock else self.existing
+        return {n: visible[n] for n in player_names if n in visible}
+
+    async def insert_many(self, players) -> None:
+        for player in players:
+            # the unique key ignores a name longer than 50 with a taken prefix
+            if player.name in self.concurrent or len(player.name) > 50:
+                continue
+            self.existing[player.name] = get_player(len(self.existing) + 1, player.name)
+
+
+@pytest.mark.asyncio
+async def test_players_are_cached_after_commit():
+    cache = TTLCache()
+    controller = Players(cache=cache, existing={})
+
+    players = await controller.get_or_insert_many(["new_player", "x" * 60])
+    assert list(players) == ["new player"]
+    # the transaction did not commit yet
+    assert cache.get(key="new player") is None
+
+    controller.cache_pending()
+    assert cache.get(key="new player") == players["new player"]
+    assert cache.get(key="x" * 60) is NEGATIVE
+
+
+@pytest.mark.asyncio
+async def test_concurrently_inserted_player_is_found():
+    cache = TTLCache()
+    player = get_player(7, "new player")
+    controller = Players(cache=cache, existing={}, concurrent={"new player": player})
+
+    players = await controller.get_or_insert_many(["new_player"])
+    assert players == {"new player": player}
+
+
+@pytest.mark.asyncio
+async def test_unresolved_player_is_not_negative_cached():
+    cache = TTLCache()
+    controller = Players(cache=cache, existing={})
+
+    async def insert_many(players):
+        pass
+
+    controller.insert_many = insert_many
+    with pytest.raises(UnresolvedPlayer):
+        await controller.get_or_insert_many(["new_player"])
+    controller.cache_pending()
+    assert cache.get(key="new player") is None
@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime
+
+import _kafka
+import main
+import pytest
+from _batcher import Batch
+from _kafka import ReportProducer
+from aiokafka import TopicPartition
+from aiokafka.errors import KafkaError
+from app.views.report import ReportRow
+
+TP = TopicPartition("report", 0)
+
+
+class FakeProducer:
+    def __init__(self, **kwargs):
+        self.acks = []
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def send(self, topic, value):
+        ack = asyncio.get_running_loop().create_future()
+        self.acks.append(ack)
+        return ack
+
+
+@pytest.mark.asyncio
+async def test_send_resolves_after_the_ack(monkeypatch):
+    monkeypatch.setattr(_kafka, "AIOKafkaProducer", FakeProducer)
+    producer = ReportProducer(bootstrap_servers=[], queue_size=10)
+    task = asyncio.create_task(producer.produce_messages("report-retry"))
+
+    delivered = await producer.send({"a": 1})
+    await asyncio.sleep(0.01)
+    assert not delivered.done()
+
+    producer.producer.acks[0].set_result("metadata")
+    assert await delivered == "metadata"
+
+    pending = await producer.send({"a": 2})
+    await producer.stop_engine()
+    await task
+    with pytest.raises(KafkaError):
+        await pending
+
+
+@pytest.mark.asyncio
+async def test_offsets_are_done_when_the_insert_fails(monkeypatch):
+    sent = []
+
+    async def insert_bisect(**kwargs):
+        raise RuntimeError("boom")
+
+    async def send_and_wait(values):
+        sent.extend(values)
+
+    report = ReportRow(
+        reportedID=1,
+        reportingID=2,
+        region_id=1,
+        x_coord=2,
+        y_coord=3,
+        z_coord=0,
+        timestamp=datetime(2024, 1, 1),
+        manual_detect=False,
+    )
+    tracker = main.consumer.tracker
+    tracker.track(TP, 0)
+    monkeypatch.setattr(main, "insert_bisect", insert_bisect)
+    monkeypatch.setattr(main.dlq_producer, "send_and_wait", send_and_wait)
+    try:
+        batch = Batch(items=[report], offsets=[(TP, 0)], reason="size", started_at=0)
+        await main.insert_batch([batch], dimension_cache=None, sinks=[])
+
+        assert [m["error"] for m in sent] == ["boom"]
+        assert tracker.committable() == {TP: 1}
+    finally:
+        tracker.forget([TP])
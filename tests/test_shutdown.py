@@ -0,0 +1,63 @@
+import asyncio
+import os
+import signal
+
+import pytest
+from _batcher import Batcher
+from _pipeline import Pipeline, Stage
+from gracefull_shutdown import GracefulShutdown
+
+
+@pytest.mark.asyncio
+async def test_drain_flushes_partial_batch():
+    inserted = []
+
+    async def insert(batches):
+        await asyncio.sleep(0.01)
+        inserted.extend(batches)
+
+    async def process(items):
+        for item in items:
+            await batcher.in_queue.put((item, item))
+
+    insert_stage = Stage(name="insert", handler=insert, maxsize=1)
+    batcher = Batcher(
+        out_queue=insert_stage.in_queue,
+        max_records=3,
+        max_bytes=10**9,
+        max_age=60,
+        size_fn=lambda item: 1,
+    )
+    process_stage = Stage(name="process", handler=process, max_items=4)
+    pipeline = Pipeline(stages=[process_stage, batcher, insert_stage])
+    pipeline.start()
+    for i in range(7):
+        await process_stage.in_queue.put(i)
+
+    await asyncio.wait_for(pipeline.drain(), 1)
+    await pipeline.stop()
+
+    assert [b.items for b in inserted] == [[0, 1, 2], [3, 4, 5], [6]]
+    assert inserted[-1].reason == "shutdown"
+
+
+@pytest.mark.asyncio
+async def test_signal_runs_shutdown_sequence_once():
+    calls = []
+
+    async def sequence():
+        calls.append(1)
+
+    event = asyncio.Event()
+    shutdown = GracefulShutdown(shutdown_event=event, shutdown_sequence=sequence)
+    try:
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.wait_for(event.wait(), 1)
+        os.kill(os.getpid(), signal.SIGINT)
+        await asyncio.sleep(0.01)
+        await shutdown.task
+    finally:
+        loop = asyncio.get_running_loop()
+        loop.remove_signal_handler(signal.SIGINT)
+        loop.remove_signal_handler(signal.SIGTERM)
+    assert calls == [1]
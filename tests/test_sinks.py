@@ -0,0 +1,95 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+from _sinks import ArchiveSink, Sink, write_committed
+from app.views.report import ReportRow
+
+
+def reports(n: int) -> list[ReportRow]:
+    return [
+        ReportRow(
+            reportedID=i,
+            reportingID=i + 1,
+            region_id=1,
+            x_coord=2,
+            y_coord=3,
+            z_coord=0,
+            timestamp=datetime(2024, 1, 1),
+            manual_detect=False,
+        )
+        for i in range(n)
+    ]
+
+
+class FileWriter:
+    def __init__(self, path: str, compression: str):
+        self.file = open(path, "wb")
+
+    def write(self, reports: list[ReportRow]) -> None:
+        self.file.write(b"x" * 10 * len(reports))
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+@pytest.mark.asyncio
+async def test_archive_rotates_by_size_and_age(tmp_path):
+    sink = ArchiveSink(
+        directory=str(tmp_path), max_bytes=100, max_age=60, open_writer=FileWriter
+    )
+    await sink.write(reports(5))
+    assert [p.suffix for p in tmp_path.iterdir()] == [".tmp"]
+
+    await sink.write(reports(6))
+    assert sink.writer is None
+    assert [p.suffix for p in tmp_path.iterdir()] == [".parquet"]
+
+    await sink.write(reports(1))
+    sink.opened_at = time.monotonic() - 60
+    assert sink.due() == "age"
+    await sink.close()
+    sizes = sorted(os.path.getsize(p) for p in tmp_path.iterdir())
+    assert sizes == [10, 110]
+
+
+@pytest.mark.asyncio
+async def test_write_committed_skips_transactional_and_failing_sinks():
+    written = []
+
+    class Transactional(Sink):
+        async def write(self, reports, controller=None):
+            written.append(self.name)
+
+    class Failing(Sink):
+        name = "failing"
+        transactional = False
+
+        async def write(self, reports, controller=None):
+            raise OSError("disk full")
+
+    class Archive(Sink):
+        name = "archive"
+        transactional = False
+
+        async def write(self, reports, controller=None):
+            written.append(self.name)
+
+    await write_committed([Transactional(), Failing(), Archive()], reports(1))
+    assert written == ["archive"]
+
+
+@pytest.mark.asyncio
+async def test_archive_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    sink = ArchiveSink(directory=str(tmp_path), max_bytes=10**6, max_age=60)
+    await sink.write(reports(3))
+    await sink.write(reports(2))
+    await sink.close()
+
+    (path,) = tmp_path.iterdir()
+    table = pq.read_table(path)
+    assert table.num_rows == 5
+    assert table.column("reportedID").to_pylist() == [0, 1, 2, 0, 1]
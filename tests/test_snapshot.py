@@ -0,0 +1,52 @@
+import time
+
+import pytest
+from _cache import SimpleALRUCache, TTLCache
+from _snapshot import INT_VALUE, InvalidSnapshot, Snapshot, SnapshotWriter, int_key
+
+
+def decode_id(value: bytes) -> int:
+    return INT_VALUE.unpack(value)[0]
+
+
+def write(path, items: dict[tuple, int]):
+    encode = int_key(2)
+    writer = SnapshotWriter()
+    records = {encode(key): INT_VALUE.pack(_id) for key, _id in items.items()}
+    writer.add_table("location", encode.size, INT_VALUE.size, records)
+    writer.write(str(path))
+
+
+@pytest.mark.asyncio
+async def test_snapshot_backs_cache(tmp_path):
+    path = tmp_path / "cache.snapshot"
+    items = {(i, None if i % 2 else True): i * 10 for i in range(-50, 50)}
+    write(path, items)
+
+    snapshot = Snapshot(str(path), max_age=60)
+    cache = SimpleALRUCache()
+    cache.backing = snapshot.view("location", int_key(2), decode_id)
+
+    assert all([await cache.get(key) == _id for key, _id in items.items()])
+    assert await cache.get((1, True)) is None
+    assert cache.backing_hits == len(items)
+    assert len(cache.cache) == len(items)
+
+
+def test_snapshot_expiry_carries_over(tmp_path):
+    cache = TTLCache()
+    cache.backing = {"a": (1, time.time() + 60), "b": (2, time.time() - 1)}
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert 59 < cache.items()[0][2] - time.time() <= 60
+
+
+def test_stale_snapshot_is_rejected(tmp_path):
+    path = tmp_path / "cache.snapshot"
+    write(path, {(1, 1): 1})
+    with pytest.raises(InvalidSnapshot):
+        Snapshot(str(path), max_age=-1)
+
+    path.write_bytes(path.read_bytes()[:40])
+    with pytest.raises(InvalidSnapshot):
+        Snapshot(str(path), max_age=60)
@@ -0,0 +1,85 @@
+import asyncio
+import os
+
+import main
+import pytest
+import supervisor
+from _metrics import registry, serve_metrics
+from core.config import settings
+
+
+async def serve_forever():
+    registry.gauge("worker_pid", "Pid of the worker").set(os.getpid())
+    await serve_metrics(port=settings.METRICS_PORT, host=settings.METRICS_HOST)
+    await asyncio.Event().wait()
+
+
+async def crash():
+    raise RuntimeError("crash")
+
+
+@pytest.mark.asyncio
+async def test_restart_crashed_worker(monkeypatch):
+    monkeypatch.setattr(main, "main", crash)
+    _supervisor = supervisor.Supervisor(processes=1)
+    _supervisor.start()
+    first = _supervisor.workers[0]
+    await asyncio.to_thread(first.join, 10)
+
+    _supervisor.check()
+    await asyncio.sleep(1.1)
+    _supervisor.check()
+
+    assert _supervisor.workers[0] is not first
+    assert supervisor.restarts_total.values[(0,)] == 1
+    await _supervisor.stop(timeout=5)
+
+
+@pytest.mark.asyncio
+async def test_aggregate_worker_metrics(monkeypatch, unused_tcp_port):
+    monkeypatch.setattr(main, "main", serve_forever)
+    _supervisor = supervisor.Supervisor(processes=2, metrics_port=unused_tcp_port)
+    _supervisor.start()
+    try:
+        for _ in range(50):
+            text = await _supervisor.render()
+            if text.count("worker_pid{") == 2:
+                break
+            await asyncio.sleep(0.1)
+    finally:
+        await _supervisor.stop(timeout=5)
+
+    for index, process in _supervisor.workers.items():
+        assert f'worker_pid{{worker="{index}"}} {process.pid}' in text
+    assert "report_worker_processes 2" in text
+
+
+async def sleep_forever():
+    await asyncio.Event().wait()
+
+
+@pytest.mark.asyncio
+async def test_worker_closes_inherited_metrics_socket(monkeypatch, unused_tcp_port):
+    monkeypatch.setattr(main, "main", sleep_forever)
+    server = await serve_metrics(port=unused_tcp_port, host="127.0.0.1")
+    _supervisor = supervisor.Supervisor(processes=1)
+    _supervisor.server = server
+    _supervisor.start()
+    try:
+        await asyncio.sleep(0.5)
+        server.close()
+        await server.wait_closed()
+        # nobody listens on the port once the supervisor closed it
+        with pytest.raises(OSError):
+            await asyncio.open_connection("127.0.0.1", unused_tcp_port)
+    finally:
+        await _supervisor.stop(timeout=5)
+
+
+@pytest.mark.parametrize("cpu_max, cap", [("max 100000", None), ("150000 100000", 1)])
+def test_default_processes(monkeypatch, tmp_path, cpu_max, cap):
+    path = tmp_path / "cpu.max"
+    path.write_text(cpu_max)
+    monkeypatch.setattr(supervisor, "CPU_MAX", str(path))
+    cpus = len(os.sched_getaffinity(0))
+    assert supervisor.default_processes() == min(cpus, cap or cpus)